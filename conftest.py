@@ -0,0 +1,5 @@
+"""
+Having a conftest at the root of the repository puts the root on sys.path,
+so the tests import summvar and ddsummary from the working tree without the
+package having to be installed
+"""
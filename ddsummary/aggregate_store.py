@@ -0,0 +1,173 @@
+"""
+Per-workspace aggregates for incremental runs
+
+Most workspaces don't change from one night to the next, yet every run used
+to download and summarize every one of them just to rebuild the phs level
+rollups. The store keeps each workspace's data managers (the per-variable
+aggregates) alongside the lastModified value firecloud reported when they
+were built. As long as the workspace's lastModified hasn't moved, those
+aggregates can be merged into the phs level summaries as they are and the
+workspace itself can be skipped entirely.
+
+The workspace's data isn't the only thing that goes into the aggregates,
+though. A fingerprint of the data-dictionary (the ActivityDefinitions and 
+ObservationDefinitions) and the summarizer's settings is stored as well, and
+any change to those means the workspace must be summarized again.
+
+Each workspace gets its own pickle inside the store's directory, so a
+workspace that changes only rewrites its own file. The lastModified and 
+fingerprint for every workspace are also kept in a small index.json so that
+deciding whether a workspace can be skipped doesn't require loading its 
+aggregates.
+"""
+
+from pathlib import Path
+import hashlib
+import pickle
+import json
+
+from ddsummary.checkpoint import od_key
+
+from rich import print
+
+# Bump this whenever the way the aggregates are built changes in a way that
+# makes the stored ones unusable
+STORE_VERSION = 2
+
+def fingerprint(data_dictionary, config=None):
+    """Hash of everything other than the workspace's data that goes into its
+    aggregates"""
+    content = {
+        "version": STORE_VERSION,
+        "config": config or {},
+        "activity_definitions": []
+    }
+    for ad in data_dictionary.activity_definitions:
+        content['activity_definitions'].append({
+            "resource": ad.resource,
+            "missing": sorted(str(value) for value in ad.missing_encoding),
+            "observation_definitions": [od.resource for od in ad.get_observation_definitions()]
+        })
+    content = json.dumps(content, sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+class AggregateStore:
+    def __init__(self, directory, config=None):
+        """
+        :param directory: Where the aggregates (and the index) are kept
+        :param config: dict of the summarizer settings which affect the 
+            aggregates (such as the sketch threshold)
+        """
+        self.directory = Path(directory)
+        self.config = config or {}
+        self.index_file = self.directory / "index.json"
+
+        # ws key => {"last_modified", "fingerprint"}
+        self.index = {}
+        if self.index_file.exists():
+            self.index = json.loads(self.index_file.read_text())
+
+        # id(data_dictionary) => fingerprint. The dictionaries don't change 
+        # over the course of a run
+        self.fingerprints = {}
+
+        # Workspaces which were reused (or refreshed) during this run
+        self.reused = 0
+        self.refreshed = 0
+
+    def filename(self, wsnamespace, wsname):
+        return self.directory / f"{wsnamespace}__{wsname}.pkl"
+
+    def fingerprint(self, data_dictionary):
+        key = id(data_dictionary)
+        if key not in self.fingerprints:
+            self.fingerprints[key] = fingerprint(data_dictionary, self.config)
+        return self.fingerprints[key]
+
+    def save_index(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp = self.index_file.with_suffix(".json.tmp")
+        tmp.write_text(json.dumps(self.index, sort_keys=True, indent=2))
+        tmp.replace(self.index_file)
+
+    def is_current(self, wsnamespace, wsname, last_modified, data_dictionary):
+        """True if the stored aggregates were built from the same 
+        lastModified, data-dictionary and settings. Only the index is 
+        consulted, so this is cheap"""
+        if last_modified is None:
+            return False
+
+        details = self.index.get(f"{wsnamespace}/{wsname}")
+        return details is not None and \
+            details['last_modified'] == last_modified and \
+            details['fingerprint'] == self.fingerprint(data_dictionary) and \
+            self.filename(wsnamespace, wsname).exists()
+
+    def lookup(self, wsnamespace, wsname, last_modified, data_dictionary):
+        """Returns the stored aggregates for the workspace if they are still
+        current (see is_current). Otherwise, None"""
+        if not self.is_current(wsnamespace, wsname, last_modified, data_dictionary):
+            return None
+
+        try:
+            with self.filename(wsnamespace, wsname).open("rb") as f:
+                record = pickle.load(f)
+        except Exception as e:
+            print(f"Unable to load stored aggregates for {wsnamespace}/{wsname}: {e}")
+            return None
+
+        return record
+
+    def reuse(self, record, data_dictionary, cid, phsid):
+        """Merge the stored aggregates into the phs level summaries just as
+        if the workspace had been summarized again"""
+        if phsid is not None:
+            for ad in data_dictionary.activity_definitions:
+                for od in ad.get_observation_definitions():
+                    key = od_key(cid, ad, od)
+                    if key in record['data_managers']:
+                        od.merge_into_phsid(phsid, record['data_managers'][key])
+        self.reused += 1
+
+    def start_workspace(self, data_dictionary):
+        """Forget anything committed by the previous workspace"""
+        for ad in data_dictionary.activity_definitions:
+            for od in ad.get_observation_definitions():
+                od.last_committed = None
+
+    def save(self, wsnamespace, wsname, last_modified, data_dictionary, cid, tables, study_problems):
+        """Capture the workspace level data managers committed while
+        summarizing the workspace. This must happen before the next workspace
+        is merged into the phs level summaries, since the first workspace's
+        data manager becomes the phs level aggregate."""
+        if last_modified is None:
+            return
+
+        data_managers = {}
+        for ad in data_dictionary.activity_definitions:
+            for od in ad.get_observation_definitions():
+                if od.last_committed is not None:
+                    data_managers[od_key(cid, ad, od)] = od.last_committed
+
+        ws_fingerprint = self.fingerprint(data_dictionary)
+        record = {
+            "last_modified": last_modified,
+            "fingerprint": ws_fingerprint,
+            "tables": tables,
+            "study_problems": study_problems,
+            "data_managers": data_managers
+        }
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        filename = self.filename(wsnamespace, wsname)
+        tmp = filename.with_suffix(filename.suffix + ".tmp")
+        with tmp.open("wb") as f:
+            pickle.dump(record, f)
+        tmp.replace(filename)
+
+        self.index[f"{wsnamespace}/{wsname}"] = {
+            "last_modified": last_modified,
+            "fingerprint": ws_fingerprint
+        }
+        self.save_index()
+        self.refreshed += 1
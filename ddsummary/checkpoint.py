@@ -0,0 +1,149 @@
+"""
+Periodic checkpoints for long summary runs
+
+summarize_workspaces can walk hundreds of workspaces in a single run and, up
+to this point, everything it learned along the way lived only in memory. The
+checkpoint captures enough to pick up where we left off:
+
+    - The workspaces that have been completely summarized (and loaded)
+    - The phs level data managers for every ObservationDefinition
+    - The phs ids whose studies have already been created
+    - The partial consensus report
+    - Summaries from completed workspaces the destination wouldn't accept,
+      so that they can be retried when the run is resumed
+
+Everything is pickled into a single file which is replaced atomically so
+that a crash mid-write can't corrupt the previous checkpoint. A Checkpoint 
+without a filename keeps track of things but never writes them out.
+"""
+
+from pathlib import Path
+import pickle
+
+import summvar
+
+from rich import print
+
+def od_key(cid, ad, od):
+    return (cid, ad.table_name, od.source_identifier)
+
+class Checkpoint:
+    def __init__(self, filename=None, every=10):
+        self.filename = None
+        if filename is not None:
+            self.filename = Path(filename)
+        self.every = every
+
+        # namespace/name for each workspace that is finished
+        self.completed = set()
+
+        # phsid => (consortium name, study identifier system)
+        self.study_summaries = {}
+
+        # The consensus report, keyed by workspace name
+        self.study_problems = {}
+
+        # od_key => {phsid => data manager}
+        self.data_managers = {}
+
+        # Research Study ids that have been created (used for partOf)
+        self.valid_phs_ids = set()
+
+        # namespace/name => [summary resource, ...] for completed workspaces
+        # whose summaries couldn't all be written
+        self.failed_uploads = {}
+
+        # Number of workspaces completed since the last save
+        self.pending = 0
+
+    def is_complete(self, wsnamespace, wsname):
+        return f"{wsnamespace}/{wsname}" in self.completed
+
+    def load(self):
+        """Returns True if there was a checkpoint to be loaded"""
+        if self.filename is None or not self.filename.exists():
+            return False
+
+        with self.filename.open("rb") as f:
+            state = pickle.load(f)
+
+        self.completed = state['completed']
+        self.study_summaries = state['study_summaries']
+        self.study_problems = state['study_problems']
+        self.data_managers = state['data_managers']
+        self.valid_phs_ids = state['valid_phs_ids']
+        self.failed_uploads = state.get('failed_uploads', {})
+        print(f"Checkpoint loaded from {self.filename}: {len(self.completed)} workspaces already complete")
+        return True
+
+    def restore(self, data_dictionaries, study_summaries, study_problems):
+        """Push the checkpoint's state back into the live objects"""
+        study_summaries.update(self.study_summaries)
+        study_problems.update(self.study_problems)
+        summvar._valid_phs_ids.update(self.valid_phs_ids)
+
+        for cid, dd in data_dictionaries.items():
+            for ad in dd.activity_definitions:
+                for od in ad.get_observation_definitions():
+                    key = od_key(cid, ad, od)
+                    if key in self.data_managers:
+                        od.study_summaries = self.data_managers[key]
+
+    def capture(self, data_dictionaries, study_summaries, study_problems):
+        self.study_summaries = dict(study_summaries)
+        self.study_problems = study_problems
+        self.valid_phs_ids = set(summvar._valid_phs_ids)
+        self.data_managers = {}
+
+        for cid, dd in data_dictionaries.items():
+            for ad in dd.activity_definitions:
+                for od in ad.get_observation_definitions():
+                    if len(od.study_summaries) > 0:
+                        self.data_managers[od_key(cid, ad, od)] = od.study_summaries
+
+    def workspace_complete(self, wsnamespace, wsname, data_dictionaries, study_summaries, study_problems, failed_uploads=None):
+        """The workspace's data has been merged into the phs level data 
+        managers, so it must not be summarized again on resume. Any summaries
+        that couldn't be written are held onto instead, to be retried"""
+        self.completed.add(f"{wsnamespace}/{wsname}")
+        self.uploads_retried(f"{wsnamespace}/{wsname}", failed_uploads)
+        self.pending += 1
+        if self.pending >= self.every:
+            self.save(data_dictionaries, study_summaries, study_problems)
+
+    def save(self, data_dictionaries, study_summaries, study_problems):
+        if self.filename is None:
+            self.pending = 0
+            return
+
+        self.capture(data_dictionaries, study_summaries, study_problems)
+
+        state = {
+            "completed": self.completed,
+            "study_summaries": self.study_summaries,
+            "study_problems": self.study_problems,
+            "data_managers": self.data_managers,
+            "valid_phs_ids": self.valid_phs_ids,
+            "failed_uploads": self.failed_uploads
+        }
+
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.filename.with_suffix(self.filename.suffix + ".tmp")
+        with tmp.open("wb") as f:
+            pickle.dump(state, f)
+        tmp.replace(self.filename)
+        self.pending = 0
+
+    def uploads_retried(self, workspace_key, still_failing=None):
+        """Replace the summaries waiting on workspace_key (namespace/name) 
+        with those that are still failing"""
+        if still_failing:
+            self.failed_uploads[workspace_key] = list(still_failing)
+        else:
+            self.failed_uploads.pop(workspace_key, None)
+
+    def discard(self):
+        """Remove the checkpoint once the run it belongs to is finished"""
+        if self.filename is not None and self.filename.exists():
+            self.filename.unlink()
+            print(f"Removed checkpoint, {self.filename}")
@@ -0,0 +1,144 @@
+"""
+Local snapshots of Terra workspaces
+
+A snapshot directory holds a manifest describing each workspace (the entry
+firecloud returned for it, including lastModified, and its table schema) along
+with one gzipped JSON file per table:
+
+    DIR/manifest.json
+    DIR/<namespace>__<workspace>/<table>.json.gz
+
+summarize_workspaces can read everything it needs from the snapshot rather
+than firecloud, which makes it possible to rerun summaries (e.g. while working
+on a data-dictionary) without waiting on the network. Refreshing a snapshot
+only downloads the workspaces whose lastModified has changed.
+"""
+
+from pathlib import Path
+import gzip
+import json
+
+import firecloud.api as fapi
+
+from rich import print
+
+class MissingSnapshot(Exception):
+    def __init__(self, namespace, workspace, table_name=None):
+        self.namespace = namespace
+        self.workspace = workspace
+        self.table_name = table_name
+
+    def __str__(self):
+        location = f"{self.namespace}/{self.workspace}"
+        if self.table_name is not None:
+            location = f"{location}:{self.table_name}"
+        return f"{location} is not part of the snapshot"
+
+def ws_key(namespace, workspace):
+    return f"{namespace}/{workspace}"
+
+class SnapshotStore:
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.manifest_file = self.directory / "manifest.json"
+
+        # ws_key => {"workspace", "schema", "tables": table_name => filename}
+        self.manifest = {}
+        if self.manifest_file.exists():
+            self.manifest = json.loads(self.manifest_file.read_text())['workspaces']
+
+    def save_manifest(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp = self.manifest_file.with_suffix(".json.tmp")
+        tmp.write_text(json.dumps({"workspaces": self.manifest}, sort_keys=True, indent=2))
+        tmp.replace(self.manifest_file)
+
+    def details(self, namespace, workspace, table_name=None):
+        key = ws_key(namespace, workspace)
+        if key not in self.manifest:
+            raise MissingSnapshot(namespace, workspace)
+        if table_name is not None and table_name not in self.manifest[key]['tables']:
+            raise MissingSnapshot(namespace, workspace, table_name)
+        return self.manifest[key]
+
+    def is_current(self, workspace):
+        """workspace is the entry from fapi.list_workspaces"""
+        ws = workspace['workspace']
+        key = ws_key(ws['namespace'], ws['name'])
+        if key not in self.manifest:
+            return False
+        return self.manifest[key]['workspace']['workspace'].get('lastModified') == ws.get('lastModified')
+
+    # These mirror the firecloud calls summarize_workspaces makes, only
+    # returning the json content rather than the response
+    def list_workspaces(self):
+        return [details['workspace'] for details in self.manifest.values()]
+
+    def list_entity_types(self, namespace, workspace):
+        return self.details(namespace, workspace)['schema']
+
+    def iter_entities(self, namespace, workspace, table_name):
+        details = self.details(namespace, workspace, table_name)
+        with gzip.open(self.directory / details['tables'][table_name], "rt") as f:
+            for entity in json.load(f):
+                yield entity
+
+    def get_entities(self, namespace, workspace, table_name):
+        return list(self.iter_entities(namespace, workspace, table_name))
+
+    def store_workspace(self, workspace, schema, tables):
+        """Write a workspace's tables to the snapshot. tables is table_name
+        => list of entities"""
+        ws = workspace['workspace']
+        wsdir = f"{ws['namespace']}__{ws['name']}"
+        (self.directory / wsdir).mkdir(parents=True, exist_ok=True)
+
+        table_files = {}
+        for table_name, entities in tables.items():
+            filename = f"{wsdir}/{table_name}.json.gz"
+            tmp = self.directory / f"{filename}.tmp"
+            with gzip.open(tmp, "wt") as f:
+                json.dump(entities, f)
+            tmp.replace(self.directory / filename)
+            table_files[table_name] = filename
+
+        # Tables that have since been dropped from the workspace go too
+        key = ws_key(ws['namespace'], ws['name'])
+        if key in self.manifest:
+            for table_name, filename in self.manifest[key]['tables'].items():
+                if table_name not in table_files:
+                    (self.directory / filename).unlink(missing_ok=True)
+
+        self.manifest[key] = {
+            "workspace": workspace,
+            "schema": schema,
+            "tables": table_files
+        }
+        self.save_manifest()
+
+    def pull_workspace(self, workspace):
+        """Download the workspace from firecloud into the snapshot"""
+        ws = workspace['workspace']
+        namespace = ws['namespace']
+        name = ws['name']
+
+        schema = fapi.list_entity_types(namespace=namespace, workspace=name).json()
+        tables = {}
+        for table_name in schema:
+            tables[table_name] = fapi.get_entities(namespace, name, table_name).json()
+        self.store_workspace(workspace, schema, tables)
+
+    def refresh(self, workspaces):
+        """Pull each of the workspaces (entries from fapi.list_workspaces)
+        whose lastModified differs from what is in the snapshot. Returns the
+        number of workspaces that were downloaded"""
+        pulled = 0
+        for workspace in workspaces:
+            ws = workspace['workspace']
+            if self.is_current(workspace):
+                print(f"{ws['namespace']}/{ws['name']} is up to date")
+            else:
+                print(f"Pulling {ws['namespace']}/{ws['name']} ({ws.get('lastModified')})")
+                self.pull_workspace(workspace)
+                pulled += 1
+        return pulled
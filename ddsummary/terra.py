@@ -0,0 +1,106 @@
+"""
+Streaming access to Terra workspace tables
+
+fapi.get_entities returns an entire table in one response, which is fine for
+small tables but the sample and file tables in some of the larger workspaces
+are big enough to dominate the run's memory. The entity query API lets us
+pull a table a page at a time, so we only ever hold a single page.
+
+When memory isn't the concern, the TablePrefetcher instead keeps a few 
+workspaces' worth of tables downloading in the background while the current
+workspace is summarized and loaded.
+"""
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_PAGE_SIZE = 1000
+
+class EntityQueryError(Exception):
+    def __init__(self, namespace, workspace, table_name, page, status_code):
+        self.namespace = namespace
+        self.workspace = workspace
+        self.table_name = table_name
+        self.page = page
+        self.status_code = status_code
+
+    def __str__(self):
+        return f"Unable to pull page {self.page} of {self.namespace}/{self.workspace}:{self.table_name} ({self.status_code})"
+
+def iter_entities(namespace, workspace, table_name, page_size=DEFAULT_PAGE_SIZE):
+    """Yield each entity (row) of a workspace table, one page at a time"""
+    # Only the reader needs firecloud. The prefetcher works with whatever
+    # fetch function it is given (including the offline snapshots)
+    import firecloud.api as fapi
+
+    page = 1
+    page_count = 1
+    while page <= page_count:
+        response = fapi.get_entities_query(namespace,
+                                           workspace,
+                                           table_name,
+                                           page=page,
+                                           page_size=page_size)
+        if response.status_code != 200:
+            raise EntityQueryError(namespace, workspace, table_name, page, response.status_code)
+
+        content = response.json()
+        page_count = content['resultMetadata']['filteredPageCount']
+        for entity in content['results']:
+            yield entity
+        page += 1
+
+class TablePrefetcher:
+    """Download workspace tables ahead of when they are needed.
+
+    keys are the arguments to fetch for each workspace, in the order the 
+    workspaces will be consumed. At most depth workspaces are in flight (or
+    waiting to be consumed) at a time, so memory stays bounded no matter how
+    many workspaces there are. Results are always handed back in the order
+    they are asked for, regardless of which download finishes first.
+    """
+    def __init__(self, fetch, keys, workers=4, depth=None):
+        self.fetch = fetch
+        self.pending = deque(keys)
+        self.depth = depth if depth is not None else workers * 2
+
+        # key => future, in the order they were submitted
+        self.futures = OrderedDict()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.fill()
+
+    def fill(self):
+        while len(self.pending) > 0 and len(self.futures) < self.depth:
+            key = self.pending.popleft()
+            self.futures[key] = self.executor.submit(self.fetch, *key)
+
+    def get(self, key):
+        """Returns the fetched result for key. Anything submitted ahead of 
+        key is no longer going to be asked for, so it is dropped"""
+        result = None
+        if key in self.futures:
+            while len(self.futures) > 0:
+                next_key, future = self.futures.popitem(last=False)
+                if next_key == key:
+                    result = future.result()
+                    break
+                future.cancel()
+        else:
+            # Either we skipped far enough ahead that the key hasn't been 
+            # submitted yet, or it isn't something we were expecting. Either
+            # way, everything before it is stale and we just pull it now
+            if key in self.pending:
+                for future in self.futures.values():
+                    future.cancel()
+                self.futures = OrderedDict()
+                while self.pending.popleft() != key:
+                    pass
+            result = self.fetch(*key)
+
+        self.fill()
+        return result
+
+    def shutdown(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown()
@@ -3,10 +3,21 @@
 """
 We want to create study resources for these things we encounter, but we only 
 have an id, so I guess we can scrape the actual data from dbgap. 
+
+Resolving the qualified accession is a single (quick) request, but pulling 
+and parsing the GapExchange XML is not. So the parsed study configurations
+are kept in a cache, keyed by the qualified accession. When dbGaP releases a
+new version of the study, the qualified accession changes and we pull the 
+new details. prefetch_studies can be used to resolve a batch of phs ids 
+concurrently before they are needed.
 """
 
 import xmltodict
 import requests
+import json
+from pathlib import Path
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 
 from summvar import system_prefix, system_url, study_id, create_dataset_study, create_study_group
 
@@ -23,6 +34,90 @@ class InvalidStudyID(Exception):
     def message(self):
         return "No DbGAP study ID found matching {self.id}."
 
+class StudyCache:
+    """Parsed study configurations keyed by qualified accession, optionally
+    written to a JSON file so that they survive between runs"""
+    def __init__(self, filename=None):
+        self.filename = None
+        if filename is not None:
+            self.filename = Path(filename)
+
+        # qualified accession => configuration
+        self.configurations = {}
+        self.lock = Lock()
+
+        if self.filename is not None and self.filename.exists():
+            self.configurations = json.loads(self.filename.read_text())
+
+    def configuration(self, phsid, qualified_accession):
+        with self.lock:
+            if qualified_accession in self.configurations:
+                return self.configurations[qualified_accession]
+
+        details_url = f"https://ftp.ncbi.nlm.nih.gov/dbgap/studies/{phsid}/{qualified_accession}/GapExchange_{qualified_accession}.xml"
+        response = requests.get(details_url)
+        assert response.status_code == 200
+        data = xmltodict.parse(response.text)
+        configuration = data['GaPExchange']['Studies']['Study']['Configuration']
+
+        with self.lock:
+            self.configurations[qualified_accession] = configuration
+            self.save()
+        return configuration
+
+    def save(self):
+        if self.filename is not None:
+            self.filename.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.filename.with_suffix(self.filename.suffix + ".tmp")
+            tmp.write_text(json.dumps(self.configurations))
+            tmp.replace(self.filename)
+
+_study_cache = StudyCache()
+
+# phsid => DbGaPStudy (or the InvalidStudyID raised when we tried to pull it)
+_studies = {}
+
+def InitStudyCache(filename=None):
+    global _study_cache
+
+    _study_cache = StudyCache(filename)
+    return _study_cache
+
+def get_study(phsid):
+    """Returns the DbGaPStudy for phsid, only pulling it if it hasn't been 
+    seen already during this run"""
+    if phsid not in _studies:
+        try:
+            _studies[phsid] = DbGaPStudy(phsid)
+        except InvalidStudyID as e:
+            _studies[phsid] = e
+
+    study = _studies[phsid]
+    if isinstance(study, InvalidStudyID):
+        raise study
+    return study
+
+def prefetch_studies(phsids, workers=8):
+    """Resolve each of the phsids concurrently so that they are ready by the
+    time get_study is called for them"""
+    phsids = [x for x in set(phsids) if x not in _studies]
+
+    def pull(phsid):
+        try:
+            return DbGaPStudy(phsid)
+        except InvalidStudyID as e:
+            return e
+        except Exception as e:
+            # Leave it for get_study to try again (and report) when needed
+            print(f"Unable to prefetch {phsid}: {e}")
+            return None
+
+    if len(phsids) > 0:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for phsid, study in zip(phsids, executor.map(pull, phsids)):
+                if study is not None:
+                    _studies[phsid] = study
+
 class DbGaPStudy:
     def __init__(self, phsid):
         global study_base, study_details_base
@@ -53,12 +148,7 @@ class DbGaPStudy:
                     "Attributions": "None available at this time",
                 }
             else:
-                details_url = f"https://ftp.ncbi.nlm.nih.gov/dbgap/studies/{phsid}/{self.qualified_accession}/GapExchange_{self.qualified_accession}.xml"
-                response = requests.get(details_url)
-                assert response.status_code == 200
-                self.data = xmltodict.parse(response.text)
-
-                configuration = self.data['GaPExchange']['Studies']['Study']['Configuration']
+                configuration = _study_cache.configuration(phsid, self.qualified_accession)
             # Not sure what the difference is between StudyNameEntrez and StudyNameReportPage
             self.title = configuration['StudyNameEntrez']
             self.description = configuration['Description']
@@ -2,10 +2,18 @@
 
 """
 Provide a simple script for pulling data from firecloud API and write it out as JSON file
+
+With --snapshot, the workspaces are written to a snapshot directory instead 
+(see ddsummary/snapshot.py), which summarize_workspaces can read using 
+--from-snapshot. Workspaces already in the snapshot are only pulled again if
+their lastModified has changed.
 """
 
 import firecloud.api as fapi
 
+from ddsummary.snapshot import SnapshotStore
+from ddsummary.yamlcfg import SummaryConfig
+
 from os import getenv
 
 from pathlib import Path
@@ -15,6 +23,7 @@ from yaml import safe_load
 from rich import print
 import json
 import re 
+import sys
 
 import pdb
 
@@ -25,7 +34,7 @@ if __name__ == '__main__':
     parser = ArgumentParser("Pull Workspace Data - Pulls data from the firecloud API into JSON file suitable for debugging our summary scripts")
     parser.add_argument("workspaces",
                         type=str, 
-                        nargs="+",
+                        nargs="*",
                         help="A Workspace to be pulled from firecloud")
 
     parser.add_argument("-o",
@@ -34,10 +43,50 @@ if __name__ == '__main__':
                         default=None,
                         help="Filename to write the results to (defaults to the first workspace name in output/)")
     
+    parser.add_argument("--snapshot",
+                        type=str,
+                        default=None,
+                        metavar="DIR",
+                        help="Refresh the snapshot in DIR, downloading only the "
+                             "workspaces whose lastModified has changed. If no "
+                             "workspaces or projects are provided, every "
+                             "workspace already in the snapshot is refreshed")
+    parser.add_argument("--project",
+                        type=FileType('rt'),
+                        action='append',
+                        default=[],
+                        help="Project YAML file. Workspaces belonging to the "
+                             "project are included in the snapshot")
+
     args = parser.parse_args()
 
     workspaces = fapi.list_workspaces().json()
 
+    if args.snapshot is not None:
+        snapshot = SnapshotStore(args.snapshot)
+
+        gsumm = SummaryConfig()
+        for prj in args.project:
+            gsumm.add_consortium(prj)
+
+        selected = []
+        for workspace in workspaces:
+            ws = workspace['workspace']
+            if ws['name'] in args.workspaces or \
+                    gsumm.find_consortium(ws['name']) is not None:
+                selected.append(workspace)
+            elif len(args.workspaces) == 0 and len(args.project) == 0 and \
+                    f"{ws['namespace']}/{ws['name']}" in snapshot.manifest:
+                selected.append(workspace)
+
+        pulled = snapshot.refresh(selected)
+        print(f"{pulled} of {len(selected)} workspaces were pulled into {args.snapshot}")
+        sys.exit(0)
+
+    if len(args.workspaces) == 0:
+        print("You must provide one or more workspaces when not refreshing a snapshot")
+        sys.exit(1)
+
     workspace_resources = {}
 
     print(f"Searching for workspaces: {args.workspaces}")
@@ -14,10 +14,15 @@ from ncpi_fhir_client.fhir_client import FhirClient
 #from ncpi_fhir_plugin.common import constants
 from argparse import ArgumentParser, FileType
 from summvar.fhir.research_study import pull_studies, ResearchStudy
-from summvar.fhir.group import Group
+from summvar.fhir.group import Group, GroupIndex
+from summvar.fhir.study_scan import StudyScan
 from summvar.fhir import InitMetaTag,MetaTag
+from summvar.fhir.valueset import InitVocabularyCache, replicate_vocabulary, VocabularyLoadError, DEFAULT_VOCAB_WORKERS, DEFAULT_READY_TIMEOUT, DEFAULT_VOCAB_TTL
+from summvar.fhir.bundle import BundleWriter, DEFAULT_BUNDLE_SIZE
+from summvar.upload_ledger import InitUploadLedger
+from summvar.fhir.observation_definition import PULL_SCOPES
+from summvar.fhir.search import host_setting, DEFAULT_BATCH_SIZE, DEFAULT_PAGE_SIZE
 from summvar.summary.condition import summarize as summarize_conditions
-from time import sleep
 import pdb
 
 from rich.pretty import pprint
@@ -25,24 +30,6 @@ from rich.console import Console
 from rich.live import Live
 from rich.table import Table
 
-def load_vocabulary(host, resource):
-    retry_count = 5
-
-    while retry_count > 0:
-        identifier = f"{resource['identifier'][0]['system']}|{resource['identifier'][0]['value']}"
-        response = host.post(resource['resourceType'], resource, identifier=identifier)
-        if response['status_code'] > 299:
-            retry_count -= 1
-            sleep(2)
-        else:
-            retry_count = 0
-    if response['status_code'] > 299:
-        pprint(resource)
-        pprint(response)
-        pprint("We were unable to load the resource. ")
-        sys.exit(1)
-    return response
-
 if __name__ == "__main__":
 
     # Identify the hosts we can choose from
@@ -75,14 +62,83 @@ if __name__ == "__main__":
                 action='store_true',
                 help="When active, data-dictionary pieces will be copied to destination")
 
+    parser.add_argument("--vocab-cache",
+                type=str,
+                default=None,
+                help="File used to keep ValueSet expansions between runs")
+
+    parser.add_argument("--vocab-ttl",
+                type=int,
+                default=DEFAULT_VOCAB_TTL,
+                help="Number of seconds a cached ValueSet expansion remains "
+                     f"valid (default {DEFAULT_VOCAB_TTL})")
+
+    parser.add_argument("--ledger",
+                type=str,
+                default=None,
+                help="SQLite file recording what has already been written to "
+                     "each host. Resources identical to what the host "
+                     "already has are not written again")
+    parser.add_argument("--ledger-reset",
+                action='store_true',
+                help="Forget everything the ledger has recorded for the "
+                     "destination host before writing anything. Use this when "
+                     "the destination was changed or wiped outside of these "
+                     "scripts")
+
+    parser.add_argument("--vocab-workers",
+                type=int,
+                default=DEFAULT_VOCAB_WORKERS,
+                help="Number of CodeSystems/ValueSets uploaded at a time when "
+                     "copying the vocabulary to the destination")
+
+    parser.add_argument("--vocab-timeout",
+                type=int,
+                default=DEFAULT_READY_TIMEOUT,
+                help="Max number of seconds to wait on the destination to "
+                     "index newly loaded CodeSystems")
+
+    parser.add_argument("--bundle-size",
+                type=int,
+                default=DEFAULT_BUNDLE_SIZE,
+                help="Number of summary Observations written per batch bundle")
+
+    parser.add_argument("--partitioned",
+                action='store_true',
+                help="Pull each variable's Observations once for all of the "
+                     "study's groups rather than once per group")
+
+    parser.add_argument("--study-scan",
+                action='store_true',
+                help="Pull every Observation tagged with the study in a single "
+                     "pass, routing each to its variable by code, rather than "
+                     "searching for each variable separately. Observations "
+                     "that don't match any variable are reported")
+
+    parser.add_argument("--observation-scope",
+                choices=PULL_SCOPES,
+                default="server",
+                help="How each variable's Observations are found: every "
+                     "Observation on the server with the variable's code, or "
+                     "narrowed on the server by the study's tag, the group's "
+                     "subjects or group membership")
+
     args = parser.parse_args()
+
+    InitVocabularyCache(filename=args.vocab_cache, ttl=args.vocab_ttl)
+    ledger = InitUploadLedger(args.ledger)
     
     fhir_host = FhirClient(config[args.source_env])
     dest_host = fhir_host
+    batch_size = host_setting(config[args.source_env], 'batch_size', DEFAULT_BATCH_SIZE)
+    page_size = host_setting(config[args.source_env], 'page_size', DEFAULT_PAGE_SIZE)
 
     if args.dest_env:
         dest_host = FhirClient(config[args.dest_env])
 
+    if ledger is not None and args.ledger_reset:
+        print(f"Upload ledger: forgot {ledger.reset(dest_host)} resources")
+
     target_studies = args.study
     # If we didn't get one or more groups, identify available groups and let the user choose one
     if len(target_studies) == 0:
@@ -126,20 +182,31 @@ if __name__ == "__main__":
         resource = study.load(dest_host)
 
         groups = study.get_groups()
+        group_index = None
+        if args.partitioned or args.study_scan:
+            group_index = GroupIndex(groups)
+
+        scan = None
+        if args.study_scan:
+            scan = StudyScan(fhir_host, 
+                             study.get_activity_definitions(), 
+                             group_index, 
+                             page_size=page_size)
+            scan.scan()
+            scan.report_unmatched()
 
         # This approach assumes the dd lives with the row-level data, which 
         # probably isn't always going to be true. We should probably move this
         # function over to the od file as a class method or global function
         activity_defs = study.get_activity_definitions()
 
-        #pdb.set_trace()
-        for ad in activity_defs:
-            if fhir_host != dest_host:
-                # Collect the vocabulary and load them into the remote host
+        if fhir_host != dest_host:
+            # Collect the vocabulary for every table up front so that it can
+            # all be loaded into the remote host together (and we only have 
+            # to wait on the code systems to be indexed once)
+            vocabulary = []
+            for ad in activity_defs:
                 vocab = ad.get_vocabulary()
-
-                #pdb.set_trace()
-                code_systems_loaded = 0
                 for url in vocab.keys():
                     resource = vocab[url]
                     if 'resource' in resource:
@@ -148,27 +215,25 @@ if __name__ == "__main__":
                     if 'resourceType' not in resource:
                         pprint(resource)
                         pdb.set_trace()
-                    if resource['resourceType'] == 'CodeSystem':
-                        del resource['id']
+                    if resource['resourceType'] in ['CodeSystem', 'ValueSet']:
                         if resource['url'] not in saved_vocabs:
-                            response = load_vocabulary(dest_host, resource)
-                            code_systems_loaded += 1
+                            vocabulary.append(resource)
                             saved_vocabs.add(resource['url'])
 
-                # Give the code systems some time to merge into the database
-                if code_systems_loaded > 0:
-                    sleep(60)
-                for url in vocab.keys():
-                    resource = vocab[url]
-                    if 'resource' in resource:
-                        resource = resource['resource']
-                        
-                    if resource['resourceType'] == 'ValueSet':
-                        del resource['id']
-                        if resource['url'] not in saved_vocabs:
-                            response = load_vocabulary(dest_host, resource)
-                            saved_vocabs.add(resource['url'])
+            try:
+                replicate_vocabulary(dest_host, 
+                                     vocabulary, 
+                                     workers=args.vocab_workers, 
+                                     timeout=args.vocab_timeout)
+            except VocabularyLoadError as e:
+                pprint(e.resource)
+                pprint(e.response)
+                pprint("We were unable to load the resource. ")
+                sys.exit(1)
 
+        #pdb.set_trace()
+        for ad in activity_defs:
+            if fhir_host != dest_host:
                 if args.full_dd:
                     resource = ad.load(dest_host)
 
@@ -186,38 +251,60 @@ if __name__ == "__main__":
             min_obs = None
             max_obs = None
             sum_counts = 0
+            writer = BundleWriter(dest_host, batch_size=args.bundle_size)
             with Live(table, refresh_per_second=1):
                 for od in ods:
-                    for population in groups:
+                    if scan is not None:
+                        # The scan has already divided everything up 
+                        results = od.build_partitioned_summaries(dest_host, 
+                                                                 study.identifier['value'], 
+                                                                 focus=study.remote_ref)
+                    elif group_index is not None:
+                        # One pass over the Observations feeds every group
+                        od.pull_partitioned(group_index, 
+                                            scope=args.observation_scope, 
+                                            batch_size=batch_size, 
+                                            page_size=page_size)
+                        results = od.build_partitioned_summaries(dest_host, 
+                                                                 study.identifier['value'], 
+                                                                 focus=study.remote_ref)
+                    else:
+                        results = []
+                        for population in groups:
+                            od.pull_observations(population, 
+                                                 scope=args.observation_scope, 
+                                                 batch_size=batch_size, 
+                                                 page_size=page_size)
+                            results.append(od.summarize_population(dest_host, 
+                                                                   study.identifier['value'], 
+                                                                   focus=study.remote_ref))
+
+                    for result in results:
                         total_non_missing = 0
                         total_missing = 0
-                        od.pull_observations(population)
-                        varsummary = od.build_summary(dest_host)
+                        varsummary = result.summary
                         if varsummary is not None:
-                            total_non_missing = od.nonmissing_count
-                            if min_obs is None or min_obs < od.nonmissing_count:
-                                min_obs = od.nonmissing_count
-                            if max_obs is None or max_obs > od.nonmissing_count:
-                                max_obs = od.nonmissing_count
-                            sum_counts += od.nonmissing_count
-                            resource = dest_host.post(varsummary['resourceType'], 
-                                            varsummary, 
-                                            identifier=varsummary['identifier'][0]['value'], 
-                                            identifier_system=varsummary['identifier'][0]['system'])
-                            if not resource['status_code'] < 300:
-                                pprint(varsummary)
-                                pprint(resource)
-                                sys.exit(1)
+                            total_non_missing = result.nonmissing_count
+                            if min_obs is None or min_obs < result.nonmissing_count:
+                                min_obs = result.nonmissing_count
+                            if max_obs is None or max_obs > result.nonmissing_count:
+                                max_obs = result.nonmissing_count
+                            sum_counts += result.nonmissing_count
+                            writer.add(varsummary)
 
                             #pdb.set_trace()
-                            table.add_row(population.name,
+                            table.add_row(result.population.name,
                                         od.identifier['value'],
                                         od.code.display,
-                                        od.type_name,
-                                        str(od.nonmissing_count),
-                                        str(od.missing_count))
+                                        result.type_name,
+                                        str(result.nonmissing_count),
+                                        str(result.missing_count))
                         else:
                             total_missing += 1
+            writer.flush()
+            if len(writer.failures) > 0:
+                writer.report_failures()
+                sys.exit(1)
 
 
         if not args.no_condition:
@@ -229,9 +316,8 @@ if __name__ == "__main__":
                 table.add_column("NonMiss", style="green" )
                 table.add_column("Miss", style="bright_red")
 
+                writer = BundleWriter(dest_host, batch_size=args.bundle_size)
                 with Live(table, refresh_per_second=1):
-                    valid_summaries = 0
-                    invalid_summaries = 0
                     condition_summaries = summarize_conditions(fhir_host, name, group.p_refs, group.remote_reference(dest_host))
                     for summary in condition_summaries:
                         #pdb.set_trace()
@@ -240,20 +326,11 @@ if __name__ == "__main__":
                                     str(summary['component'][0]['valueInteger']),
                                     str(summary['component'][1]['valueInteger'])
                                     )
-                        identity = f"{summary['identifier'][0]['system']}|{summary['identifier'][0]['value']}"
-                        response = dest_host.post(summary['resourceType'], summary, identifier=identity)
+                        writer.add(summary)
+                    writer.flush()
 
-                        if response['status_code'] < 300:
-                            valid_summaries+=1
-                            #pdb.set_trace()
-                            #print(f"\t\tSummary: {summary['resourceType']}/{response['response']['id']}")
-                        else:
-                            pprint(summary)
-                            pprint(response)
-                            pdb.set_trace()
-                            invalid_summaries += 1
-
-                print(f"{group.name}: {valid_summaries} Added")
-                if invalid_summaries > 0:
-                    print(f"{group.name}: {invalid_summaries} Failed")
+                print(f"{group.name}: {writer.written} Added")
+                if len(writer.failures) > 0:
+                    writer.report_failures()
+                    print(f"{group.name}: {len(writer.failures)} Failed")
 
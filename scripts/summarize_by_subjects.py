@@ -123,7 +123,7 @@ if __name__ == '__main__':
                 resource = response['response']
                 group = Group(dest_host, resource=resource)
             
-        if len(group.p_refs) == 0:       
+        if group.count == 0:       
             #pdb.set_trace()
             group.p_refs = patient_refs
 
@@ -28,13 +28,18 @@ from yaml import safe_load
 from ncpi_fhir_client.fhir_client import FhirClient
 from argparse import ArgumentParser, FileType
 from summvar.fhir.group import pull_groups, Group
-from summvar.fhir import InitMetaTag,MetaTag,has_no_study
-from summvar.summary.condition import summarize as summarize_conditions
+from summvar.fhir import InitMetaTag,MetaTag
+from summvar.summary.condition import summarize as summarize_conditions, HARVEST_STRATEGIES
+from summvar.fhir.search import host_setting, DEFAULT_BATCH_SIZE
 from summvar.summary.patient import summarize as summarize_demo
+from summvar.summary.hpo import summarize as summarize_phenotypes, SCAN_STRATEGIES
+from summvar.summary.fused import summarize as summarize_fused
+from summvar.fhir.bundle import BundleWriter, DEFAULT_BUNDLE_SIZE
+from summvar.upload_ledger import InitUploadLedger, forget as forget_upload, post as ledger_post
 from pprint import pformat
 import pdb
 
-def summarize_group(fhir_host, dest_host, group):
+def summarize_group(fhir_host, dest_host, group, batch_size=None, condition_strategy="subject", phenotype_strategy=None, fused=False, bundle_size=DEFAULT_BUNDLE_SIZE):
     group_ref = group.reference
     gdest = None
     ident = group.identifier
@@ -49,17 +54,45 @@ def summarize_group(fhir_host, dest_host, group):
             # There is no valid group with that identifier
             tempgroup = group.objectify(min=True)
             #pdb.set_trace()
-            response = dest_host.post('Group', tempgroup)
+            # The destination doesn't have it, whatever the ledger thinks
+            forget_upload(dest_host, tempgroup)
+            response = ledger_post(dest_host, 'Group', tempgroup)
             if response['status_code'] == 201:
                 resource = response['response']      
                 gdest = Group(dest_host, resource = resource)     
                 group_ref = gdest.reference 
 
-    valid_summaries = 0
-    invalid_summaries = 0
-    hpo_summaries = summarize_conditions(fhir_host, group.name, group.p_refs, group_ref)
-    demo_summaries = summarize_demo(fhir_host, group.name, group.p_refs, group_ref)
+    # Building the member references isn't free, so only do it once
+    p_refs = group.p_refs
+
+    if fused:
+        # Demographics, conditions and phenotypes all come from the same 
+        # pages of Patients (with their Conditions and Observations included)
+        condition_summaries, phenotype_summaries, demo_summaries = summarize_fused(fhir_host,
+                                         group.name,
+                                         p_refs,
+                                         group_ref,
+                                         batch_size=batch_size or DEFAULT_BATCH_SIZE)
+        hpo_summaries = condition_summaries + phenotype_summaries
+    else:
+        hpo_summaries = summarize_conditions(fhir_host, 
+                                         group.name, 
+                                         p_refs, 
+                                         group_ref, 
+                                         strategy=condition_strategy, 
+                                         batch_size=batch_size or DEFAULT_BATCH_SIZE)
+        demo_summaries = summarize_demo(fhir_host, group.name, p_refs, group_ref, batch_size=batch_size)
+
+        # The fused summary always includes the phenotypes, but otherwise 
+        # they are only summarized when asked for
+        if phenotype_strategy is not None:
+            hpo_summaries = hpo_summaries + summarize_phenotypes(fhir_host, 
+                                         group.name, 
+                                         p_refs, 
+                                         group_ref, 
+                                         strategy=phenotype_strategy)
     #pdb.set_trace()
+    writer = BundleWriter(dest_host, batch_size=bundle_size)
     for summary in hpo_summaries + demo_summaries:
         #pdb.set_trace()
         if gdest is not None:
@@ -68,16 +101,15 @@ def summarize_group(fhir_host, dest_host, group):
         identity = f"{summary['identifier'][0]['system']}|{summary['identifier'][0]['value']}"
         print(identity)
 
-        response = dest_host.post('Observation', summary, identifier=identity)
-        if response['status_code'] < 300:
-            valid_summaries+=1
-        else:
-            print(pformat(response))
-            pdb.set_trace()
-            invalid_summaries += 1
-    print(f"{ident['value']}: {valid_summaries} Added")
-    if invalid_summaries > 0:
-        print(f"{ident['value']}: {invalid_summaries} Failed")
+        writer.add(summary)
+    writer.flush()
+
+    print(f"{ident['value']}: {writer.written} Added in {writer.request_count} requests")
+    if writer.skipped > 0:
+        print(f"{ident['value']}: {writer.skipped} Unchanged")
+    if len(writer.failures) > 0:
+        writer.report_failures()
+        print(f"{ident['value']}: {len(writer.failures)} Failed")
     return gdest 
     
 if __name__ == '__main__':
@@ -100,14 +132,60 @@ if __name__ == '__main__':
                 default=[],
                 action='append',
                 help="Optional group to summarize over.")
+    parser.add_argument("--batch-size",
+                type=int,
+                default=None,
+                help="Pull patients in batches of this size rather than one "
+                     "at a time. Defaults to the source host's batch_size "
+                     "setting, if present.")
+    parser.add_argument("--condition-strategy",
+                choices=HARVEST_STRATEGIES,
+                default="subject",
+                help="How Conditions are pulled for the group: one search "
+                     "per patient, multi-subject searches or a single tag "
+                     "scoped search filtered against the group's members")
+    parser.add_argument("--phenotype-strategy",
+                choices=SCAN_STRATEGIES,
+                default=None,
+                help="Also summarize the group's phenotype Observations, "
+                     "pulling them with one search per patient, a single "
+                     "tag scoped scan filtered against the group's members "
+                     "or whichever of those needs fewer requests (auto). "
+                     "--fused always includes the phenotypes")
+    parser.add_argument("--ledger",
+                type=str,
+                default=None,
+                help="SQLite file recording what has already been written to "
+                     "each host. Resources identical to what the host "
+                     "already has are not written again")
+    parser.add_argument("--ledger-reset",
+                action='store_true',
+                help="Forget everything the ledger has recorded for the "
+                     "destination host before writing anything. Use this when "
+                     "the destination was changed or wiped outside of these "
+                     "scripts")
+    parser.add_argument("--bundle-size",
+                type=int,
+                default=DEFAULT_BUNDLE_SIZE,
+                help="Number of summary Observations written per batch bundle")
+    parser.add_argument("--fused",
+                action='store_true',
+                help="Summarize demographics, conditions and phenotypes in a "
+                     "single pass over the group's patients using _revinclude")
 
     args = parser.parse_args()
+    ledger = InitUploadLedger(args.ledger)
     fhir_host = FhirClient(config[args.source_env])
+    if args.batch_size is None:
+        args.batch_size = host_setting(config[args.source_env], 'batch_size', None)
     dest_host = fhir_host
 
     if args.dest_env:
         dest_host = FhirClient(config[args.dest_env])
 
+    if ledger is not None and args.ledger_reset:
+        print(f"Upload ledger: forgot {ledger.reset(dest_host)} resources")
+
     # If we didn't get one or more groups, identify available groups and let the user choose one
     if len(args.group) == 0:
         groups = pull_groups(fhir_host)
@@ -136,7 +214,14 @@ if __name__ == '__main__':
         group = Group(fhir_host, identifier=name)
         #pdb.set_trace()
 
-        summarize_group(fhir_host, dest_host, group)
+        summarize_group(fhir_host, 
+                        dest_host, 
+                        group, 
+                        batch_size=args.batch_size, 
+                        condition_strategy=args.condition_strategy,
+                        phenotype_strategy=args.phenotype_strategy,
+                        fused=args.fused,
+                        bundle_size=args.bundle_size)
 
                         
                 
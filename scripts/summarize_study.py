@@ -31,10 +31,41 @@ from summvar.fhir.research_study import pull_studies, ResearchStudy
 from summvar.fhir.group import Group
 from summvar.fhir import InitMetaTag,MetaTag
 from summarize_group import summarize_group
-from summvar.summary.condition import summarize as summarize_conditions
+from summvar.summary.condition import summarize as summarize_conditions, HARVEST_STRATEGIES
+from summvar.summary.hpo import SCAN_STRATEGIES
+from summvar.fhir.bundle import DEFAULT_BUNDLE_SIZE
+from summvar.fhir.search import host_setting
+from summvar.upload_ledger import InitUploadLedger, forget as forget_upload, post as ledger_post
+from concurrent.futures import ProcessPoolExecutor
 from pprint import pformat
 import pdb
 
+# Each worker process gets its own connections to the source and destination
+_worker_hosts = None
+
+def init_worker(source_cfg, dest_cfg, ledger=None):
+    global _worker_hosts
+    InitUploadLedger(ledger)
+    fhir_host = FhirClient(source_cfg)
+    dest_host = fhir_host
+    if dest_cfg is not None:
+        dest_host = FhirClient(dest_cfg)
+    _worker_hosts = (fhir_host, dest_host)
+
+def summarize_group_ref(group_ref, tag_system, tag_code, options):
+    """Summarize a single group inside a worker process and return the 
+    reference to the group on the destination server (if any)"""
+    fhir_host, dest_host = _worker_hosts
+
+    # The meta tag is module level state, so each worker must set it for 
+    # the study it is working on
+    InitMetaTag(system=tag_system, code=tag_code)
+    group = Group(fhir_host, identifier=group_ref)
+    remote_group = summarize_group(fhir_host, dest_host, group, **options)
+    if remote_group is not None:
+        return remote_group.reference
+    return None
+
 if __name__ == '__main__':
 
     hostsfile = Path(getenv("FHIRHOSTS", 'fhir_hosts'))
@@ -55,14 +86,65 @@ if __name__ == '__main__':
                 default=[],
                 action='append',
                 help="Optional study to summarize over.")
+    parser.add_argument("--batch-size",
+                type=int,
+                default=None,
+                help="Pull patients in batches of this size rather than one "
+                     "at a time. Defaults to the source host's batch_size "
+                     "setting, if present.")
+    parser.add_argument("--condition-strategy",
+                choices=HARVEST_STRATEGIES,
+                default="subject",
+                help="How Conditions are pulled for each group: one search "
+                     "per patient, multi-subject searches or a single tag "
+                     "scoped search filtered against the group's members")
+    parser.add_argument("--phenotype-strategy",
+                choices=SCAN_STRATEGIES,
+                default=None,
+                help="Also summarize each group's phenotype Observations, "
+                     "pulling them with one search per patient, a single "
+                     "tag scoped scan filtered against the group's members "
+                     "or whichever of those needs fewer requests (auto). "
+                     "--fused always includes the phenotypes")
+    parser.add_argument("--fused",
+                action='store_true',
+                help="Summarize demographics, conditions and phenotypes in a "
+                     "single pass over each group's patients using _revinclude")
+    parser.add_argument("--bundle-size",
+                type=int,
+                default=DEFAULT_BUNDLE_SIZE,
+                help="Number of summary Observations written per batch bundle")
+    parser.add_argument("--ledger",
+                type=str,
+                default=None,
+                help="SQLite file recording what has already been written to "
+                     "each host. Resources identical to what the host "
+                     "already has are not written again")
+    parser.add_argument("--ledger-reset",
+                action='store_true',
+                help="Forget everything the ledger has recorded for the "
+                     "destination host before writing anything. Use this when "
+                     "the destination was changed or wiped outside of these "
+                     "scripts")
+    parser.add_argument("--workers",
+                type=int,
+                default=1,
+                help="Number of processes used to summarize a study's groups "
+                     "concurrently")
 
     args = parser.parse_args()
+    ledger = InitUploadLedger(args.ledger)
     fhir_host = FhirClient(config[args.source_env])
+    if args.batch_size is None:
+        args.batch_size = host_setting(config[args.source_env], 'batch_size', None)
     dest_host = fhir_host
 
     if args.dest_env:
         dest_host = FhirClient(config[args.dest_env])
 
+    if ledger is not None and args.ledger_reset:
+        print(f"Upload ledger: forgot {ledger.reset(dest_host)} resources")
+
     # If we didn't get one or more groups, identify available groups and let the user choose one
     if len(args.study) == 0:
         studies = pull_studies(fhir_host)
@@ -90,6 +172,15 @@ if __name__ == '__main__':
             
             args.study.append(studies[index-1].reference)
         
+    pool = None
+    if args.workers > 1:
+        dest_cfg = None
+        if args.dest_env:
+            dest_cfg = config[args.dest_env]
+        pool = ProcessPoolExecutor(max_workers=args.workers, 
+                                   initializer=init_worker, 
+                                   initargs=(config[args.source_env], dest_cfg, args.ledger))
+
     for name in args.study:
         print(f"Working on the group, {name}")
         study = ResearchStudy(fhir_host, identifier=name)
@@ -101,11 +192,32 @@ if __name__ == '__main__':
     
         # Now that we have a study, we should have 1 or more enrolled groups. For each of these,
         # we want to build out those summaries
-        for group_ref in study.g_refs:
-            group = Group(fhir_host, identifier=group_ref)
-            remote_group = summarize_group(fhir_host, dest_host, group)
-            if remote_group is not None:
-                group_refs.append(remote_group.reference)
+        summary_options = {
+            "batch_size": args.batch_size,
+            "condition_strategy": args.condition_strategy,
+            "phenotype_strategy": args.phenotype_strategy,
+            "fused": args.fused,
+            "bundle_size": args.bundle_size
+        }
+        if pool is not None:
+            # Groups are independent of one another, so they can be farmed out
+            # to the workers. We only need the remote references back in 
+            # order to build the enrollment
+            remote_refs = pool.map(summarize_group_ref, 
+                                   study.g_refs,
+                                   [study.identifier['system']] * len(study.g_refs),
+                                   [study.identifier['value']] * len(study.g_refs),
+                                   [summary_options] * len(study.g_refs))
+            group_refs = [ref for ref in remote_refs if ref is not None]
+        else:
+            for group_ref in study.g_refs:
+                group = Group(fhir_host, identifier=group_ref)
+                remote_group = summarize_group(fhir_host, 
+                                               dest_host, 
+                                               group, 
+                                               **summary_options)
+                if remote_group is not None:
+                    group_refs.append(remote_group.reference)
 
         if fhir_host != dest_host:
             # First, we have to decide if the group exists on the remote, destination server
@@ -133,14 +245,12 @@ if __name__ == '__main__':
                     temp['title'] = alt_titles[study.title]
                 
                 #pdb.set_trace()
-                response = dest_host.post('ResearchStudy', temp)
+                # The destination doesn't have it, whatever the ledger thinks
+                forget_upload(dest_host, temp)
+                response = ledger_post(dest_host, 'ResearchStudy', temp)
                 if response['status_code'] > 299:
                     print(pformat(response))
                 print(response['status_code'])
-                
-
-                
-
-
-
 
+    if pool is not None:
+        pool.shutdown()
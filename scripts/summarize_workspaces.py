@@ -7,6 +7,10 @@ import firecloud.api as fapi
 #from ddsummary.ggsummary import GSummary
 from ddsummary.yamlcfg import SummaryConfig
 from ddsummary.workspace import Workspace
+from ddsummary.checkpoint import Checkpoint
+from ddsummary.aggregate_store import AggregateStore
+from ddsummary.terra import iter_entities, TablePrefetcher
+from ddsummary.snapshot import SnapshotStore
 
 import re
 import sys
@@ -21,7 +25,7 @@ from argparse import ArgumentParser, FileType
 from yaml import safe_load
 import json
 
-from dbgap_study import DbGaPStudy, InvalidStudyID
+from dbgap_study import get_study, prefetch_studies, InitStudyCache, InvalidStudyID
 
 from summvar.fhir import MetaTag, InitMetaTag
 
@@ -32,6 +36,10 @@ from rich.progress import track
 
 from ddsummary.anvil_sources import get_workspaces
 from summvar.fhir.activity_definition import ActivityDefinition
+from summvar.fhir.observation_definition import sketch_threshold
+from summvar.fhir.valueset import InitVocabularyCache, DEFAULT_VOCAB_TTL
+from summvar.fhir.bundle import BundleWriter, DEFAULT_BUNDLE_SIZE
+from summvar.upload_ledger import InitUploadLedger, post as ledger_post
 from summvar import system_prefix, system_url, study_id, create_dataset_study, create_study_group
 
 from ncpi_fhir_client.ridcache import RIdCache
@@ -94,7 +102,7 @@ def clean_varname(value):
     if varname is not None:
         return _varclean_x.match(value).group('colname').lower()
 
-def prep_data(table_name, id_name, table_data):
+def prep_data(table_name, id_name, table_data, attribute_names=None):
     """The workspace header doesn't match the data-dictionary but we can help
        modify the headers to be more like what we expect. 
        
@@ -104,15 +112,64 @@ def prep_data(table_name, id_name, table_data):
     # columns that must be reported as missing or invalid. 
     header_lookup = {}
 
-    updated_data = []
-
-    #pdb.set_trace()
-    #if table_name == "aligned_dna_short_read_set":
-    #    pdb.set_trace()
-
-    for row in table_data:
-        idname = clean_varname(id_name) + "_id"
+    updated_data = list(iter_prep_data(table_name, id_name, table_data, header_lookup, attribute_names))
+    return updated_data, header_lookup
 
+# Column kinds
+VALUE_COLUMN = "value"
+REFERENCE_COLUMN = "references"
+OTHER_COLUMN = "other"
+
+def column_kind(value):
+    if type(value) is dict:
+        if value.get('itemsType') == "EntityReference":
+            return REFERENCE_COLUMN
+        return OTHER_COLUMN
+    return VALUE_COLUMN
+
+class TableTransformer:
+    """The column names are the same for every row in a table, so we clean
+       each one the first time we see it (or up front from the schema's 
+       attributeNames) rather than once per cell. 
+
+       The kind of data isn't cached, though. A list column can hold an 
+       empty AttributeValue list in one row and EntityReferences in the 
+       next, so each cell is judged by its own itemsType.
+    """
+    def __init__(self, id_name, header_lookup, attribute_names=None):
+        self.idname = clean_varname(id_name) + "_id"
+        self.header_lookup = header_lookup
+
+        # original column name => cleaned column name (None if unusable)
+        self.colnames = {}
+
+        # entityType => cleaned column name for referenced entities
+        self.entity_columns = {}
+
+        if attribute_names is not None:
+            for origcolname in attribute_names:
+                self.compile(origcolname)
+
+    def compile(self, origcolname):
+        """Columns whose names can't be cleaned are dropped from every row
+           (the original prep_data dropped the entire row instead)"""
+        colname = clean_varname(origcolname)
+        if colname is not None:
+            colname = colname + "_id"
+            self.header_lookup[colname] = origcolname
+        self.colnames[origcolname] = colname
+        return colname
+
+    def entity_column(self, entity_type):
+        colid = self.entity_columns.get(entity_type)
+        if colid is None:
+            colid = clean_varname(entity_type) + '_id'
+            self.entity_columns[entity_type] = colid
+        return colid
+
+    def transform(self, row):
+        """Returns the list of rows resulting from the workspace's row"""
+        idname = self.idname
         name = get_id_name_from_workspace(row)
 
         newrows = []
@@ -120,65 +177,136 @@ def prep_data(table_name, id_name, table_data):
             idname: name
         }
         newrows_as_list = defaultdict(list)
-        try:
-            was_complex = False
-            for origcolname, value in row['attributes'].items():
-                colname = clean_varname(origcolname) + "_id"
-
-                #if colname == "aligned_dna_short_read_set":
-                #    pdb.set_trace()
-                # check for complex data
-                if type(value) is dict:
-                    if value.get('itemsType') == "EntityReference":
-                        was_complex = True
-                        #pdb.set_trace()
-                        rows = []
-
-                        for item in value['items']:
-                            colid = clean_varname(item['entityType']) + '_id'
-                            item_obj = {
-                                idname: name,
-                                f"{colid}": item['entityName'] 
-                            }
-                            newrows_as_list[colid].append(item['entityName'])
-                            newrows.append(item_obj)
-                else:
-                    if colname is not None:
-                        if was_complex and len(newrows) > 0:
-                            if len(newrows_as_list) == 1:
-                                # For now, we'll transform the singular column
-                                # a pipe separated list. 
-                                key = list(newrows_as_list.keys())[0]
-                                value = "|".join(newrows_as_list[key])
-                                # To avoid treating the newly minted rows as
-                                # the real data, we'll clear them out. 
-                                newrows = []
-                            else:
-                                print("OK. We probably shouldn't be here")
-                                pdb.set_trace()
-                                print(f"{colname}:{value}")
-                        newrow[colname] = value
-                        header_lookup[colname] = origcolname
-
-            if len(newrows) > 0:
-                for nr in newrows:
-                    updated_data.append(nr)
-                if len(newrow) > 1:
-                    print("-----")
-                    print(row)
-                    print(f"----- {len(newrows)}")
-                    print(newrows)
-                    print(f"----- {len(newrow)}")
-                    print(newrow)
-                    print("\nWe shouldn't have both complex data and simple data....should we?")
-                    pdb.set_trace()
+        was_complex = False
+        for origcolname, value in row['attributes'].items():
+            if origcolname in self.colnames:
+                colname = self.colnames[origcolname]
             else:
-                updated_data.append(newrow)
+                colname = self.compile(origcolname)
+
+            kind = column_kind(value)
+            # check for complex data
+            if kind == REFERENCE_COLUMN:
+                was_complex = True
+
+                for item in value['items']:
+                    colid = self.entity_column(item['entityType'])
+                    item_obj = {
+                        idname: name,
+                        f"{colid}": item['entityName'] 
+                    }
+                    newrows_as_list[colid].append(item['entityName'])
+                    newrows.append(item_obj)
+            elif kind == VALUE_COLUMN:
+                if colname is not None:
+                    if was_complex and len(newrows) > 0:
+                        if len(newrows_as_list) == 1:
+                            # For now, we'll transform the singular column
+                            # a pipe separated list. 
+                            key = list(newrows_as_list.keys())[0]
+                            value = "|".join(newrows_as_list[key])
+                            # To avoid treating the newly minted rows as
+                            # the real data, we'll clear them out. 
+                            newrows = []
+                        else:
+                            # The row gets reported and skipped
+                            raise ValueError(f"Unable to fold {len(newrows_as_list)} reference columns into {colname}:{value}")
+                    newrow[colname] = value
+
+        if len(newrows) > 0:
+            if len(newrow) > 1:
+                # The row gets reported and skipped
+                raise ValueError(f"Row has both references ({len(newrows)} rows) and values ({newrow})")
+            return newrows
+        return [newrow]
+
+def iter_prep_data(table_name, id_name, table_data, header_lookup, attribute_names=None):
+    """Generator version of prep_data. Rows are yielded as they are rewritten
+       so table_data can itself be a generator (see ddsummary.terra) and we 
+       never hold the full table. header_lookup is filled in as each column
+       is first encountered.
+    """
+    transformer = TableTransformer(id_name, header_lookup, attribute_names)
+
+    for row in table_data:
+        try:
+            newrows = transformer.transform(row)
         except Exception as e:
             print(f"A Problem was encountered with ATTRIBUTES: {row}")
             print(e)
+            continue
+
+        for newrow in newrows:
+            yield newrow
+
+def pull_workspace_tables(wsnamespace, wsname, page_size=None, snapshot=None):
+    """Returns the prepped table data and header lookups for each of the 
+    workspace's tables. If page_size is provided, each table is a generator
+    which pages through the table as it is consumed. If snapshot is 
+    provided, the tables come from the snapshot rather than firecloud."""
+    if snapshot is not None:
+        schema = snapshot.list_entity_types(wsnamespace, wsname)
+    else:
+        schema = fapi.list_entity_types(namespace=wsnamespace, workspace=wsname).json()
+    #pdb.set_trace()
 
-    return updated_data, header_lookup
+    # Schema gives us all of the tables, now we will pull the data for 
+    # each of those tables and pass that along with the data-dictionary
+    # reference to perform the summary
+    table_data = {}
+    header_lookup = {}
+    for table_name in schema:
+        # We have to fix those column names here, before we capture 
+        # them in order to avoid putting workspace specific behavior
+        # inside the more generic activity / observation classes. 
+        # 
+        # each "row" has an "attributes" property that points to the
+        # individual row of data. Those rows are prefixed by numbers
+        # probably some sort of sorting thing as well as a number 
+        # at the end. The variable's name is like this 
+        # [d]+-(varname)-[d]+
+        # varname is currently mixed case. A quick scan suggests that
+        # they don't include a mix of Snake Case and Humpback case, 
+        # fortunately. 
+
+       
+
+        if type(schema[table_name]) is dict:
+            id_name = get_id_name_from_workspace(schema[table_name])
+            attribute_names = schema[table_name].get('attributeNames')
+
+            if snapshot is not None:
+                header_lookup[table_name] = {}
+                table_data[table_name] = iter_prep_data(table_name,
+                                        id_name,
+                                        snapshot.iter_entities(wsnamespace, 
+                                            wsname, 
+                                            table_name),
+                                        header_lookup[table_name],
+                                        attribute_names)
+            elif page_size is not None:
+                # Nothing is pulled until the summarizer asks for 
+                # the rows
+                header_lookup[table_name] = {}
+                table_data[table_name] = iter_prep_data(table_name,
+                                        id_name,
+                                        iter_entities(wsnamespace,
+                                            wsname,
+                                            table_name,
+                                            page_size=page_size),
+                                        header_lookup[table_name],
+                                        attribute_names)
+            else:
+                table_data[table_name], header_lookup[table_name] = prep_data(table_name, 
+                                        id_name,
+                                        fapi.get_entities(wsnamespace, 
+                                            wsname,
+                                            table_name).json(),
+                                        attribute_names)
+        else:
+            print(f"Invalid schema format: {schema[table_name]} is {type(schema[table_name])}, not dict. ")
+
+    return table_data, header_lookup
 
 _invalid_phs_ids = set(["Registration Pending", 
                         "TBD",
@@ -228,9 +356,98 @@ def exec(argv=None):
                 help="Log correlations between each workspace and the data-"
                      "dictionary including missing tables, unexpected table "
                      "names and variables. ")
+    parser.add_argument("--sketch-threshold",
+                type=int,
+                default=None,
+                help="Number of distinct values a string variable may have "
+                     "before its distinct count and most frequent values "
+                     "are estimated with sketches (default 10000)")
+    parser.add_argument("--vocab-cache",
+                type=str,
+                default=None,
+                help="File used to keep ValueSet expansions between runs")
+    parser.add_argument("--vocab-ttl",
+                type=int,
+                default=DEFAULT_VOCAB_TTL,
+                help="Number of seconds a cached ValueSet expansion remains "
+                     f"valid (default {DEFAULT_VOCAB_TTL})")
+    parser.add_argument("--checkpoint",
+                type=str,
+                default=None,
+                help="File used to checkpoint progress. Progress is only "
+                     "checkpointed when this or --resume is provided. With "
+                     "just --resume, the checkpoint lives inside log/ based "
+                     "on the project name. The file is removed once a run "
+                     "finishes cleanly")
+    parser.add_argument("--checkpoint-every",
+                type=int,
+                default=10,
+                help="Number of workspaces completed between checkpoints")
+    parser.add_argument("--resume",
+                action='store_true',
+                help="Pick up from the last checkpoint, skipping workspaces "
+                     "that were already summarized")
+    parser.add_argument("--ledger",
+                type=str,
+                default=None,
+                help="SQLite file recording what has already been written to "
+                     "each host. Resources identical to what the host "
+                     "already has are not written again")
+    parser.add_argument("--ledger-reset",
+                action='store_true',
+                help="Forget everything the ledger has recorded for the "
+                     "destination host before writing anything. Use this when "
+                     "the destination was changed or wiped outside of these "
+                     "scripts")
+    parser.add_argument("--bundle-size",
+                type=int,
+                default=DEFAULT_BUNDLE_SIZE,
+                help="Number of summary Observations written per batch bundle")
+    parser.add_argument("--page-size",
+                type=int,
+                default=None,
+                help="Stream each workspace table from Terra this many rows "
+                     "at a time rather than pulling the whole table at once")
+    parser.add_argument("--prefetch",
+                type=int,
+                default=4,
+                help="Number of threads downloading upcoming workspaces' tables "
+                     "while the current workspace is summarized. 0 disables "
+                     "prefetching, as does --page-size")
+    parser.add_argument("--from-snapshot",
+                type=str,
+                default=None,
+                metavar="DIR",
+                help="Read the workspaces and their tables from a snapshot "
+                     "(see pull_workspace_data.py --snapshot) rather than "
+                     "firecloud")
+    parser.add_argument("--dbgap-cache",
+                type=str,
+                default="log/dbgap-studies.json",
+                help="File used to keep the study details pulled from dbGaP "
+                     "between runs")
+    parser.add_argument("--dbgap-workers",
+                type=int,
+                default=8,
+                help="Number of threads used to pull study details from dbGaP "
+                     "before the workspaces are summarized")
+    parser.add_argument("--incremental",
+                type=str,
+                default=None,
+                metavar="DIR",
+                help="Directory where each workspace's aggregates are kept. "
+                     "Workspaces whose lastModified hasn't changed since "
+                     "their aggregates were stored are not downloaded again")
 
     args = parser.parse_args()
 
+    InitVocabularyCache(filename=args.vocab_cache, ttl=args.vocab_ttl)
+    InitStudyCache(args.dbgap_cache)
+    ledger = InitUploadLedger(args.ledger)
+
+    if args.sketch_threshold is not None:
+        sketch_threshold(args.sketch_threshold)
+
     # We'll send this to the client to 
     if args.resource_log is None:
         if len(args.project) == 1:
@@ -248,6 +465,13 @@ def exec(argv=None):
 
         args.report = f"log/consensus-report-{args.project[0].name.lower()}.json"
 
+    if args.checkpoint is None and args.resume:
+        if len(args.project) > 1:
+            print("You must provide --checkpoint argument when summarizing "
+                  "more than one configuration.")
+            sys.exit(1)
+
+        args.checkpoint = f"log/checkpoint-{args.project[0].name.lower().replace(' ', '_')}-{args.host}.pkl"
 
     logpath = Path(args.resource_log)
     logpath.parent.mkdir(parents=True, exist_ok=True)
@@ -255,6 +479,8 @@ def exec(argv=None):
     #pdb.set_trace()
     cache_remote_ids = RIdCache()
     fhir_host = FhirClient(config[args.host], idcache=cache_remote_ids, cmdlog=args.resource_log)
+    if ledger is not None and args.ledger_reset:
+        print(f"Upload ledger: forgot {ledger.reset(fhir_host)} resources")
     print(f"Connected to the host, {args.host}.")
 
     #pdb.set_trace()
@@ -275,7 +501,12 @@ def exec(argv=None):
     # Assuming names and workspace names are the same we should be able to use
     # this data for things like consortium and phsID
     base_workspaces = get_workspaces()
-    workspaces = fapi.list_workspaces().json()
+    snapshot = None
+    if args.from_snapshot is not None:
+        snapshot = SnapshotStore(args.from_snapshot)
+        workspaces = snapshot.list_workspaces()
+    else:
+        workspaces = fapi.list_workspaces().json()
     print(f"{len(workspaces)} workspaces found.")
 
     table = Table(title=f"Parsing Workspace data:")
@@ -289,6 +520,77 @@ def exec(argv=None):
     study_summaries = {}
     study_problems = {}
 
+    # Summaries the destination wouldn't accept
+    upload_failures = 0
+
+    # Without a file, the checkpoint still tracks the completed workspaces 
+    # but never writes anything
+    checkpoint = Checkpoint(args.checkpoint, every=args.checkpoint_every)
+    if args.resume:
+        if checkpoint.load():
+            checkpoint.restore(data_dictionaries, study_summaries, study_problems)
+
+            # Workspaces are complete once their data is merged, but some of
+            # their summaries may not have made it to the destination
+            for workspace_key, resources in list(checkpoint.failed_uploads.items()):
+                print(f"Retrying {len(resources)} summaries for {workspace_key}")
+                writer = BundleWriter(fhir_host, batch_size=args.bundle_size)
+                for resource in resources:
+                    writer.add(resource)
+                writer.flush()
+
+                wsname = workspace_key.split("/", 1)[1]
+                study_problems.get(wsname, {}).pop('failed_uploads', None)
+                if len(writer.failures) > 0:
+                    writer.report_failures()
+                    study_problems.setdefault(wsname, {})['failed_uploads'] = writer.failure_details()
+                    upload_failures += len(writer.failures)
+                checkpoint.uploads_retried(workspace_key, 
+                                           [result.resource for result in writer.failures])
+        else:
+            print(f"No checkpoint found at {args.checkpoint}. Starting from the beginning.")
+
+    aggregates = None
+    if args.incremental is not None:
+        aggregates = AggregateStore(args.incremental, 
+                                    config={"sketch_threshold": sketch_threshold()})
+
+    prefetcher = None
+    # Snapshots are local, so there is nothing to gain by prefetching
+    if args.prefetch > 0 and args.page_size is None and snapshot is None:
+        # Work out ahead of time which workspaces will actually need their
+        # tables, in the order we'll get to them
+        upcoming = []
+        for wkspc in workspaces:
+            ws = wkspc['workspace']
+            if gsumm.find_consortium(ws['name']) is None:
+                continue
+            if checkpoint.is_complete(ws['namespace'], ws['name']):
+                continue
+            if aggregates is not None and \
+                    aggregates.is_current(ws['namespace'], 
+                                          ws['name'], 
+                                          ws.get('lastModified'), 
+                                          data_dictionaries[gsumm.find_consortium(ws['name']).name]):
+                continue
+            upcoming.append((ws['namespace'], ws['name']))
+        prefetcher = TablePrefetcher(pull_workspace_tables, upcoming, workers=args.prefetch)
+
+    # Pull the dbGaP details for every study we'll encounter up front so that
+    # we aren't waiting on dbGaP inside the loop
+    phs_ids = set()
+    for wkspc in workspaces:
+        ws = wkspc['workspace']
+        cns = gsumm.find_consortium(ws['name'])
+        if cns is not None:
+            phs_id = Workspace(cns.name, ws['namespace'], ws['name'], ws).phs_id
+            if ws['name'] in base_workspaces and base_workspaces[ws['name']].phsid is not None:
+                phs_id = base_workspaces[ws['name']].phsid
+            if filter_phs_id(phs_id) and phs_id not in study_summaries:
+                phs_ids.add(phs_id)
+    print(f"Pulling study details for {len(phs_ids)} dbGaP studies")
+    prefetch_studies(phs_ids, workers=args.dbgap_workers)
+
     for wkspc in track(workspaces, f"Parsing workspaces"):
         #for wkspc in workspaces:
         ws = wkspc['workspace']
@@ -296,6 +598,10 @@ def exec(argv=None):
         wsnamespace = ws['namespace']
         cns = gsumm.find_consortium(wsname)
 
+        if cns is not None and checkpoint.is_complete(wsnamespace, wsname):
+            print(f"Skipping {wsnamespace}/{wsname}, which was completed before the checkpoint")
+            cns = None
+
         if cns is not None:
             #pdb.set_trace()
             system_prefix(cns.system_prefix)
@@ -317,16 +623,16 @@ def exec(argv=None):
                             wkspace.phs_id not in study_summaries:
                 
                 try:
-                    dbgstudy = DbGaPStudy(wkspace.phs_id)
+                    dbgstudy = get_study(wkspace.phs_id)
 
                     study_group = dbgstudy.study_group()
                     sg_id = study_group['identifier'][0]
 
-                    result = fhir_host.post("Group", 
-                                            study_group,
-                                            identifier=sg_id['value'],
-                                            identifier_system=sg_id['system'],
-                                            skip_insert_if_present=False)
+                    result = ledger_post(fhir_host, "Group", 
+                                                    study_group,
+                                                    identifier=sg_id['value'],
+                                                    identifier_system=sg_id['system'],
+                                                    skip_insert_if_present=False)
                     if result['status_code'] >= 300:
                         print(result)
                         pdb.set_trace()
@@ -341,11 +647,11 @@ def exec(argv=None):
                         }
                     ]
                     
-                    result = fhir_host.post("ResearchStudy", 
-                                            fhir_study, 
-                                            identifier=fhir_study['identifier'][0]['value'],
-                                            identifier_system=fhir_study['identifier'][0]['system'],
-                                            skip_insert_if_present=True)
+                    result = ledger_post(fhir_host, "ResearchStudy", 
+                                                    fhir_study, 
+                                                    identifier=fhir_study['identifier'][0]['value'],
+                                                    identifier_system=fhir_study['identifier'][0]['system'],
+                                                    skip_insert_if_present=True)
                     if result['status_code'] >= 300:
                         print(result)
                         pdb.set_trace()
@@ -366,6 +672,27 @@ def exec(argv=None):
             wkspace = gsumm.add_workspace(wkspace)
             cns.add_study(wkspace)
 
+            last_modified = ws.get('lastModified')
+            if aggregates is not None:
+                record = aggregates.lookup(wsnamespace, 
+                                           wsname, 
+                                           last_modified, 
+                                           data_dictionaries[cns.name])
+                if record is not None:
+                    # Nothing has changed, so the stored aggregates are as 
+                    # good as anything we would build by pulling it again
+                    print(f"{wsnamespace}/{wsname} unchanged since {last_modified}")
+                    aggregates.reuse(record, data_dictionaries[cns.name], cns.name, wkspace.phs_id)
+                    table.add_row(wsname, wsnamespace, record['tables'])
+                    study_problems[wsname] = record['study_problems']
+                    checkpoint.workspace_complete(wsnamespace, 
+                                                  wsname, 
+                                                  data_dictionaries, 
+                                                  study_summaries, 
+                                                  study_problems)
+                    continue
+                aggregates.start_workspace(data_dictionaries[cns.name])
+
             #pdb.set_trace()
             study_group = create_study_group(
                             study=wkspace.phs_id,
@@ -373,11 +700,11 @@ def exec(argv=None):
                             member_count=wkspace.subject_count
             )
             
-            result = fhir_host.post("Group", 
-                                    study_group,
-                                    identifier=study_group['identifier'][0]['value'],
-                                    identifier_system=study_group['identifier'][0]['system'],
-                                    skip_insert_if_present=False)
+            result = ledger_post(fhir_host, "Group", 
+                                            study_group,
+                                            identifier=study_group['identifier'][0]['value'],
+                                            identifier_system=study_group['identifier'][0]['system'],
+                                            skip_insert_if_present=False)
             if result['status_code'] >= 300:
                 print(result)
                 pdb.set_trace()
@@ -397,11 +724,11 @@ def exec(argv=None):
                 }
             ]
             
-            result = fhir_host.post("ResearchStudy", 
-                                    fhir_study, 
-                                    identifier=fhir_study['identifier'][0]['value'],
-                                    identifier_system=fhir_study['identifier'][0]['system'],
-                                    skip_insert_if_present=True)
+            result = ledger_post(fhir_host, "ResearchStudy", 
+                                            fhir_study, 
+                                            identifier=fhir_study['identifier'][0]['value'],
+                                            identifier_system=fhir_study['identifier'][0]['system'],
+                                            skip_insert_if_present=True)
             if result['status_code'] >= 300:
                 print(fhir_study)
                 print("  --------------------  ")
@@ -415,41 +742,14 @@ def exec(argv=None):
             #pdb.set_trace()
             study_fhir_id = result['response']['id']
 
-            schema = fapi.list_entity_types(namespace=wsnamespace, workspace=wsname).json()
-            #pdb.set_trace()
+            if prefetcher is not None:
+                table_data, header_lookup = prefetcher.get((wsnamespace, wsname))
+            else:
+                table_data, header_lookup = pull_workspace_tables(wsnamespace, 
+                                                                  wsname, 
+                                                                  page_size=args.page_size,
+                                                                  snapshot=snapshot)
 
-            # Schema gives us all of the tables, now we will pull the data for 
-            # each of those tables and pass that along with the data-dictionary
-            # reference to perform the summary
-            table_data = {}
-            header_lookup = {}
-            for table_name in schema:
-                # We have to fix those column names here, before we capture 
-                # them in order to avoid putting workspace specific behavior
-                # inside the more generic activity / observation classes. 
-                # 
-                # each "row" has an "attributes" property that points to the
-                # individual row of data. Those rows are prefixed by numbers
-                # probably some sort of sorting thing as well as a number 
-                # at the end. The variable's name is like this 
-                # [d]+-(varname)-[d]+
-                # varname is currently mixed case. A quick scan suggests that
-                # they don't include a mix of Snake Case and Humpback case, 
-                # fortunately. 
-
-               
-
-                if type(schema[table_name]) is dict:
-                    id_name = get_id_name_from_workspace(schema[table_name])
-
-                    table_data[table_name], header_lookup[table_name] = prep_data(table_name, 
-                                                id_name,
-                                                fapi.get_entities(wsnamespace, 
-                                                    wsname,
-                                                    table_name).json())
-                else:
-                    print(f"Invalid schema format: {schema[table_name]} is {type(schema[table_name])}, not dict. ")
-                    
             table_names = ",".join(table_data.keys())
             table.add_row(wsname, wsnamespace, table_names)
             #print(f"Workspace: {wsname}\t{wsnamespace}:{table_names}")
@@ -459,6 +759,7 @@ def exec(argv=None):
                 "unrecognized_tables": unrecognized_tables
             }
             #pdb.set_trace()
+            writer = BundleWriter(fhir_host, batch_size=args.bundle_size)
             for table_name in summaries:
                 print(f"Loading {len(summaries[table_name].summaries)} for table, {table_name}. ")
                 study_problems[wsname][table_name] = {}
@@ -467,27 +768,46 @@ def exec(argv=None):
                 study_problems[wsname][table_name]['unseen_variables'] = summaries[table_name].unseen
                 study_problems[wsname][table_name]['enumerations'] = summaries[table_name].enums
                 for summary in summaries[table_name].summaries:
-                    try:
-                        
-                        result = fhir_host.post("Observation", 
-                                                summary,
-                                                identifier=summary['identifier'][0]['value'],
-                                                identifier_system=summary['identifier'][0]['system']
-                                                )
-                        if result['status_code'] >= 300:
-                            print(result)
-                            pdb.set_trace()
-                    except Exception as e:
-                        print(summary)
-                        print("----------------------------------")
-                        print(e)
-                        print("----------------------------------")
-                        pdb.set_trace()
-                        print("Well, there was an exception")
+                    writer.add(summary)
+            writer.flush()
+            if len(writer.failures) > 0:
+                # One bad summary shouldn't stop the rest of the run. They
+                # end up in the report and the run exits with an error
+                writer.report_failures()
+                study_problems[wsname]['failed_uploads'] = writer.failure_details()
+                upload_failures += len(writer.failures)
+
+            # A stored record would mark the workspace as current and the
+            # summaries that failed would never be retried by the next run
+            if aggregates is not None and len(writer.failures) == 0:
+                aggregates.save(wsnamespace, 
+                                wsname, 
+                                last_modified, 
+                                data_dictionaries[cns.name], 
+                                cns.name, 
+                                table_names, 
+                                study_problems[wsname])
+
+            checkpoint.workspace_complete(wsnamespace, 
+                                          wsname, 
+                                          data_dictionaries, 
+                                          study_summaries, 
+                                          study_problems,
+                                          failed_uploads=[result.resource for result in writer.failures])
+
+    if prefetcher is not None:
+        prefetcher.shutdown()
+
+    # Everything at the workspace level is done, so capture that before we
+    # move on to the phs level rollups
+    checkpoint.save(data_dictionaries, study_summaries, study_problems)
 
     console = Console()
     console.print(table, justify="center")
 
+    if aggregates is not None:
+        print(f"{aggregates.reused} workspaces reused their stored aggregates. {aggregates.refreshed} were summarized again.")
+
     reportpath = Path(args.report)
     reportpath.parent.mkdir(parents=True, exist_ok=True)
     reportpath.write_text(json.dumps(study_problems, sort_keys=True, indent=2))
@@ -501,19 +821,25 @@ def exec(argv=None):
         #pdb.set_trace()
         summaries, unrecognized_tables = data_dictionaries[cns].summarize(phsid, None, None, None, focus=f"ResearchStudy/{phsid}")
 
+        writer = BundleWriter(fhir_host, batch_size=args.bundle_size)
         for table_name in summaries:
             print(f"Loading {len(summaries[table_name].summaries)} for table, {phsid}:{table_name}. ")
 
             for summary in summaries[table_name].summaries:
-                
-                result = fhir_host.post("Observation", 
-                                        summary,                                        
-                                        identifier=summary['identifier'][0]['value'],
-                                        identifier_system=summary['identifier'][0]['system']
-                                        )
-                if result['status_code'] >= 300:
-                    print(result)
-                    pdb.set_trace()
+                writer.add(summary)
+        writer.flush()
+        if len(writer.failures) > 0:
+            writer.report_failures()
+            upload_failures += len(writer.failures)
+    if ledger is not None:
+        ledger.report()
+
+    if upload_failures > 0:
+        print(f"{upload_failures} summaries could not be written to {args.host}")
+        sys.exit(1)
+
+    # Nothing left to resume
+    checkpoint.discard()
     #gsumm.save_cfg()
 if __name__ == '__main__':
     exec()
@@ -177,4 +177,11 @@ class BadIdentifier(Exception):
     def __init__(self, resource_type, identifier):
         super().__init__(f"Bad Identifier: No match found for {resource_type}.identifier == {identifier}")
         self.resource_type = resource_type
-        self.identifier = identifier
\ No newline at end of file
+        self.identifier = identifier
+
+class SearchFailed(Exception):
+    def __init__(self, url, status_code, response=None):
+        super().__init__(f"Search Failed: {url} returned {status_code}")
+        self.url = url
+        self.status_code = status_code
+        self.response = response
@@ -5,9 +5,20 @@ Representation of the data-dictionary as loaded from FHIR.
 from summvar.fhir.activity_definition import ActivityDefinition
 
 import sys
+from itertools import chain
 
 import pdb 
 
+def peek(rows):
+    """Returns the first row along with an iterable which still produces
+    every row, including the first. Rows may be a list or a generator."""
+    rows = iter(rows)
+    try:
+        first = next(rows)
+    except StopIteration:
+        return None, []
+    return first, chain([first], rows)
+
 class StudyDictionary:
     def __init__(self, client, tag):
         self.client = client
@@ -46,7 +57,7 @@ class StudyDictionary:
                     table_name = alt_names[table_name]
 
                 if table_name in data:
-                    observed_tables[original_table_name] = data[table_name][0].keys()
+                    observed_tables[original_table_name] = table_name
                     summary_results[ad.table_name] = ad.summarize_rows(data[table_name], study_id, wsname, focus=focus)
 
                 else:
@@ -60,9 +71,12 @@ class StudyDictionary:
             for table_name in data:
                 if table_name not in observed_tables:
                     try:
-                        unrecognized_tables[table_name] = list(data[table_name][0].keys())
+                        first, _ = peek(data[table_name])
+                        unrecognized_tables[table_name] = []
+                        if first is not None:
+                            unrecognized_tables[table_name] = list(first.keys())
                     except Exception as e:
-                        print(data[table_name][0:5])
+                        print(f"Unable to read the header for {table_name}")
                         print(e)
                         sys.exit(1)
 
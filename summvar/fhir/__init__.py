@@ -15,3 +15,11 @@ def MetaTag():
             "system": _tag_system,
             "code": _tag_code
     }]
+
+def MetaTagParam():
+    """The current meta tag formatted for use as a _tag search parameter"""
+    if _tag_code is None:
+        return None
+    if _tag_system is None:
+        return _tag_code
+    return f"{_tag_system}|{_tag_code}"
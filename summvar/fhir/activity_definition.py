@@ -8,13 +8,26 @@ from summvar import MissingIdentifier, BadIdentifier
 from pprint import pformat
 from copy import deepcopy
 from summvar.fhir.observation_definition import ObservationDefinition
+from summvar.upload_ledger import post as ledger_post
 
 from rich.pretty import pprint
 import pdb
 
 import sys
 
-from collections import namedtuple
+from collections import namedtuple, defaultdict
+from itertools import islice
+
+# Number of rows pivoted at a time. Tables may be streamed in, so we never
+# want to hold more than this many rows at once
+DEFAULT_CHUNK_SIZE = 5000
+
+def row_chunks(tabular_data, size):
+    rows = iter(tabular_data)
+    chunk = list(islice(rows, size))
+    while len(chunk) > 0:
+        yield chunk
+        chunk = list(islice(rows, size))
 
 # Just a simple way to deal with returns from the AD summary
 # - unrecognized indicate which columns weren't matched to the header
@@ -25,6 +38,68 @@ SummaryResult = namedtuple("SummaryResult", ["summaries",
                                              "unseen",
                                              "enums"])
 
+class TablePlan:
+    """Resolve a table's header against the table's ODs once, so that the 
+    rows only need to be visited for the columns that actually matched
+    something. Wide tables (files, QC, etc) tend to have many columns that
+    aren't part of the data-dictionary at all.
+
+    The plan is built from the first row's keys. Rows aren't guaranteed to 
+    all have the same keys, so any keys showing up later on are added with
+    extend."""
+    def __init__(self, header, obs_definitions):
+        self.header = set()
+
+        # colname => ODs which consume that column
+        self.columns = defaultdict(list)
+
+        # ODs whose column hasn't been found in the table (yet)
+        self.unmatched = list(obs_definitions)
+
+        self.extend(header)
+
+    def extend(self, keys):
+        """Add keys that weren't part of the header to the plan"""
+        keys = set(keys) - self.header
+        if len(keys) == 0:
+            return
+        self.header.update(keys)
+
+        unmatched = []
+        for od in self.unmatched:
+            if od.colname in keys:
+                self.columns[od.colname].append(od)
+            else:
+                unmatched.append(od)
+        self.unmatched = unmatched
+
+    def new_keys(self, rows):
+        """Keys found in any of the rows that aren't part of the plan yet. 
+        The rows' keys are gathered with a single C level union, so there 
+        is no per-row Python work, and only the keys that turn out to be new
+        are compared against the ODs (see extend)"""
+        return set().union(*rows) - self.header
+
+    @property
+    def recognized(self):
+        return set(self.columns.keys())
+
+    @property
+    def unrecognized(self):
+        return self.header - self.recognized
+
+    @property
+    def unseen(self):
+        return set(od.colname for od in self.unmatched)
+
+    def pivot(self, tabular_data):
+        """Pull the matched columns out of the rows. Returns colname => list 
+        of values"""
+        columns = {}
+        for colname in self.columns:
+            columns[colname] = [row[colname] for row in tabular_data if colname in row]
+        return columns
+
 class ActivityDefinition:
     def __init__(self, client, resource=None, identifier=None, missing=set()):
         self.client = client
@@ -62,14 +137,20 @@ class ActivityDefinition:
         for od in self.observation_definition:
             od.reset()
 
+    def plan_table(self, header):
+        """Returns a new TablePlan for the table's header (typically the 
+        keys of the first row)"""
+        return TablePlan(header, self.get_observation_definitions())
+
     """There are a few things we need to track:
        - Which columns were successfully consumed
        - Which columns were not
        - various summary results
     """
-    def summarize_rows(self, tabular_data, study_id, study_name, focus):
-        columns_expected = set()
-        columns_observed = set()
+    def summarize_rows(self, tabular_data, study_id, study_name, focus, chunk_size=DEFAULT_CHUNK_SIZE):
+        """tabular_data can be a list or any iterable of rows (such as a 
+        generator paging through a remote table), which is consumed chunk by
+        chunk"""
         summaries = []
 
         # We may not have loaded them yet, so this will force them to have been
@@ -77,13 +158,29 @@ class ActivityDefinition:
         obs_definitions = self.get_observation_definitions()
         enum_report = {}
 
-        for row in tabular_data:
-            for od in obs_definitions:
-                colname = od.summarize_row(row)
-                columns_expected.add(colname)
-                if colname is not None:
-                    columns_observed.add(colname)
-        
+        # Make sure nothing is left over from a previous table
+        for od in obs_definitions:
+            od.begin_table()
+
+        # The plan comes from the first row. Rows aren't guaranteed to all
+        # have the same keys, though, so any keys the plan hasn't seen yet 
+        # extend it (checked once per chunk rather than once per row)
+        plan = None
+        for chunk in row_chunks(tabular_data, chunk_size):
+            if plan is None:
+                plan = self.plan_table(chunk[0].keys())
+            new_keys = plan.new_keys(chunk)
+            if len(new_keys) > 0:
+                plan.extend(new_keys)
+
+            # Pivot the matched columns once so that each data manager can 
+            # consume its entire column in one go rather than one cell at a 
+            # time
+            columns = plan.pivot(chunk)
+            for colname, ods in plan.columns.items():
+                for od in ods:
+                    od.summarize_column(columns[colname])
+
         for od in obs_definitions:
             rpt = od.report_on_enumerations()
             if len(rpt) > 0:
@@ -92,19 +189,17 @@ class ActivityDefinition:
             if summary:
                 if len(summary['component']) > 0:
                     summaries.append(summary)
-                
-        # Identify which columns didn't match
-        # Is it safe to assume each row will have the same keys? It seems
-        # reasonable, but I don't know if it's true
-        unrecognized = set()
 
-        if len(tabular_data) > 0:
-            unrecognized = set(tabular_data[0].keys()) - columns_observed
-        unseen_columns = columns_expected - columns_observed
+        recognized = set()
+        unrecognized = set()
+        unseen_columns = set()
+        if plan is not None:
+            recognized = plan.recognized
+            unrecognized = plan.unrecognized
+            unseen_columns = plan.unseen
 
-        
         return SummaryResult(summaries=summaries, 
-                             recognized=list(columns_observed),
+                             recognized=list(recognized),
                              unrecognized=list(unrecognized), 
                              unseen=list(unseen_columns),
                              enums=enum_report)
@@ -131,7 +226,7 @@ class ActivityDefinition:
     def load(self, remote_host):
         resource = self.objectify(remote_host=remote_host)
         identifier = f"{resource['identifier'][0]['system']}|{resource['identifier'][0]['value']}"
-        response = remote_host.post(resource['resourceType'], resource, identifier=identifier)
+        response = ledger_post(remote_host, resource['resourceType'], resource, identifier=identifier)
         if response['status_code'] > 299:
             pprint(resource)
             resource
@@ -1,28 +1,215 @@
 """
 Abstraction for creating FHIR bundles
+
+Posting summaries one at a time costs (at least) two requests apiece, since
+the client first searches for the identifier to decide between create and
+update. The BundleWriter instead collects resources and sends them as batch
+(or transaction) bundles where each entry is a conditional write, so the
+server does the identifier matching for us.
+
+If an upload ledger has been initialized (see summvar.upload_ledger), 
+resources the destination already has an identical copy of aren't sent at 
+all.
 """
 
-class TransactionBundle:
-    def __init__(self, bundle_id, fhir_host):
-        self.id = bundle_id
-        self.host = fhir_host
-        self.entries = []
-
-    def add_post(self, resource_object):
-        self.entries.append(resource_object)
-    
-    def objectify(self):
-        bundle = {
+from collections import namedtuple
+from urllib.parse import quote
+
+from summvar.upload_ledger import upload_ledger, canonical_hash
+
+from rich import print
+
+DEFAULT_BUNDLE_SIZE = 250
+
+# Conditional writes. put will create or update the resource matching the
+# identifier. create only creates the resource if there isn't one matching
+# the identifier already (ifNoneExist).
+WRITE_MODES = ["put", "create"]
+
+# resource - The resource that was written
+# status - Numeric status code returned for the entry
+# reference - ResourceType/id of the written resource (when successful)
+# outcome - The OperationOutcome (or other response) for failures
+EntryResult = namedtuple("EntryResult", ["resource", "status", "reference", "outcome"])
+
+def identifier_query(resource):
+    """resource's first identifier as a search parameter value"""
+    identifier = resource['identifier'][0]
+    return quote(f"{identifier['system']}|{identifier['value']}", safe=":/|")
+
+def bundle_entry(resource, mode="put"):
+    resource_type = resource['resourceType']
+    query = f"identifier={identifier_query(resource)}"
+
+    if mode == "put":
+        request = {
+            "method": "PUT",
+            "url": f"{resource_type}?{query}"
+        }
+    else:
+        request = {
+            "method": "POST",
+            "url": resource_type,
+            "ifNoneExist": query
+        }
+
+    return {
+        "resource": resource,
+        "request": request
+    }
+
+def entry_status(status):
+    """Bundle responses report status as text, such as '201 Created'"""
+    try:
+        return int(str(status).split(" ")[0])
+    except ValueError:
+        return 500
+
+def entry_reference(location):
+    """Trim the location (which may be a full url with _history) down to
+    ResourceType/id"""
+    if location is None:
+        return None
+    parts = location.split("/")
+    if "_history" in parts:
+        parts = parts[:parts.index("_history")]
+    return "/".join(parts[-2:])
+
+def post_bundle(client, bundle):
+    """The one place the bundles actually get sent to the server. Bundles
+    are posted to the service's base url. FhirClient.post appends the 
+    resource type to target_service_url, so an empty type leaves us with 
+    the base (plus a trailing slash). The response is FhirClient's usual 
+    dict with status_code and the parsed body as response"""
+    return client.post("", bundle)
+
+class BundleWriter:
+    def __init__(self, client, batch_size=DEFAULT_BUNDLE_SIZE, bundle_type="batch", mode="put"):
+        """
+        :param client: FhirClient for the destination server
+        :param batch_size: Max number of entries per bundle
+        :param bundle_type: batch or transaction. Failed entries in a
+            transaction cause the entire bundle to fail
+        :param mode: put or create (see WRITE_MODES)
+        """
+        assert mode in WRITE_MODES
+        assert bundle_type in ["batch", "transaction"]
+
+        self.client = client
+        self.batch_size = batch_size
+        self.bundle_type = bundle_type
+        self.mode = mode
+        self.pending = []
+        self.pending_hashes = []
+
+        # Every EntryResult that wasn't successful
+        self.failures = []
+        self.written = 0
+        self.skipped = 0
+        self.request_count = 0
+
+    def add(self, resource):
+        """Queue up the resource. Returns the results if this caused the
+        bundle to be sent (or the resource was skipped as unchanged), 
+        otherwise an empty list"""
+        ledger = upload_ledger()
+        content_hash = None
+        if ledger is not None:
+            content_hash = canonical_hash(resource)
+            resource_id = ledger.lookup(self.client, resource, content_hash=content_hash)
+            if resource_id is not None:
+                self.skipped += 1
+                return [EntryResult(resource, 200, f"{resource['resourceType']}/{resource_id}", None)]
+
+        self.pending.append(resource)
+        self.pending_hashes.append(content_hash)
+        if len(self.pending) >= self.batch_size:
+            return self.flush()
+        return []
+
+    def objectify(self, resources):
+        return {
             "resourceType": "Bundle",
-            "type": "transaction",
-            "entry": []
+            "type": self.bundle_type,
+            "entry": [bundle_entry(resource, self.mode) for resource in resources]
         }
 
-        for entry in self.entries:
-            bundle.entry.append({
-                "fullUrl": f"{self.host.target_service_url}/{entry.reference}",
-                "resource": entry.resource,
-                "url": f'"{entry.resource_type}"'
+    def flush(self):
+        """Send whatever is pending. Returns an EntryResult for each of the
+        resources, in the order they were added"""
+        if len(self.pending) == 0:
+            return []
+
+        resources = self.pending
+        hashes = self.pending_hashes
+        self.pending = []
+        self.pending_hashes = []
+
+        response = post_bundle(self.client, self.objectify(resources))
+        self.request_count += 1
+
+        results = []
+        entries = []
+        body = response.get('response')
+        if response['status_code'] < 300 and type(body) is dict and body.get('resourceType') == "Bundle":
+            entries = body.get('entry', [])
+
+        if len(entries) != len(resources):
+            # The bundle itself failed (or the server didn't tell us about
+            # each entry), so each resource shares the bundle's fate
+            status = response['status_code']
+            if status < 300:
+                status = 500
+            results = [EntryResult(resource, status, None, body) for resource in resources]
+        else:
+            for resource, entry in zip(resources, entries):
+                details = entry.get('response', {})
+                status = entry_status(details.get('status', 500))
+                reference = None
+                outcome = details.get('outcome')
+                if status < 300:
+                    reference = entry_reference(details.get('location'))
+                    if reference is None and 'resource' in entry:
+                        reference = f"{entry['resource']['resourceType']}/{entry['resource']['id']}"
+                results.append(EntryResult(resource, status, reference, outcome))
+
+        ledger = upload_ledger()
+        for result, content_hash in zip(results, hashes):
+            if result.status < 300:
+                self.written += 1
+                if ledger is not None and result.reference is not None:
+                    ledger.record(self.client, 
+                                  result.resource, 
+                                  result.reference.split("/")[-1], 
+                                  content_hash=content_hash, 
+                                  commit=False)
+            else:
+                self.failures.append(result)
+        if ledger is not None:
+            ledger.commit()
+        return results
+
+    def report_failures(self):
+        for result in self.failures:
+            identifier = result.resource['identifier'][0]
+            print(f"{result.status} - {identifier['system']}|{identifier['value']}")
+            print(result.outcome)
+
+    def failure_details(self):
+        """The failures in a form that can be dropped into a json report"""
+        details = []
+        for result in self.failures:
+            identifier = result.resource['identifier'][0]
+            details.append({
+                "identifier": f"{identifier['system']}|{identifier['value']}",
+                "status": result.status,
+                "outcome": result.outcome
             })
+        return details
+
+    def __enter__(self):
+        return self
 
-        return bundle
\ No newline at end of file
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
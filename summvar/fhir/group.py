@@ -4,11 +4,16 @@
 
 from pprint import pformat
 from copy import deepcopy
+from collections import defaultdict
+from array import array
 import sys
 from rich import pretty
 
 from summvar import MissingIdentifier, BadIdentifier
 from summvar.fhir import MetaTag
+from summvar.summary.subjects import SubjectSet, subject_index
+from summvar.fhir.search import subject_key
+from summvar.upload_ledger import post as ledger_post
 import pdb
 
 pretty.install()
@@ -27,34 +32,68 @@ class Group:
             if resource is None:
                 raise BadIdentifier(self.resource_type, identifier)
 
+        # The member list can be huge and we keep our own (much smaller) 
+        # copy of the membership, so there is no reason to hold onto it 
+        members = []
+        member_extras = {}
+        if 'member' in resource:
+            resource = dict(resource)
+            for position, entity in enumerate(resource.pop('member')):
+                members.append(entity['entity']['reference'])
+
+                # Members with more than a reference (period, inactive, etc)
+                # are rare enough to simply keep as they were
+                if len(entity) > 1 or len(entity['entity']) > 1:
+                    member_extras[position] = deepcopy(entity)
+
         self.resource = resource
         self.identifier = resource['identifier'][0]
-        self.p_refs = []
-
-        # We'll keep only the identifiers in a set for fast lookup
-        self.p_identifiers = None
 
         self.id = None
         if 'id' in resource:
             self.id = resource['id']
-        if 'member' in resource:
-            for entity in resource['member']:
-                self.p_refs.append(entity['entity']['reference'])
-
-    def is_member(self, patient_ref):
-        if self.p_identifiers is None:
-            self.p_identifiers = set()
+        self.p_refs = members
+        self.member_extras = member_extras
 
-            for p in self.p_refs:
-                self.p_identifiers.add(p.split("/")[-1])
+    def iter_refs(self):
+        """Yield the members' references exactly as they appeared in the 
+        source (same form and order, duplicates included). Prefer this (or 
+        is_member and count) to p_refs unless a list is really needed"""
+        for sid in self.members:
+            yield self.index.reference(sid)
 
-        pid = patient_ref = patient_ref.split("/")[-1]
+    @property
+    def p_refs(self):
+        """The members' references as a new list. Hang onto the result 
+        rather than reading this repeatedly"""
+        return list(self.iter_refs())
+
+    @p_refs.setter
+    def p_refs(self, refs):
+        # Members are interned in the same SubjectIndex used by the summary
+        # accumulators, so a patient's reference is only held once no matter
+        # how many groups and summaries it appears in. The references are 
+        # kept as is, in order, so that the Group we write matches the source
+        self.index = subject_index()
+        self.members = array('L', [self.index.intern(ref) for ref in refs])
+        self.member_extras = {}
+
+        # Membership tests use ResourceType/id so that absolute and relative
+        # references match. That is almost always the reference itself
+        self.member_set = SubjectSet(index=self.index)
+        for ref, sid in zip(refs, self.members):
+            key = subject_key(ref)
+            if key != ref:
+                sid = self.index.intern(key)
+            self.member_set.add_id(sid)
 
-        return pid in self.p_identifiers
+    def is_member(self, patient_ref):
+        sid = self.index.ids.get(subject_key(patient_ref))
+        return sid is not None and self.member_set.has_id(sid)
 
     def load(self, remote_host):
         resource = self.objectify(min=True)
-        response = remote_host.post(resource['resourceType'], resource, identifier=self.dest_identifier)
+        response = ledger_post(remote_host, resource['resourceType'], resource, identifier=self.dest_identifier)
         if response['status_code'] > 299:
             print(resource)
             resource
@@ -93,17 +132,23 @@ class Group:
         for prop in ['resourceType', 'name', 'type']:
             if prop in self.resource:
                 obj[prop] = deepcopy(self.resource[prop])
-        if 'member' in self.resource:
-            obj['quantity'] = len(self.resource['member'])
-
+        obj['quantity'] = len(self.members)
+        if len(self.members) > 0:
             if not min:
-                obj['member'] = deepcopy(self.resource['member'])
+                obj['member'] = []
+                for position, ref in enumerate(self.iter_refs()):
+                    entity = self.member_extras.get(position)
+                    if entity is None:
+                        entity = {'entity': {'reference': ref}}
+                    else:
+                        entity = deepcopy(entity)
+                    obj['member'].append(entity)
 
         return obj
 
     @property
     def count(self):
-        return len(self.p_refs)
+        return len(self.members)
 
     @property
     def name(self):
@@ -154,6 +199,39 @@ class Group:
         print(f"No responses were found for {self.resource_type}/identifier={identifier}")
         return None
     
+class GroupIndex:
+    """Map each subject to the groups (by position) it belongs to, so that
+    resources can be divided up among several groups in a single pass"""
+    def __init__(self, groups):
+        self.groups = list(groups)
+
+        # Subjects are identified the same way Group.is_member does it, by
+        # the id the shared SubjectIndex holds for their ResourceType/id
+        self.index = subject_index()
+
+        # subject id => [group index, ...]
+        self.memberships = defaultdict(list)
+
+        # subject id => id of the reference as it appeared in the group
+        self.refs = {}
+        for position, group in enumerate(self.groups):
+            assert group.index is self.index
+            for sid in group.member_set.ids():
+                self.memberships[sid].append(position)
+            for sid in group.members:
+                self.refs[self.index.ids[subject_key(self.index.reference(sid))]] = sid
+
+    def groups_for(self, subject_ref):
+        sid = self.index.ids.get(subject_key(subject_ref))
+        if sid is None:
+            return []
+        return self.memberships.get(sid, [])
+
+    @property
+    def subject_refs(self):
+        """Every subject belonging to at least one of the groups"""
+        return [self.index.reference(sid) for sid in self.refs.values()]
+
 def pull_groups(client, identifier = None, keep_empty_groups=False):
     """Build local representations for FHIR Group resources
 
@@ -4,16 +4,51 @@ Abstraction for FHIR resource, ObservationDefinition
 from summvar import MissingIdentifier, BadIdentifier
 from rich.pretty import pprint
 from copy import deepcopy
-from collections import defaultdict
+from types import MappingProxyType
+from collections import defaultdict, Counter, namedtuple
 from summvar.fhir.codeableconcept import CodeableConcept
 from summvar.summary.constants import common_terms
 from summvar.summary.variable_summary import VariableSummary
+from summvar.fhir.valueset import vocabulary_cache
+from summvar.summary.sketch import KLLSketch, HyperLogLog, SpaceSaving
+from summvar.fhir.search import PagedSearch, chunks, subject_key, DEFAULT_BATCH_SIZE, DEFAULT_PAGE_SIZE
+from summvar.fhir import MetaTagParam
+from summvar.upload_ledger import post as ledger_post
 from summvar import fix_fieldname
 import sys
 import pdb
 
+import numpy as np
 from rich import print
 
+# Once a DefaultSummary has seen more distinct values than this, it stops 
+# counting each value individually and switches over to sketches
+_sketch_threshold = 10000
+
+def sketch_threshold(threshold=None):
+    global _sketch_threshold
+
+    if threshold is not None:
+        _sketch_threshold = threshold
+    return _sketch_threshold
+
+# How pull_observations finds an OD's Observations:
+#   server  - Every Observation on the server with the OD's code
+#   tag     - Only those carrying the current study's meta tag
+#   subject - Searches for the population's members, batch_size at a time
+#   group   - Only those whose subject is a member of the population's Group
+PULL_SCOPES = ["server", "tag", "subject", "group"]
+
+# The data managers only need the subject, code and value
+observation_elements = "subject,code,value"
+
+# What summarize_by_dd needs to know about an OD's summary for one group
+PopulationSummary = namedtuple("PopulationSummary", ["population", 
+                                                     "type_name", 
+                                                     "nonmissing_count", 
+                                                     "missing_count", 
+                                                     "summary"])
+
 class QuantityVariable:
     def __init__(self, unit=None, 
                     unit_code=None, 
@@ -27,6 +62,10 @@ class QuantityVariable:
         self.nan = 0
         self.missing_encoding = missing_enc
 
+        # Lets us report median and quartiles without holding on to every
+        # value we've seen
+        self.sketch = KLLSketch()
+
         self.unit = unit 
         self.unit_code = unit_code
         self.unit_system = unit_system
@@ -38,10 +77,12 @@ class QuantityVariable:
         self.max = None
         self.missing = 0
         self.nan = 0
+        self.sketch.reset()
 
     def merge(self, other):
         self.sum += other.sum
         self.count += other.count
+        self.sketch.merge(other.sketch)
         if self.min is None:
             self.min = other.min
         else:
@@ -83,22 +124,56 @@ class QuantityVariable:
 
         self.count += 1
         self.sum += quantity
+        self.sketch.update(quantity)
+
+    def add_quantities(self, quantities):
+        """Add a numpy array of (non-nan) quantities all at once"""
+        if len(quantities) > 0:
+            low = float(quantities.min())
+            high = float(quantities.max())
+            if self.min is None or low < self.min:
+                self.min = low
+            if self.max is None or high > self.max:
+                self.max = high
+
+            self.count += len(quantities)
+            self.sum += float(quantities.sum())
+            self.sketch.update_many(quantities.tolist())
+
+    def as_quantity(self, value):
+        rval = {
+            'value': value
+        }
+        if self.unit is not None:
+            rval['unit'] = self.unit
+        
+        if self.unit_code is not None:
+            rval['code'] = self.unit_code
+        
+        if self.unit_system is not None:
+            rval['system'] = self.unit_system
+        return rval
+
+    def median(self):
+        median = self.sketch.quantile(0.5)
+        if median is not None:
+            return self.as_quantity(median)
+        return None
+
+    def add_quartiles(self, resource):
+        q1 = self.sketch.quantile(0.25)
+        q3 = self.sketch.quantile(0.75)
+        if q1 is not None and q3 is not None:
+            resource['valueRange'] = {
+                'low': self.as_quantity(q1),
+                'high': self.as_quantity(q3)
+            }
 
     def mean(self):
         try:
             mean =  self.sum / self.count
             if mean == mean:
-                rval = {
-                    'value': mean
-                }
-                if self.unit is not None:
-                    rval['unit'] = self.unit
-                
-                if self.unit_code is not None:
-                    rval['code'] = self.unit_code
-                
-                if self.unit_system is not None:
-                    rval['system'] = self.unit_system
+                rval = self.as_quantity(mean)
             else:
                 rval = None
         except:
@@ -136,16 +211,55 @@ class DefaultSummary:
         self.type_name = "String"
         self.missing_encoding = missing_encoding
 
+        # Free text and identifier-like columns can have as many distinct 
+        # values as there are rows. For those, we fall back on sketches once
+        # we've seen too many distinct values
+        self.distinct = None
+        self.top_values = None
 
     def reset(self):
         self.observed_data = defaultdict(int)
         self.missing = 0
         self.total_nonmissing = 0
+        self.distinct = None
+        self.top_values = None
 
+    @property
+    def sketched(self):
+        return self.distinct is not None
+
+    def start_sketching(self):
+        self.distinct = HyperLogLog()
+        self.top_values = SpaceSaving()
+        for k,v in self.observed_data.items():
+            self.distinct.add(k)
+            self.top_values.add(k, v)
+        self.observed_data = defaultdict(int)
+
+    def observe(self, value, count=1):
+        if self.sketched:
+            self.distinct.add(value)
+            self.top_values.add(value, count)
+        else:
+            self.observed_data[value] += count
+            if len(self.observed_data) > _sketch_threshold:
+                self.start_sketching()
 
     def merge(self, other):
-        for k,v in other.observed_data.items():
-            self.observed_data[k] += v
+        if self.sketched or other.sketched:
+            if not self.sketched:
+                self.start_sketching()
+            if other.sketched:
+                self.distinct.merge(other.distinct)
+                self.top_values.merge(other.top_values)
+            else:
+                for k,v in other.observed_data.items():
+                    self.observe(k, v)
+        else:
+            for k,v in other.observed_data.items():
+                self.observed_data[k] += v
+            if len(self.observed_data) > _sketch_threshold:
+                self.start_sketching()
         self.missing += other.missing
         self.total_nonmissing += other.total_nonmissing
 
@@ -157,19 +271,39 @@ class DefaultSummary:
     def nonmissing_count(self):
         return self.total_nonmissing
 
+    @property
+    def distinct_count(self):
+        if self.sketched:
+            return self.distinct.count()
+        return len(self.observed_data)
+
     def get_vocabulary(self, client):
         return None
 
     def add_value(self, value):
         if value.strip() != "" and value not in self.missing_encoding:
-            self.observed_data[value] += 1
+            self.observe(value)
             self.total_nonmissing += 1
         else:
             self.missing += 1
 
+    def add_column(self, values):
+        """Add every value from a column at once. Returns the values that
+        couldn't be accepted"""
+        rejected = []
+        for value, count in Counter(values).items():
+            if type(value) is not str:
+                rejected.append(value)
+            elif value.strip() != "" and value not in self.missing_encoding:
+                self.observe(value, count)
+                self.total_nonmissing += count
+            else:
+                self.missing += count
+        return rejected
+
     def add_resource(self, resource):
         if 'valueString' in resource:
-            self.observed_data[resource['valueString']] += 1
+            self.observe(resource['valueString'])
             self.total_nonmissing += 1
         else:
             self.missing += 1
@@ -191,7 +325,7 @@ class DefaultSummary:
                 'coding': [common_terms['DISTINCT']],
                 'text': common_terms['DISTINCT']['display']
             },
-            'valueInteger': len(self.observed_data)
+            'valueInteger': self.distinct_count
         }
         var_summary['component'].append(component)
 
@@ -208,6 +342,13 @@ class DefaultSummary:
         return obj
     
     def report_on_enumerations(self):
+        # When we've had to sketch, the most frequent values are worth 
+        # reporting since they are often placeholders for missing data
+        if self.sketched:
+            return {
+                "estimated_distinct": self.distinct.count(),
+                "top_values": dict(self.top_values.top())
+            }
         return {}
     
 
@@ -250,6 +391,20 @@ class DateTimeSummary:
         else:
             self.missing += 1
 
+    def add_column(self, values):
+        """Add every value from a column at once. Returns the values that
+        couldn't be accepted"""
+        rejected = []
+        for value, count in Counter(values).items():
+            if type(value) is not str:
+                rejected.append(value)
+            elif value.strip() != "" and value not in self.missing_encoding:
+                self.observed_data[value] += count
+                self.total_nonmissing += count
+            else:
+                self.missing += count
+        return rejected
+
     def add_resource(self, resource):
         if '_valueDateTime' in resource:
             ext = resource['_valueDateTime']
@@ -363,6 +518,43 @@ class QuantitySummary:
             #pdb.set_trace()
             self.missing += 1
 
+    def add_column(self, values):
+        """Add every value from a column at once, letting numpy do the 
+        parsing and the arithmetic. Returns the values that couldn't be 
+        accepted (invalid values are counted rather than rejected)"""
+        if self.quantity is None:
+            self.quantity=QuantityVariable(missing_enc=self.missing_encoding)
+
+        column = np.fromiter(values, dtype=object, count=len(values))
+        if len(self.missing_encoding) > 0:
+            # Object arrays are compared element-wise inside numpy, once for
+            # each of the (few) missing encodings
+            encodings = np.array(list(self.missing_encoding), dtype=object)
+            is_missing = np.isin(column, encodings)
+            self.missing += int(is_missing.sum())
+            column = column[~is_missing]
+
+        try:
+            numbers = column.astype(float)
+        except (ValueError, TypeError):
+            # Some of the values aren't numbers, so we have to go the long way
+            parsed = []
+            for value in column:
+                try:
+                    parsed.append(float(value))
+                except:
+                    self.invalid_values += 1
+            numbers = np.array(parsed, dtype=float)
+
+        # Same as with add_value, nan values are treated as missing
+        nans = np.isnan(numbers)
+        nan_count = int(nans.sum())
+        self.missing += nan_count
+        self.invalid_values += nan_count
+
+        self.quantity.add_quantities(numbers[~nans])
+        return []
+
     def add_resource(self, resource):
         self.observations_observed += 1
         try:
@@ -410,6 +602,27 @@ class QuantitySummary:
                 }
                 var_summary['component'].append(component)
 
+            median = self.quantity.median()
+            if median is not None:
+                component = {
+                    'code': {
+                        'coding': [common_terms['MEDIAN']],
+                        'text': common_terms['MEDIAN']['display']
+                    },
+                    'valueQuantity': median
+                }
+                var_summary['component'].append(component)
+
+            component = {
+                'code': {
+                    'coding': [common_terms['IQR']],
+                    'text': common_terms['IQR']['display']
+                },
+            }
+            self.quantity.add_quartiles(component)
+            if 'valueRange' in component:
+                var_summary['component'].append(component)
+
             component = {
                 'code': {
                     'coding': [common_terms['RANGE']],
@@ -448,7 +661,6 @@ class QuantitySummary:
 class CodeableConceptSummary:
     def __init__(self, client, valueset_ref, permittedDataTypes, missing_encoding):
         self.permittedDataTypes = permittedDataTypes
-        self.codings = {}
         self.observations = defaultdict(int)
         self.invalid_observations = defaultdict(int)
         self.missing = 0 
@@ -461,45 +673,24 @@ class CodeableConceptSummary:
         self.observed_enumerations = set()
         self.unexpected_enumerations = set()
 
-        response = client.get(f"{valueset_ref}/$expand", except_on_error=False)
-
-        # Google doesn't currently support the expand operation, so we have to
-        # fall back on the code system to get the values
-        if not response.success():
-            response = client.get(f"{valueset_ref}")
-            if response.success():
-                for entry in response.entries:
-
-                    for include in entry['compose']['include']:
-                        system = include['system']
-                        resp2 = client.get(f"CodeSystem?url={system}")
-                        if resp2.success():
-
-                            for coding in resp2.entries[0]['resource']['concept']:
-                                coding['system'] = system
-                                self.codings[coding['code']] = coding
-                                
-                                self.observations[coding['code']] = 0
-        else:
-            if response.success() and len(response.entries) > 0:
-                entry = response.entries[0]
-
-                if 'resource' in entry:
-                    entry = entry['resource']
-                vs = entry
-
-                for coding in vs['expansion']['contains']:
-                    self.codings[coding['code']] = coding
-                    self.observations[coding['code']] = 0
-
-        # When you expand the valueset, the url is lost...
-        response = client.get(valueset_ref)
-        if response.success() and len(response.entries) > 0:
-            entry = response.entries[0]
-            if 'resource' in entry:
-                entry = entry['resource']
-            
-            self.valueset_url = entry['url']
+        # The expansion is shared with every other data manager using this
+        # ValueSet, so it only costs us requests the first time through
+        expansion = vocabulary_cache().expand(client, valueset_ref)
+        self.codings = expansion.codings
+        for code in self.codings:
+            self.observations[code] = 0
+
+        self.valueset_url = expansion.url
+
+    def __getstate__(self):
+        # The shared codings are read only views which can't be pickled
+        state = self.__dict__.copy()
+        state['codings'] = dict(self.codings)
+        return state
+
+    def __setstate__(self, state):
+        state['codings'] = MappingProxyType(state['codings'])
+        self.__dict__.update(state)
 
     def reset(self):
         self.missing = 0 
@@ -578,6 +769,21 @@ class CodeableConceptSummary:
                     #pdb.set_trace()
                 self.missing += 1
 
+    def add_column(self, values):
+        """Add every value from a column at once. Returns the values that
+        couldn't be accepted"""
+        for value, count in Counter(values).items():
+            if value in self.missing_encoding:
+                self.missing += count
+            elif value in self.observations:
+                self.observations[value] += count
+                self.non_missing += count
+            else:
+                if value != "-":
+                    self.invalid_observations[value] += count
+                self.missing += count
+        return []
+
     def report_on_enumerations(self):
         report = {}
         all_observed = set(self.observations.keys())
@@ -646,6 +852,14 @@ class ObservationDefinition:
                 raise BadIdentifier(self.resource_type, identifier)
 
         self.data_manager = None
+
+        # The workspace level data manager most recently folded into the phs
+        # level summaries. Incremental runs keep these around so that they
+        # can be reused when the workspace hasn't changed.
+        self.last_committed = None
+
+        # Per group state for partitioned pulls
+        self.partitions = []
         self.population = None
         self.resource = resource
         self.id = resource['id']
@@ -682,15 +896,52 @@ class ObservationDefinition:
         """can track what was and wasn't summarized. """
         return recognized_colname
     
+    def begin_table(self):
+        """Called before a table's columns are passed to summarize_column"""
+        self.valid_observation_count = 0
+
+    def summarize_column(self, values):
+        """values are the values found in this OD's column for a given table 
+        (or a chunk of that table). Returns the column name if there were any
+        values so that we can track what was and wasn't summarized."""
+        if len(values) == 0:
+            return None
+
+        try:
+            rejected = self.data_manager.add_column(values)
+            self.valid_observation_count += len(values) - len(rejected)
+        except:
+            # Something in the column couldn't be handled in bulk (such as 
+            # unhashable values), so we'll fall back on going one at a time
+            rejected = []
+            for value in values:
+                try:
+                    self.data_manager.add_value(value)
+                    self.valid_observation_count += 1
+                except:
+                    rejected.append(value)
+
+        for value in rejected:
+            try:
+                self.invalid_values.add(value)
+            except:
+                self.invalid_values.add(f"Value at {self.colname} can't be added to a set")
+
+        return self.colname
+
     def report_on_enumerations(self):
         return self.data_manager.report_on_enumerations()
     
+    def merge_into_phsid(self, phsid, data_manager):
+        if phsid not in self.study_summaries:
+            self.study_summaries[phsid] = data_manager
+        else:
+            self.study_summaries[phsid].merge(data_manager)
+
     def commit_to_phsid(self, phsid):
         if phsid is not None:
-            if phsid not in self.study_summaries:
-                self.study_summaries[phsid] = self.data_manager
-            else:
-                self.study_summaries[phsid].merge(self.data_manager)
+            self.merge_into_phsid(phsid, self.data_manager)
+        self.last_committed = self.data_manager
 
         self.init_data_manager()
 
@@ -730,7 +981,7 @@ class ObservationDefinition:
     def load(self, remote_host):
         resource = self.objectify(remote_host)
         identifier = f"{resource['identifier'][0]['system']}|{resource['identifier'][0]['value']}"
-        response = remote_host.post(resource['resourceType'], resource, identifier=identifier)
+        response = ledger_post(remote_host, resource['resourceType'], resource, identifier=identifier)
         if response['status_code'] > 299:
             pprint(resource)
             resource
@@ -752,31 +1003,156 @@ class ObservationDefinition:
     def get_vocabulary(self):
         return self.data_manager.get_vocabulary(self.client)
 
-    def pull_observations(self, population):
-        # Reset the data manager in case we are rerunning on a different population
-        self.init_data_manager()
-        self.population = population
+    def observation_queries(self, scope, subject_refs=None, group_id=None, batch_size=DEFAULT_BATCH_SIZE):
+        """The searches required to find the OD's Observations using one of 
+        the scoped PULL_SCOPES"""
         coding = self.code.coding[0]
+        query = f"Observation?code={coding['system']}|{coding['code']}&_elements={observation_elements}"
+
+        if scope == "tag":
+            tag = MetaTagParam()
+            if tag is not None:
+                query = f"{query}&_tag={tag}"
+            yield query
+        elif scope == "subject":
+            for chunk in chunks(subject_refs, batch_size):
+                yield f"{query}&subject={','.join(subject_key(ref) for ref in chunk)}"
+        elif scope == "group":
+            yield f"{query}&subject:Patient._has:Group:member:_id={group_id}"
+        else:
+            raise ValueError(f"Unknown scope, {scope}. Expected one of {PULL_SCOPES}")
 
-        self.valid_observation_count = 0
-        query = f"Observation?code={coding['system']}|{coding['code']}"
-        response = self.client.get(query)
-
-        if response.success() and len(response.entries) > 0:
-            for resource in response.entries:
-                if 'resource' in resource:
-                    resource = resource['resource']
-                if 'subject' not in resource:
-                    pdb.set_trace()
-                subject = resource['subject']['reference']
-
-                # Ignore anything that isn't in the target population
-                if self.population.is_member(subject):
+    def find_observations(self, scope="server", subject_refs=None, group_id=None, batch_size=DEFAULT_BATCH_SIZE, page_size=DEFAULT_PAGE_SIZE):
+        """Yield each of the OD's Observations found using scope"""
+        if scope == "server":
+            coding = self.code.coding[0]
+            query = f"Observation?code={coding['system']}|{coding['code']}"
+            response = self.client.get(query)
 
-                    self.valid_observation_count += 1
+            if response.success() and len(response.entries) > 0:
+                for resource in response.entries:
                     if 'resource' in resource:
                         resource = resource['resource']
-                    self.data_manager.add_resource(resource)
+                    yield resource
+        else:
+            # Let the server do the narrowing and only hold a page at a time
+            search = PagedSearch(self.client, page_size=page_size)
+            for query in self.observation_queries(scope, 
+                                                  subject_refs=subject_refs, 
+                                                  group_id=group_id, 
+                                                  batch_size=batch_size):
+                for resource in search.resources(query):
+                    yield resource
+
+    def subject_reference(self, resource):
+        """Return the resource's subject reference. Observations without one
+        can't be attributed to anybody, so they are recorded as invalid and
+        None is returned so that the caller can skip them"""
+        subject = resource.get('subject', {}).get('reference')
+        if subject is None:
+            self.invalid_values.add(f"Observation/{resource.get('id')} has no subject")
+        return subject
+
+    def add_observation(self, resource):
+        """Add the resource to the data manager if its subject is a member
+        of the current population"""
+        subject = self.subject_reference(resource)
+
+        # Ignore anything that isn't in the target population
+        if subject is not None and self.population.is_member(subject):
+            self.valid_observation_count += 1
+            self.data_manager.add_resource(resource)
+
+    def pull_observations(self, population, scope="server", batch_size=DEFAULT_BATCH_SIZE, page_size=DEFAULT_PAGE_SIZE):
+        # Reset the data manager in case we are rerunning on a different population
+        self.init_data_manager()
+        self.population = population
+
+        # Only the subject scope needs the member references, which are 
+        # built as the searches are generated rather than all at once
+        subject_refs = None
+        if scope == "subject":
+            subject_refs = population.iter_refs()
+
+        self.valid_observation_count = 0
+        for resource in self.find_observations(scope, 
+                                               subject_refs=subject_refs, 
+                                               group_id=population.id, 
+                                               batch_size=batch_size, 
+                                               page_size=page_size):
+            self.add_observation(resource)
+
+    def start_partitions(self, group_index):
+        """Set up a fresh data manager for each of the index's groups"""
+        # [group, data manager, valid observation count]
+        self.partitions = []
+        for group in group_index.groups:
+            self.init_data_manager()
+            self.partitions.append([group, self.data_manager, 0])
+
+    def add_partitioned(self, resource, group_index):
+        """Add the resource to the data manager of each group its subject
+        belongs to"""
+        subject = self.subject_reference(resource)
+        if subject is None:
+            return
+        for index in group_index.groups_for(subject):
+            partition = self.partitions[index]
+            partition[1].add_resource(resource)
+            partition[2] += 1
+
+    def pull_partitioned(self, group_index, scope="server", batch_size=DEFAULT_BATCH_SIZE, page_size=DEFAULT_PAGE_SIZE):
+        """Like pull_observations, but for every group in the GroupIndex at 
+        once. Each group gets its own data manager, which are fed from a 
+        single pass over the Observations (except for the group scope, which
+        is inherently one search per group). Use build_partitioned_summaries
+        to produce the summaries."""
+        self.start_partitions(group_index)
+
+        if scope == "group":
+            for partition in self.partitions:
+                group = partition[0]
+                for resource in self.find_observations(scope, 
+                                                       group_id=group.id, 
+                                                       page_size=page_size):
+                    subject = self.subject_reference(resource)
+                    if subject is not None and group.is_member(subject):
+                        partition[1].add_resource(resource)
+                        partition[2] += 1
+        else:
+            subject_refs = None
+            if scope == "subject":
+                subject_refs = group_index.subject_refs
+
+            for resource in self.find_observations(scope, 
+                                                   subject_refs=subject_refs, 
+                                                   batch_size=batch_size, 
+                                                   page_size=page_size):
+                self.add_partitioned(resource, group_index)
+
+    def summarize_population(self, remote_host, study_id, focus):
+        """Build the summary for the current population. The counts are 
+        captured first, since building the summary resets the data manager"""
+        result = PopulationSummary(population=self.population,
+                                   type_name=self.type_name,
+                                   nonmissing_count=self.nonmissing_count,
+                                   missing_count=self.missing_count,
+                                   summary=None)
+        summary = self.build_summary(remote_host, study_id, self.population.name, focus)
+        return result._replace(summary=summary)
+
+    def build_partitioned_summaries(self, remote_host, study_id, focus):
+        """Returns a PopulationSummary for each of the partitions from the 
+        last pull_partitioned. The summary is None for any group with no 
+        matching Observations"""
+        results = []
+        for group, data_manager, count in self.partitions:
+            self.population = group
+            self.data_manager = data_manager
+            self.valid_observation_count = count
+            results.append(self.summarize_population(remote_host, study_id, focus))
+        self.partitions = []
+        return results
 
     def pull_details(self, odref):
         # ObjectDefinition doesn't currently support querying by identifier,
@@ -795,7 +1171,11 @@ class ObservationDefinition:
 
     def build_summary(self, remote_host, study_id, study_name, focus):
         variable_summary = None
-        if self.valid_observation_count > 0:
+
+        # Rolled up (phs level) summaries depend only on what has been 
+        # committed for the study, not on whatever the last table contained
+        rollup = study_name is None and study_id in self.study_summaries
+        if self.valid_observation_count > 0 or rollup:
             vs = VariableSummary(study_id, 
                                  study_name, 
                                  self.name_prefix, 
@@ -9,6 +9,7 @@ from copy import deepcopy
 from summvar.fhir.activity_definition import ActivityDefinition
 from summvar.fhir.group import Group
 from summvar.fhir import MetaTag
+from summvar.upload_ledger import post as ledger_post
 
 import pdb
 
@@ -48,7 +49,7 @@ class ResearchStudy:
 
     def load(self, remote_host):
         resource = self.objectify(remote_host=remote_host)
-        response = remote_host.post(resource['resourceType'], resource, identifier=self.dest_identifier)
+        response = ledger_post(remote_host, resource['resourceType'], resource, identifier=self.dest_identifier)
         if response['status_code'] > 299:
             print(resource)
             print(response['status_code'])
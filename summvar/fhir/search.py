@@ -0,0 +1,101 @@
+"""
+Paged FHIR searches
+
+The client's get will happily follow every next link and hand us back one
+giant list of entries. For the bulk summary strategies we'd rather walk the
+pages ourselves so that we can count what each strategy actually costs and
+avoid holding more than a page at a time.
+"""
+
+from urllib.parse import quote
+from itertools import islice
+
+from summvar import SearchFailed
+
+# Default _count for searches we page through ourselves. Individual hosts may
+# override this via the 'page_size' key in the fhir_hosts file
+DEFAULT_PAGE_SIZE = 250
+
+# Default number of ids we'll pack into a single comma separated search
+# parameter. Long URLs upset some servers, so hosts can tune this with the
+# 'batch_size' key in the fhir_hosts file
+DEFAULT_BATCH_SIZE = 100
+
+def host_setting(host_config, key, default):
+    """Pull a per-host tuning parameter from the fhir_hosts entry"""
+    if host_config is not None and host_config.get(key) is not None:
+        return int(host_config[key])
+    return default
+
+def chunks(values, size):
+    """Break values (any iterable, including generators) into lists of at 
+    most size items"""
+    values = iter(values)
+    chunk = list(islice(values, size))
+    while len(chunk) > 0:
+        yield chunk
+        chunk = list(islice(values, size))
+
+def next_link(bundle):
+    if bundle is not None and 'link' in bundle:
+        for link in bundle['link']:
+            if link.get('relation') == 'next':
+                return link['url']
+    return None
+
+class PagedSearch:
+    """Walk the pages of one or more searches while keeping track of how many
+    requests were required to do so."""
+    def __init__(self, client, page_size=DEFAULT_PAGE_SIZE):
+        self.client = client
+        self.page_size = page_size
+
+        # Every page we pull counts as a request
+        self.request_count = 0
+
+    def query_url(self, query):
+        if self.page_size is not None and "_count=" not in query:
+            sep = "&" if "?" in query else "?"
+            query = f"{query}{sep}_count={self.page_size}"
+        return query
+
+    def pages(self, query):
+        """Yield the list of entries from each page returned by query. Raises
+        SearchFailed if any of the pages can't be pulled"""
+        url = self.query_url(query)
+        while url is not None:
+            response = self.client.get(url, recurse=False, except_on_error=False)
+            self.request_count += 1
+            if not response.success():
+                # Anything built from the pages we did get would be quietly
+                # incomplete, so this can't simply end the search
+                raise SearchFailed(url, response.status_code, response.response)
+            yield response.entries
+            url = next_link(response.response)
+
+    def resources(self, query):
+        """Yield each resource found by the query, one page at a time"""
+        for page in self.pages(query):
+            for entry in page:
+                if 'resource' in entry:
+                    entry = entry['resource']
+                yield entry
+
+    def total(self, query):
+        """Ask the server how many resources match query without pulling them"""
+        sep = "&" if "?" in query else "?"
+        response = self.client.get(f"{query}{sep}_summary=count", recurse=False, except_on_error=False)
+        self.request_count += 1
+        if response.success() and response.response is not None:
+            return response.response.get('total')
+        return None
+
+def id_list(refs):
+    """Reduce references such as Patient/123 down to a comma separated list
+    of ids suitable for _id searches"""
+    return ",".join(quote(ref.split("/")[-1], safe="-.") for ref in refs)
+
+def subject_key(ref):
+    """Normalize a subject reference to ResourceType/id so that absolute and
+    relative references compare equal"""
+    return "/".join(ref.split("/")[-2:])
@@ -0,0 +1,97 @@
+"""
+Summarize every variable in a study from a single pass over its Observations
+
+Pulling each ObservationDefinition's Observations separately means one (or
+more) searches per variable, which adds up quickly for data-dictionaries with
+hundreds of variables. Instead, we can page through every Observation
+carrying the study's meta tag once and hand each one to the OD(s) whose code
+it matches, using an index of (system, code) => ODs built from the
+data-dictionary.
+
+As a bonus, anything that doesn't match a variable in the data-dictionary is
+counted so that it can be reported.
+"""
+
+from collections import defaultdict, Counter
+
+from summvar.fhir import MetaTagParam
+from summvar.fhir.search import PagedSearch, DEFAULT_PAGE_SIZE
+from summvar.fhir.observation_definition import observation_elements
+from summvar.summary.constants import common_terms
+
+from rich import print
+
+def coding_key(coding):
+    return (coding.get('system'), coding.get('code'))
+
+_summary_key = coding_key(common_terms['SUMMARY_REPORT'])
+def is_summary(resource):
+    for coding in resource.get('code', {}).get('coding', []):
+        if coding_key(coding) == _summary_key:
+            return True
+    return False
+
+class StudyScan:
+    def __init__(self, client, activity_definitions, group_index, page_size=DEFAULT_PAGE_SIZE):
+        self.client = client
+        self.group_index = group_index
+        self.page_size = page_size
+
+        # (system, code) => [od, ...]
+        self.index = defaultdict(list)
+        self.observation_definitions = []
+        for ad in activity_definitions:
+            for od in ad.get_observation_definitions():
+                self.observation_definitions.append(od)
+                for coding in od.code.coding:
+                    self.index[coding_key(coding)].append(od)
+
+        # (system, code) => number of Observations matching no OD
+        self.unmatched = Counter()
+        self.matched = 0
+        self.request_count = 0
+
+    def route(self, resource):
+        """Returns the ODs the resource belongs to (each at most once)"""
+        ods = {}
+        for coding in resource.get('code', {}).get('coding', []):
+            for od in self.index.get(coding_key(coding), []):
+                ods[id(od)] = od
+        return list(ods.values())
+
+    def scan(self, tag=None):
+        """Stream every Observation with the tag (the current study's meta
+        tag by default) into the partitions of the matching ODs. Afterward,
+        each OD's build_partitioned_summaries can be used to build the
+        summaries for each group."""
+        if tag is None:
+            tag = MetaTagParam()
+
+        for od in self.observation_definitions:
+            od.start_partitions(self.group_index)
+
+        search = PagedSearch(self.client, page_size=self.page_size)
+        query = f"Observation?_tag={tag}&_elements={observation_elements}"
+        for resource in search.resources(query):
+            # When the summaries are written back to the same server, they 
+            # carry the study's tag as well
+            if is_summary(resource):
+                continue
+
+            ods = self.route(resource)
+            if len(ods) == 0:
+                codings = resource.get('code', {}).get('coding') or [{}]
+                self.unmatched[coding_key(codings[0])] += 1
+            else:
+                self.matched += 1
+                for od in ods:
+                    od.add_partitioned(resource, self.group_index)
+
+        self.request_count = search.request_count
+        print(f"Study scan matched {self.matched} Observations in {self.request_count} requests")
+
+    def report_unmatched(self, limit=25):
+        if len(self.unmatched) > 0:
+            print(f"{sum(self.unmatched.values())} Observations didn't match any variable in the data-dictionary")
+            for (system, code), count in self.unmatched.most_common(limit):
+                print(f"\t{system}|{code}: {count}")
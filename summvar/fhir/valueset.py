@@ -0,0 +1,254 @@
+"""
+Process wide cache of ValueSet expansions
+
+Every time a CodeableConceptSummary is initialized (which happens each time
+an OD's data manager is reset) we need the codes from its ValueSet. Expanding
+a ValueSet takes several requests, so the results are kept here, keyed by
+the host and ValueSet reference, and shared by every data manager that
+points to the same ValueSet.
+
+The expansions are optionally written to disk so that subsequent runs don't
+have to pull them again until they are older than the cache's TTL. Failed
+(or empty) expansions are never kept, so a hiccup on the terminology server
+doesn't hide a ValueSet's codes from later runs.
+
+This is also where vocabularies get copied from one server to another (see
+replicate_vocabulary). CodeSystems and ValueSets are each uploaded 
+concurrently and, rather than sleeping for a fixed amount of time to give
+the new CodeSystems a chance to be indexed, we poll the destination until it
+can actually find them.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from pathlib import Path
+from urllib.parse import quote
+import json
+import time
+
+from summvar.upload_ledger import post as ledger_post
+
+from rich import print
+
+DEFAULT_VOCAB_WORKERS = 4
+
+# Number of seconds a cached expansion is good for (one week)
+DEFAULT_VOCAB_TTL = 7 * 24 * 60 * 60
+
+# Number of seconds we'll wait on the destination to index new CodeSystems 
+# before giving up on them
+DEFAULT_READY_TIMEOUT = 300
+
+# url - The ValueSet's canonical url (lost when the ValueSet is expanded)
+# codings - read only mapping of code => coding. The codings themselves are
+#           shared, so please don't modify them.
+ValueSetExpansion = namedtuple("ValueSetExpansion", ["url", "codings"])
+
+def cache_key(client, valueset_ref):
+    host = getattr(client, 'target_service_url', None)
+    return f"{host}|{valueset_ref}"
+
+def expand_valueset(client, valueset_ref):
+    """Pull the codes associated with a ValueSet from the server"""
+    codings = {}
+    url = None
+
+    valueset = None
+    response = client.get(valueset_ref)
+    if response.success() and len(response.entries) > 0:
+        valueset = response.entries[0]
+        if 'resource' in valueset:
+            valueset = valueset['resource']
+        url = valueset.get('url')
+
+    response = client.get(f"{valueset_ref}/$expand", except_on_error=False)
+
+    # Google doesn't currently support the expand operation, so we have to
+    # fall back on the code system to get the values
+    if not response.success():
+        if valueset is not None:
+            for include in valueset['compose']['include']:
+                system = include['system']
+                resp2 = client.get(f"CodeSystem?url={system}")
+                if resp2.success():
+                    for coding in resp2.entries[0]['resource']['concept']:
+                        coding['system'] = system
+                        codings[coding['code']] = coding
+    elif len(response.entries) > 0:
+        entry = response.entries[0]
+
+        if 'resource' in entry:
+            entry = entry['resource']
+
+        for coding in entry['expansion']['contains']:
+            codings[coding['code']] = coding
+
+    return ValueSetExpansion(url=url, codings=MappingProxyType(codings))
+
+def is_usable(expansion):
+    """Only expansions that actually found the ValueSet and its codes are 
+    worth keeping around"""
+    return expansion.url is not None and len(expansion.codings) > 0
+
+class VocabularyCache:
+    def __init__(self, filename=None, ttl=None):
+        """
+        :param filename: JSON file used to persist expansions between runs
+        :type filename: string
+
+        :param ttl: Number of seconds before an expansion must be pulled again
+        :type ttl: int
+        """
+        self.filename = None
+        if filename is not None:
+            self.filename = Path(filename)
+        self.ttl = ttl
+
+        # key => (time fetched, ValueSetExpansion)
+        self.expansions = {}
+        self.load()
+
+    def is_fresh(self, fetched):
+        return self.ttl is None or (time.time() - fetched) < self.ttl
+
+    def expand(self, client, valueset_ref):
+        key = cache_key(client, valueset_ref)
+        if key in self.expansions:
+            fetched, expansion = self.expansions[key]
+            if self.is_fresh(fetched):
+                return expansion
+
+        expansion = expand_valueset(client, valueset_ref)
+        if is_usable(expansion):
+            self.expansions[key] = (time.time(), expansion)
+            self.save()
+        else:
+            print(f"[yellow]Unable to expand {valueset_ref}. It won't be cached")
+        return expansion
+
+    def load(self):
+        if self.filename is not None and self.filename.exists():
+            content = json.loads(self.filename.read_text())
+            for key, details in content.items():
+                if self.is_fresh(details['fetched']):
+                    expansion = ValueSetExpansion(url=details['url'],
+                                                  codings=MappingProxyType(details['codings']))
+                    # Older caches may still hold failed expansions
+                    if is_usable(expansion):
+                        self.expansions[key] = (details['fetched'], expansion)
+
+    def save(self):
+        if self.filename is not None:
+            content = {}
+            for key, (fetched, expansion) in self.expansions.items():
+                content[key] = {
+                    "fetched": fetched,
+                    "url": expansion.url,
+                    "codings": dict(expansion.codings)
+                }
+            self.filename.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.filename.with_suffix(self.filename.suffix + ".tmp")
+            tmp.write_text(json.dumps(content))
+            tmp.replace(self.filename)
+
+    def clear(self):
+        self.expansions = {}
+
+_vocabulary_cache = VocabularyCache()
+
+def InitVocabularyCache(filename=None, ttl=DEFAULT_VOCAB_TTL):
+    global _vocabulary_cache
+
+    _vocabulary_cache = VocabularyCache(filename=filename, ttl=ttl)
+    return _vocabulary_cache
+
+def vocabulary_cache():
+    return _vocabulary_cache
+
+class VocabularyLoadError(Exception):
+    def __init__(self, resource, response):
+        self.resource = resource
+        self.response = response
+
+    def __str__(self):
+        return f"Unable to load the {self.resource['resourceType']}, {self.resource.get('url')} ({self.response['status_code']})"
+
+def load_vocabulary(client, resource, retry_count=5, retry_delay=2):
+    """Write a single CodeSystem or ValueSet, retrying a few times before
+    giving up"""
+    identifier = f"{resource['identifier'][0]['system']}|{resource['identifier'][0]['value']}"
+
+    while True:
+        response = ledger_post(client, resource['resourceType'], resource, identifier=identifier)
+        retry_count -= 1
+        if response['status_code'] < 300 or retry_count < 1:
+            break
+        time.sleep(retry_delay)
+
+    if response['status_code'] > 299:
+        raise VocabularyLoadError(resource, response)
+    return response
+
+def is_indexed(client, resource_type, url):
+    """True once a search by url finds the resource on the server"""
+    response = client.get(f"{resource_type}?url={quote(url, safe=':/')}&_elements=url", 
+                          except_on_error=False)
+    return response.success() and len(response.entries) > 0
+
+def wait_until_indexed(client, resources, timeout=DEFAULT_READY_TIMEOUT, interval=2, max_interval=15):
+    """Poll the server until each of the resources can be found by its url.
+    Returns the urls of any that still weren't found when time ran out"""
+    pending = set((resource['resourceType'], resource['url']) for resource in resources)
+    deadline = time.time() + timeout
+
+    while True:
+        for resource_type, url in list(pending):
+            if is_indexed(client, resource_type, url):
+                pending.remove((resource_type, url))
+
+        if len(pending) == 0 or time.time() >= deadline:
+            break
+
+        time.sleep(min(interval, max(deadline - time.time(), 0)))
+        interval = min(interval * 2, max_interval)
+
+    return sorted(url for resource_type, url in pending)
+
+def load_concurrently(client, resources, workers=DEFAULT_VOCAB_WORKERS):
+    """Load the resources, several at a time. Returns the responses in the 
+    same order as the resources. Any failure is raised once the rest have 
+    had their chance"""
+    if len(resources) == 0:
+        return []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(load_vocabulary, client, resource) for resource in resources]
+    return [future.result() for future in futures]
+
+def replicate_vocabulary(client, resources, workers=DEFAULT_VOCAB_WORKERS, timeout=DEFAULT_READY_TIMEOUT):
+    """Copy the CodeSystems and ValueSets (in that order) to the server. The 
+    ValueSets aren't loaded until the server has indexed the CodeSystems, 
+    since they are useless until the server can find the codes they point 
+    to. The resources' ids are those of the source server, so they are not
+    included."""
+    code_systems = []
+    valuesets = []
+    for resource in resources:
+        resource = {k: v for k, v in resource.items() if k != 'id'}
+        if resource['resourceType'] == 'CodeSystem':
+            code_systems.append(resource)
+        elif resource['resourceType'] == 'ValueSet':
+            valuesets.append(resource)
+
+    load_concurrently(client, code_systems, workers=workers)
+    if len(code_systems) > 0:
+        start = time.time()
+        missing = wait_until_indexed(client, code_systems, timeout=timeout)
+        if len(missing) > 0:
+            print(f"[yellow]{len(missing)} CodeSystems still weren't searchable after {timeout}s: {', '.join(missing)}")
+        else:
+            print(f"{len(code_systems)} CodeSystems indexed after {time.time() - start:.1f}s")
+
+    load_concurrently(client, valuesets, workers=workers)
+    return len(code_systems) + len(valuesets)
@@ -4,9 +4,11 @@ Provide support for summarizing conditions over a group of patients
 
 from collections import defaultdict
 from summvar.fhir.codeableconcept import CodeableConcept
+from summvar.summary.subjects import SubjectSet
 from ncpi_fhir_plugin.common import constants
 from summvar.summary.constants import common_terms
-from summvar.fhir import MetaTag, _tag_code
+from summvar.fhir import MetaTag, MetaTagParam
+from summvar.fhir.search import PagedSearch, chunks, subject_key, DEFAULT_BATCH_SIZE
 from summvar.summary import _VARDEF_SYSTEM, _VARDEF_PROFILE
 
 from pprint import pformat
@@ -35,7 +37,7 @@ class ConditionSummary:
         self.name_prefix = name_prefix      # Group portion of the identity
         self.group_ref = group_ref          # Reference for use in focus
         self.total_count = total_count      # total number of group members
-        self.status_refs = defaultdict(set) # Present => N, Absent => N
+        self.status_refs = defaultdict(SubjectSet) # Present => N, Absent => N
 
         # We no longer put negatives inside the conditions
         #for status in code_lkup.keys():
@@ -54,6 +56,11 @@ class ConditionSummary:
         self.status_refs[status].add(resource['subject']['reference'])
 
 
+    def merge(self, other):
+        """Union another summary's subjects (e.g. from a different group)"""
+        for status, refs in other.status_refs.items():
+            self.status_refs[status].update(refs)
+
     def to_json(self):
         value = self.code.value
 
@@ -140,29 +147,75 @@ class ConditionSummary:
 
         return entity
 
-def summarize(client, name_prefix, patient_refs, group_ref, profile=None):
+# Ways we can go about pulling the Conditions for a group
+#   subject - One query per patient (the original approach)
+#   chunked - Multi-subject searches, batch_size patients per search
+#   tag     - One paged search over everything with the study's tag, 
+#             filtered locally against the group's members
+HARVEST_STRATEGIES = ["subject", "chunked", "tag"]
+
+def summarize(client, name_prefix, patient_refs, group_ref, profile=None, strategy="subject", batch_size=DEFAULT_BATCH_SIZE):
+    """Summarize Conditions over the patients in patient_refs
+
+    :param strategy: One of HARVEST_STRATEGIES
+    :type strategy: string
+
+    :param batch_size: Number of subjects per search for chunked harvesting
+    :type batch_size: int
+    """
     observations = {}
-    for ref in patient_refs:
-        entry_count = 0
-        query = f"Condition?subject={ref}"
-        if _tag_code is not None:
-            query += f"&_tag={_tag_code}"
-        if profile is not None:
-            query += f"&_profile={profile}"
-        response = client.get(query)
-        if response.success():
-            for entry in response.entries:
-                resource = entry['resource']
-                cc = CodeableConcept(resource['code'])
-                code = cc.code
-                entry_count += 1
-                if code not in observations:
-                    observations[code] = ConditionSummary(cc, name_prefix, group_ref, total_count = len(patient_refs))
-
-                observations[code].add_reference(resource)
+    total_count = len(patient_refs)
+
+    def add_condition(resource):
+        cc = CodeableConcept(resource['code'])
+        code = cc.code
+        if code not in observations:
+            observations[code] = ConditionSummary(cc, name_prefix, group_ref, total_count = total_count)
+
+        observations[code].add_reference(resource)
+
+    # Every strategy is limited to the study's tag (when there is one), since
+    # the server may be shared with other studies
+    tag = MetaTagParam()
+    filters = ""
+    if tag is not None:
+        filters += f"&_tag={tag}"
+    if profile is not None:
+        filters += f"&_profile={profile}"
+
+    if strategy == "subject":
+        for ref in patient_refs:
+            entry_count = 0
+            query = f"Condition?subject={ref}{filters}"
+            response = client.get(query)
+            if response.success():
+                for entry in response.entries:
+                    resource = entry['resource']
+                    entry_count += 1
+                    add_condition(resource)
+    else:
+        search = PagedSearch(client)
+
+        if strategy == "chunked":
+            for chunk in chunks(patient_refs, batch_size):
+                query = f"Condition?subject={','.join(chunk)}{filters}"
+                for resource in search.resources(query):
+                    add_condition(resource)
+        elif strategy == "tag":
+            if tag is None:
+                raise ValueError("Tag scoped Condition harvesting requires the meta tag to be initialized")
+
+            members = set(subject_key(ref) for ref in patient_refs)
+            for resource in search.resources(f"Condition?{filters[1:]}"):
+                if subject_key(resource['subject']['reference']) in members:
+                    add_condition(resource)
+        else:
+            raise ValueError(f"Unknown harvesting strategy, {strategy}. Expected one of {HARVEST_STRATEGIES}")
 
+        print(f"{name_prefix}: {search.request_count} Condition requests for "
+              f"{total_count} patients ({strategy})")
 
     summaries = []
     for code in observations.keys():
         summaries.append(observations[code].to_json())
-    return summaries
\ No newline at end of file
+    return summaries
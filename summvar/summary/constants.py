@@ -23,7 +23,9 @@ add_common_term("COUNT", NCIT, "C0750480", "Count")
 add_common_term("DISTINCT", NCIT, "C3641802", "Distinct Product Count")
 add_common_term("SUM", NCIT, "C25697", "Sum")
 add_common_term("MEAN", NCIT, "C0444504", "Statistical Mean")
+add_common_term("MEDIAN", NCIT, "C0876920", "Median")
 add_common_term("RANGE", NCIT, "C2348147", "Sample Range")
+add_common_term("IQR", NCIT, "C53323", "Interquartile Range")
 add_common_term("SUMMARY_REPORT", NCIT, "C0242482", "Summary Report")
 add_common_term("GENDER", NCIT, "C0079399", "Gender")
 add_common_term("MISSING", NCIT, "C142610", "Missing Data")
@@ -0,0 +1,98 @@
+"""
+Provide support for summarizing demographics, conditions and phenotypes over
+a group of patients in a single pass
+
+Rather than walking the patient list once for each type of summary, we page
+through the group's Patients and pull their Conditions along for the ride 
+using _revinclude. Each page then updates every one of the accumulators. 
+
+Phenotypes are pulled with a separate, profile filtered Observation search 
+for each batch of patients. An Observation _revinclude would drag along every
+Observation the patients have, which is far more than servers are willing to
+include in a page.
+
+Servers are allowed to cap the number of included resources, sometimes only 
+saying so with an OperationOutcome in the bundle (or not at all). If a batch
+looks like it was cut short, its Conditions are pulled again with a plain 
+Condition search.
+"""
+
+from summvar.fhir.codeableconcept import CodeableConcept
+from summvar.fhir.search import PagedSearch, chunks, id_list, DEFAULT_BATCH_SIZE
+from summvar.summary.patient import GenderSummary, EthSummary, RaceSummary
+from summvar.summary.condition import ConditionSummary
+from summvar.summary.hpo import ObservationSummary, ncpi_phenotype
+
+def has_profile(resource, profile):
+    if profile is None:
+        return True
+    return profile in resource.get('meta', {}).get('profile', [])
+
+def summarize(client,
+              name_prefix,
+              patient_refs,
+              group_ref,
+              batch_size=DEFAULT_BATCH_SIZE,
+              condition_profile=None,
+              phenotypes=True):
+    """Summarize gender, ethnicity, race, conditions and (optionally)
+    phenotypes over the patients in patient_refs
+
+    Returns a tuple of lists, (condition_summaries, phenotype_summaries,
+    demo_summaries) which match what the individual summarize functions
+    would have produced.
+    """
+    total_count = len(patient_refs)
+    genders = GenderSummary(name_prefix, group_ref, total_count)
+    eths = EthSummary(name_prefix, group_ref, total_count)
+    races = RaceSummary(name_prefix, group_ref, total_count)
+    conditions = {}
+    observations = {}
+
+    def add_condition(resource):
+        if has_profile(resource, condition_profile):
+            cc = CodeableConcept(resource['code'])
+            if cc.code not in conditions:
+                conditions[cc.code] = ConditionSummary(cc, name_prefix, group_ref, total_count=total_count)
+            conditions[cc.code].add_reference(resource)
+
+    search = PagedSearch(client, page_size=batch_size)
+    for chunk in chunks(patient_refs, batch_size):
+        patient_count = 0
+        truncated = False
+        chunk_conditions = []
+        for resource in search.resources(f"Patient?_id={id_list(chunk)}&_revinclude=Condition:subject"):
+            resource_type = resource['resourceType']
+
+            if resource_type == 'Patient':
+                patient_count += 1
+                genders.add_reference(resource)
+                eths.add_reference(resource)
+                races.add_reference(resource)
+            elif resource_type == 'Condition':
+                chunk_conditions.append(resource)
+            elif resource_type == 'OperationOutcome':
+                # Typically a warning that the includes were capped
+                truncated = True
+
+        if truncated or patient_count < len(chunk):
+            # We can't trust that every Condition made it, so get them the
+            # long way for this batch
+            print(f"{name_prefix}: Included Conditions may be incomplete. Searching for them directly")
+            chunk_conditions = search.resources(f"Condition?subject={','.join(chunk)}")
+        for resource in chunk_conditions:
+            add_condition(resource)
+
+        if phenotypes:
+            for resource in search.resources(f"Observation?subject={','.join(chunk)}&_profile={ncpi_phenotype}"):
+                if resource['resourceType'] == 'Observation':
+                    cc = CodeableConcept(resource['code'])
+                    if cc.code not in observations:
+                        observations[cc.code] = ObservationSummary(cc, name_prefix, group_ref, total_count=total_count)
+                    observations[cc.code].add_reference(resource)
+
+    print(f"{name_prefix}: {search.request_count} requests for {total_count} patients (fused)")
+
+    return ([x.to_json() for x in conditions.values()],
+            [x.to_json() for x in observations.values()],
+            [genders.objectify(), eths.objectify(), races.objectify()])
@@ -4,7 +4,9 @@ Provide support for summarizing HPO Observations over a group of patients
 
 from collections import defaultdict
 from summvar.fhir.codeableconcept import CodeableConcept
-from summvar.fhir import MetaTag
+from summvar.summary.subjects import SubjectSet
+from summvar.fhir import MetaTag, MetaTagParam
+from summvar.fhir.search import PagedSearch, subject_key
 import pdb
 from pprint import pformat
 
@@ -29,7 +31,7 @@ class ObservationSummary:
         self.name_prefix = name_prefix      # Group portion of the identity
         self.group_ref = group_ref          # Reference for use in focus
         self.total_count = total_count      # total number of group members
-        self.status_refs = defaultdict(set) # Present => N, Absent => N
+        self.status_refs = defaultdict(SubjectSet) # Present => N, Absent => N
 
     def add_reference(self, resource):
         # Not sure if everyone is doing both interpretation and valueCC
@@ -46,6 +48,11 @@ class ObservationSummary:
             pdb.set_trace()
         self.status_refs[status].add(resource['subject']['reference'])
 
+    def merge(self, other):
+        """Union another summary's subjects (e.g. from a different group)"""
+        for status, refs in other.status_refs.items():
+            self.status_refs[status].update(refs)
+
     def to_json(self):
         entity = {
             'resourceType': 'Observation',
@@ -118,22 +125,74 @@ class ObservationSummary:
         return entity
 
 
-def summarize(client, name_prefix, patient_refs, group_ref):
+# Ways we can go about pulling the phenotype Observations for a group
+#   subject - One query per patient
+#   study   - One paged scan over every phenotype Observation with the 
+#             study's tag, keeping only those belonging to group members
+#   auto    - Pick whichever of the two should require fewer requests
+SCAN_STRATEGIES = ["subject", "study", "auto"]
+
+def choose_strategy(search, patient_count):
+    """Compare the number of per-subject queries against the number of pages
+    required to scan all of the study's phenotype Observations"""
+    tag = MetaTagParam()
+    if tag is None:
+        return "subject"
+
+    total = search.total(f"Observation?_tag={tag}&_profile={ncpi_phenotype}")
+    if total is None:
+        return "subject"
+
+    pages = max(1, -(-total // search.page_size))
+    if pages < patient_count:
+        return "study"
+    return "subject"
+
+def summarize(client, name_prefix, patient_refs, group_ref, strategy="subject"):
+    """Summarize phenotype Observations over the patients in patient_refs
+
+    :param strategy: One of SCAN_STRATEGIES
+    :type strategy: string
+    """
     observations = {}
-    for ref in patient_refs:
-        response = client.get(f"Observation?subject={ref}&_profile={ncpi_phenotype}")
-        if response.success():
-            for entry in response.entries:
-                resource = entry['resource']
-                cc = CodeableConcept(resource['code'])
-                code = cc.code
+    total_count = len(patient_refs)
+
+    def add_observation(resource):
+        cc = CodeableConcept(resource['code'])
+        code = cc.code
+
+        if code not in observations:
+            observations[code] = ObservationSummary(cc, name_prefix, group_ref, total_count = total_count)
+
+        observations[code].add_reference(resource)
+
+    search = PagedSearch(client)
+    if strategy == "auto":
+        strategy = choose_strategy(search, total_count)
+        print(f"{name_prefix}: Using the {strategy} phenotype scan for {total_count} patients")
+
+    if strategy == "subject":
+        for ref in patient_refs:
+            response = client.get(f"Observation?subject={ref}&_profile={ncpi_phenotype}")
+            search.request_count += 1
+            if response.success():
+                for entry in response.entries:
+                    add_observation(entry['resource'])
+    elif strategy == "study":
+        tag = MetaTagParam()
+        if tag is None:
+            raise ValueError("Study wide phenotype scans require the meta tag to be initialized")
 
-                if code not in observations:
-                    observations[code] = ObservationSummary(cc, name_prefix, group_ref, total_count = len(patient_refs))
+        members = set(subject_key(ref) for ref in patient_refs)
+        for resource in search.resources(f"Observation?_tag={tag}&_profile={ncpi_phenotype}"):
+            if subject_key(resource['subject']['reference']) in members:
+                add_observation(resource)
+    else:
+        raise ValueError(f"Unknown scan strategy, {strategy}. Expected one of {SCAN_STRATEGIES}")
 
-                observations[code].add_reference(resource)
+    print(f"{name_prefix}: {search.request_count} phenotype requests for {total_count} patients")
 
     summaries = []
     for code in observations.keys():
         summaries.append(observations[code].to_json())
-    return summaries
\ No newline at end of file
+    return summaries
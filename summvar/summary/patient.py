@@ -3,7 +3,9 @@ Provide support for summarizing demographics over a group of patients
 """
 from collections import defaultdict
 from summvar.fhir.codeableconcept import CodeableConcept
+from summvar.summary.subjects import SubjectSet
 from summvar.fhir import MetaTag
+from summvar.fhir.search import PagedSearch, chunks, id_list
 from ncpi_fhir_plugin.common import constants
 from pprint import pformat
 import pdb
@@ -27,6 +29,10 @@ ethnicities = [
     constants.COMMON.UNKNOWN
 ]
 
+# When pulling patients in batches, these are the only elements we actually
+# need (id comes along for free)
+_patient_elements = "gender,extension"
+
 class RaceSummary:
     def __init__(self, name_prefix, group_ref, total_count):
         self.code =  CodeableConcept({      # CodeableConcept associated with this variable
@@ -40,11 +46,11 @@ class RaceSummary:
         self.name_prefix = name_prefix      # Group portion of the identity
         self.group_ref = group_ref          # Reference for use in focus
         self.total_count = total_count      # total number of group members
-        self.race = defaultdict(set)
+        self.race = defaultdict(SubjectSet)
         self.value_codings = {}             # Stash the codings to be used to label observation components
         # Just to make sure we have a complete set of responses
         for race in races:
-            self.race[race] = set()
+            self.race[race] = SubjectSet()
             self.value_codings[race] = {
                 "display": race
             }
@@ -149,11 +155,11 @@ class EthSummary:
         self.name_prefix = name_prefix      # Group portion of the identity
         self.group_ref = group_ref          # Reference for use in focus
         self.total_count = total_count      # total number of group members
-        self.eth = defaultdict(set)
+        self.eth = defaultdict(SubjectSet)
         self.value_codings = {}             # Stash the codings to be used to label observation components
         # Just to make sure we have a complete set of responses       
         for eth in ethnicities:
-            self.eth[eth] = set()
+            self.eth[eth] = SubjectSet()
             self.value_codings[eth] = {
                 "display": eth
             }
@@ -276,10 +282,10 @@ class GenderSummary:
             }
         }
         self.gender = {
-            "male": set(),
-            "female": set(),
-            "other": set(),
-            "unknown": set()
+            "male": SubjectSet(),
+            "female": SubjectSet(),
+            "other": SubjectSet(),
+            "unknown": SubjectSet()
         }
 
     def add_reference(self, resource):
@@ -356,19 +362,41 @@ class GenderSummary:
         entity['component'].append(component)
 
         return entity
-def summarize(client, name_prefix, patient_refs, group_ref):
+def summarize(client, name_prefix, patient_refs, group_ref, batch_size=None):
+    """Summarize gender, ethnicity and race over the patients in patient_refs
+
+    :param batch_size: When provided, patients are pulled batch_size at a 
+                       time using Patient?_id=a,b,c... limited to just the 
+                       elements we summarize. Otherwise, each patient is 
+                       pulled individually
+    :type batch_size: int
+    """
     genders = GenderSummary(name_prefix, group_ref, len(patient_refs))
     eths = EthSummary(name_prefix, group_ref, len(patient_refs))
     races = RaceSummary(name_prefix, group_ref, len(patient_refs))
-    for ref in patient_refs:
-        response = client.get(ref)
-        if response.success():
-            for entry in response.entries:
-                resource = entry
-                if 'resource' in entry:
-                    resource = entry['resource']
+
+    if batch_size is None:
+        for ref in patient_refs:
+            response = client.get(ref)
+            if response.success():
+                for entry in response.entries:
+                    resource = entry
+                    if 'resource' in entry:
+                        resource = entry['resource']
+                    genders.add_reference(resource)
+                    eths.add_reference(resource)
+                    races.add_reference(resource)
+    else:
+        search = PagedSearch(client, page_size=batch_size)
+        for chunk in chunks(patient_refs, batch_size):
+            query = f"Patient?_id={id_list(chunk)}&_elements={_patient_elements}"
+            for resource in search.resources(query):
                 genders.add_reference(resource)
                 eths.add_reference(resource)
                 races.add_reference(resource)
 
-    return [genders.objectify(), eths.objectify(), races.objectify()]
\ No newline at end of file
+        print(f"{name_prefix}: {search.request_count} requests for "
+              f"{len(patient_refs)} patients "
+              f"({len(patient_refs) - search.request_count} requests saved)")
+
+    return [genders.objectify(), eths.objectify(), races.objectify()]
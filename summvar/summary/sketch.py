@@ -0,0 +1,175 @@
+"""
+Bounded memory sketches for the data managers
+
+These let us report things like medians and distinct counts without holding
+on to every value we see, and they merge cheaply when workspace summaries
+are rolled up to the study (phs) level.
+
+    KLLSketch     - Mergeable quantile sketch (Karnin, Lang, Liberty)
+    HyperLogLog   - Approximate distinct counts
+    SpaceSaving   - Approximate top-k (heavy hitters)
+"""
+
+import math
+from hashlib import blake2b
+
+class KLLSketch:
+    """Quantile sketch whose size is bounded by roughly 3k items regardless
+    of how many values are added. Compactions alternate which half they keep
+    rather than flipping a coin so that results are reproducible."""
+    def __init__(self, k=200):
+        self.k = k
+        self.n = 0
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.compactors = [[]]
+        self.offsets = [0]
+        self.size = 0
+        self.max_size = self.capacity(0)
+
+    def capacity(self, height):
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil(self.k * (2 / 3) ** depth)) + 1
+
+    def grow(self):
+        self.compactors.append([])
+        self.offsets.append(0)
+        self.max_size = sum(self.capacity(h) for h in range(len(self.compactors)))
+
+    def update(self, value):
+        self.compactors[0].append(value)
+        self.n += 1
+        self.size += 1
+        if self.size >= self.max_size:
+            self.compress()
+
+    def update_many(self, values):
+        """Add a batch of values (e.g. an entire column) at once"""
+        values = list(values)
+        start = 0
+        while start < len(values):
+            room = max(1, self.max_size - self.size)
+            chunk = values[start:start + room]
+            self.compactors[0].extend(chunk)
+            self.n += len(chunk)
+            self.size += len(chunk)
+            start += len(chunk)
+            if self.size >= self.max_size:
+                self.compress()
+
+    def compress(self):
+        for h in range(len(self.compactors)):
+            compactor = self.compactors[h]
+            if len(compactor) >= self.capacity(h):
+                if h + 1 >= len(self.compactors):
+                    self.grow()
+                compactor.sort()
+
+                # Odd lengths leave one item behind at this level
+                leftover = [compactor.pop()] if len(compactor) % 2 else []
+                self.compactors[h + 1].extend(compactor[self.offsets[h]::2])
+                self.offsets[h] ^= 1
+                self.compactors[h] = leftover
+
+                self.size = sum(len(c) for c in self.compactors)
+                if self.size < self.max_size:
+                    break
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self.grow()
+        for h, compactor in enumerate(other.compactors):
+            self.compactors[h].extend(compactor)
+        self.n += other.n
+        self.size = sum(len(c) for c in self.compactors)
+        while self.size >= self.max_size:
+            self.compress()
+
+    def quantile(self, q):
+        """Approximate value at quantile q (0 <= q <= 1)"""
+        if self.n == 0:
+            return None
+        weighted = sorted((value, 1 << h)
+                            for h, compactor in enumerate(self.compactors)
+                            for value in compactor)
+        total = sum(w for _, w in weighted)
+        target = q * total
+        cumulative = 0
+        for value, weight in weighted:
+            cumulative += weight
+            if cumulative >= target:
+                return value
+        return weighted[-1][0]
+
+def _hash64(value):
+    return int.from_bytes(blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'big')
+
+class HyperLogLog:
+    """Distinct count estimator using 2^p one byte registers (p=12 is 4KB
+    with a standard error of about 1.6%)"""
+    def __init__(self, p=12):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+
+    def reset(self):
+        self.registers = bytearray(self.m)
+
+    def add(self, value):
+        x = _hash64(value)
+        idx = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other):
+        assert self.p == other.p
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros > 0:
+            # Small range correction (linear counting)
+            estimate = self.m * math.log(self.m / zeros)
+        return int(round(estimate))
+
+class SpaceSaving:
+    """Track (approximately) the k most frequent values. Counts for values
+    that are reported are overestimated by at most their error term."""
+    def __init__(self, k=25):
+        self.k = k
+        self.counts = {}
+        self.errors = {}
+
+    def reset(self):
+        self.counts = {}
+        self.errors = {}
+
+    def add(self, value, count=1):
+        if value in self.counts:
+            self.counts[value] += count
+        elif len(self.counts) < self.k:
+            self.counts[value] = count
+            self.errors[value] = 0
+        else:
+            # Replace the current minimum
+            victim = min(self.counts, key=self.counts.get)
+            floor = self.counts.pop(victim)
+            del self.errors[victim]
+            self.counts[value] = floor + count
+            self.errors[value] = floor
+
+    def merge(self, other):
+        for value, count in other.counts.items():
+            self.add(value, count)
+
+    def top(self, n=None):
+        ranked = sorted(self.counts.items(), key=lambda x: (-x[1], str(x[0])))
+        if n is not None:
+            ranked = ranked[:n]
+        return ranked
@@ -0,0 +1,159 @@
+"""
+Compact subject membership for the summary accumulators
+
+The summaries only ever need to know how many distinct subjects fall into
+each category, but holding a set of "Patient/<id>" strings for every
+category gets expensive on large studies. Instead, each reference is interned
+to a dense integer once per run and category membership is kept as a
+roaring-style bitmap: ids are split into 64k wide chunks, each of which is
+held as a sorted array while sparse and as a plain bitmap once dense.
+"""
+
+from array import array
+from bisect import bisect_left
+
+# Chunks with more members than this are cheaper to hold as a bitmap
+_ARRAY_MAX = 4096
+_CHUNK_BYTES = 8192
+
+class SubjectIndex:
+    """Assign a dense integer id to each subject reference we encounter"""
+    def __init__(self):
+        self.ids = {}
+        self.refs = []
+
+    def intern(self, ref):
+        sid = self.ids.get(ref)
+        if sid is None:
+            sid = len(self.refs)
+            self.ids[ref] = sid
+            self.refs.append(ref)
+        return sid
+
+    def reference(self, sid):
+        return self.refs[sid]
+
+    def __len__(self):
+        return len(self.refs)
+
+_subject_index = SubjectIndex()
+
+def subject_index():
+    return _subject_index
+
+def reset_subject_index():
+    """Start a fresh index. Only safe once no SubjectSets from the previous
+    index are still in use"""
+    global _subject_index
+    _subject_index = SubjectIndex()
+    return _subject_index
+
+def _to_bitmap(values):
+    bits = bytearray(_CHUNK_BYTES)
+    for v in values:
+        bits[v >> 3] |= 1 << (v & 7)
+    return bits
+
+def _bitmap_values(bits):
+    for i, byte in enumerate(bits):
+        while byte:
+            low = byte & -byte
+            yield (i << 3) | (low.bit_length() - 1)
+            byte ^= low
+
+def _popcount(bits):
+    return int.from_bytes(bits, 'little').bit_count()
+
+class SubjectSet:
+    """A set of subject references backed by a compressed bitmap. Supports
+    just enough of the set interface for the summaries: add, len, in,
+    iteration and union."""
+    __slots__ = ('chunks', 'count', 'index')
+
+    def __init__(self, refs=None, index=None):
+        # high 16 bits => array('H') of low bits or a bytearray bitmap
+        self.chunks = {}
+        self.count = 0
+        self.index = index if index is not None else _subject_index
+
+        if refs is not None:
+            for ref in refs:
+                self.add(ref)
+
+    def add(self, ref):
+        self.add_id(self.index.intern(ref))
+
+    def add_id(self, sid):
+        high = sid >> 16
+        low = sid & 0xFFFF
+        chunk = self.chunks.get(high)
+        if chunk is None:
+            self.chunks[high] = array('H', [low])
+            self.count += 1
+        elif type(chunk) is array:
+            pos = bisect_left(chunk, low)
+            if pos == len(chunk) or chunk[pos] != low:
+                chunk.insert(pos, low)
+                self.count += 1
+                if len(chunk) > _ARRAY_MAX:
+                    self.chunks[high] = _to_bitmap(chunk)
+        else:
+            mask = 1 << (low & 7)
+            if not chunk[low >> 3] & mask:
+                chunk[low >> 3] |= mask
+                self.count += 1
+
+    def has_id(self, sid):
+        chunk = self.chunks.get(sid >> 16)
+        if chunk is None:
+            return False
+        low = sid & 0xFFFF
+        if type(chunk) is array:
+            pos = bisect_left(chunk, low)
+            return pos < len(chunk) and chunk[pos] == low
+        return bool(chunk[low >> 3] & (1 << (low & 7)))
+
+    def __contains__(self, ref):
+        sid = self.index.ids.get(ref)
+        return sid is not None and self.has_id(sid)
+
+    def __len__(self):
+        return self.count
+
+    def ids(self):
+        for high in sorted(self.chunks):
+            chunk = self.chunks[high]
+            values = chunk if type(chunk) is array else _bitmap_values(chunk)
+            for low in values:
+                yield (high << 16) | low
+
+    def __iter__(self):
+        for sid in self.ids():
+            yield self.index.reference(sid)
+
+    def update(self, other):
+        """Union other into this set in place. Both sets must share an index"""
+        assert other.index is self.index
+        for high, theirs in other.chunks.items():
+            mine = self.chunks.get(high)
+            if mine is None:
+                merged = theirs[:] if type(theirs) is array else bytearray(theirs)
+            elif type(mine) is array and type(theirs) is array:
+                merged = sorted(set(mine).union(theirs))
+                merged = array('H', merged) if len(merged) <= _ARRAY_MAX else _to_bitmap(merged)
+            else:
+                a = mine if type(mine) is bytearray else _to_bitmap(mine)
+                b = theirs if type(theirs) is bytearray else _to_bitmap(theirs)
+                merged = bytearray((int.from_bytes(a, 'little') | int.from_bytes(b, 'little')).to_bytes(_CHUNK_BYTES, 'little'))
+            self.chunks[high] = merged
+
+        self.count = sum(len(c) if type(c) is array else _popcount(c) for c in self.chunks.values())
+        return self
+
+    def __ior__(self, other):
+        return self.update(other)
+
+    def __or__(self, other):
+        result = SubjectSet(index=self.index)
+        result.update(self)
+        return result.update(other)
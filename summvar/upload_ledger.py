@@ -0,0 +1,158 @@
+"""
+Local record of what has already been written to each destination host
+
+Rerunning a summary typically produces exactly the same resources as the
+last run, but every one of them was still being written to the server. The
+ledger remembers a hash of the last body each host accepted for a given
+identifier (along with the id the server assigned) so that identical
+resources can be skipped while still providing an id for anything that
+needs to reference them.
+"""
+
+import sqlite3
+import hashlib
+import json
+import time
+import threading
+from pathlib import Path
+
+from rich import print
+
+# Properties the server manages which shouldn't count as changes
+_volatile_props = ['id', 'meta']
+
+def resource_key(resource):
+    identifier = resource['identifier'][0]
+    return f"{resource['resourceType']}|{identifier['system']}|{identifier['value']}"
+
+def canonical_hash(resource):
+    body = {k: v for k, v in resource.items() if k not in _volatile_props}
+
+    # Tags and profiles are ours, though, so those do matter
+    meta = resource.get('meta', {})
+    body['meta'] = {k: meta[k] for k in ['tag', 'profile'] if k in meta}
+
+    content = json.dumps(body, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(content.encode()).hexdigest()
+
+def host_key(client):
+    return getattr(client, 'target_service_url', str(client))
+
+class UploadLedger:
+    def __init__(self, filename):
+        self.filename = Path(filename)
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+
+        # Several processes may share the ledger, so give them some time to
+        # wait on each other's writes. Within a process, the vocabulary is 
+        # loaded from a thread pool, so the connection is shared between 
+        # threads and every use of it goes through the lock
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(str(self.filename), timeout=60, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS uploads (
+                                host TEXT NOT NULL,
+                                key TEXT NOT NULL,
+                                hash TEXT NOT NULL,
+                                resource_id TEXT,
+                                updated REAL,
+                                PRIMARY KEY (host, key))""")
+        self.db.commit()
+
+        self.skipped = 0
+        self.written = 0
+
+    def lookup(self, client, resource, content_hash=None):
+        """Returns the resource's id on the host if the host has already
+        accepted an identical copy of the resource. Otherwise, None"""
+        if content_hash is None:
+            content_hash = canonical_hash(resource)
+
+        with self.lock:
+            row = self.db.execute("SELECT hash, resource_id FROM uploads WHERE host=? AND key=?",
+                                  (host_key(client), resource_key(resource))).fetchone()
+            if row is not None and row[0] == content_hash and row[1] is not None:
+                self.skipped += 1
+                return row[1]
+        return None
+
+    def record(self, client, resource, resource_id, content_hash=None, commit=True):
+        if content_hash is None:
+            content_hash = canonical_hash(resource)
+
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO uploads (host, key, hash, resource_id, updated) VALUES (?, ?, ?, ?, ?)",
+                            (host_key(client), resource_key(resource), content_hash, resource_id, time.time()))
+            if commit:
+                self.db.commit()
+            self.written += 1
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def forget(self, client, resource):
+        with self.lock:
+            self.db.execute("DELETE FROM uploads WHERE host=? AND key=?",
+                            (host_key(client), resource_key(resource)))
+            self.db.commit()
+
+    def reset(self, client=None):
+        """Forget everything recorded for the client's host (or for every 
+        host if no client is provided). Use this when the destination has 
+        been changed behind the ledger's back, such as after a server has 
+        been wiped, or the ledger will keep skipping resources the server no 
+        longer has"""
+        with self.lock:
+            if client is None:
+                cursor = self.db.execute("DELETE FROM uploads")
+            else:
+                cursor = self.db.execute("DELETE FROM uploads WHERE host=?", 
+                                         (host_key(client),))
+            self.db.commit()
+        return cursor.rowcount
+
+    def report(self):
+        print(f"Upload ledger: {self.skipped} unchanged resources skipped, {self.written} written")
+
+_upload_ledger = None
+
+def InitUploadLedger(filename=None):
+    global _upload_ledger
+
+    _upload_ledger = None
+    if filename is not None:
+        _upload_ledger = UploadLedger(filename)
+    return _upload_ledger
+
+def upload_ledger():
+    return _upload_ledger
+
+def forget(client, resource):
+    """Drop the ledger's record of the resource on the client's host, if there
+    is one, so the next post actually writes it"""
+    if _upload_ledger is not None and 'identifier' in resource:
+        _upload_ledger.forget(client, resource)
+
+def post(client, resource_type, resource, **kwargs):
+    """Drop in for client.post which skips the write when the ledger says the
+    host already has an identical copy of the resource. Skipped writes return
+    a response which looks like the server's, so callers can still use
+    response['response']['id']"""
+    ledger = _upload_ledger
+    if ledger is None or 'identifier' not in resource:
+        return client.post(resource_type, resource, **kwargs)
+
+    content_hash = canonical_hash(resource)
+    resource_id = ledger.lookup(client, resource, content_hash=content_hash)
+    if resource_id is not None:
+        response = dict(resource)
+        response['id'] = resource_id
+        return {
+            "status_code": 200,
+            "response": response
+        }
+
+    result = client.post(resource_type, resource, **kwargs)
+    if result['status_code'] < 300:
+        ledger.record(client, resource, result['response'].get('id'), content_hash=content_hash)
+    return result
@@ -0,0 +1,9 @@
+import pytest
+
+@pytest.fixture
+def ledger(tmp_path):
+    """A fresh upload ledger, which is shut off again once the test is done"""
+    from summvar.upload_ledger import InitUploadLedger
+
+    yield InitUploadLedger(tmp_path / "ledger.db")
+    InitUploadLedger(None)
@@ -0,0 +1,123 @@
+"""
+Stand-ins shared by the tests: just enough of a FHIR server for the 
+Observation searches (backed by a list of resources), builders for the 
+resources it serves and a minimal data-dictionary for code that only walks 
+the ActivityDefinitions and ObservationDefinitions
+"""
+
+from urllib.parse import urlsplit, parse_qs
+
+class FakeResponse:
+    def __init__(self, entries):
+        self.status_code = 200
+        self.entries = [{"resource": resource} for resource in entries]
+        self.response = {"resourceType": "Bundle", "link": []}
+
+    def success(self):
+        return True
+
+class FakeServer:
+    def __init__(self, resources):
+        self.resources = resources
+        self.queries = []
+
+    def matches(self, resource, params):
+        if 'code' in params:
+            system, code = params['code'][0].split("|")
+            if not any(c.get('system') == system and c.get('code') == code 
+                       for c in resource.get('code', {}).get('coding', [])):
+                return False
+        if 'subject' in params:
+            subjects = params['subject'][0].split(",")
+            if resource.get('subject', {}).get('reference') not in subjects:
+                return False
+        if '_tag' in params:
+            tags = [f"{t['system']}|{t['code']}" for t in resource.get('meta', {}).get('tag', [])]
+            if params['_tag'][0] not in tags:
+                return False
+        return True
+
+    def get(self, url, recurse=True, except_on_error=True):
+        self.queries.append(url)
+        url = urlsplit(url)
+        params = parse_qs(url.query)
+        resource_type = url.path.split("/")[-1]
+        return FakeResponse([r for r in self.resources 
+                             if r['resourceType'] == resource_type and self.matches(r, params)])
+
+class FakeClient:
+    """The writing side of FhirClient. Posts are recorded as (url, resource)
+    with the resource type joined onto the base url the way FhirClient.post
+    does it. Queued responses are handed back in order and, once they run
+    out, the resource is echoed back as created"""
+    def __init__(self, url="https://fhir.example.org/fhir", responses=()):
+        self.target_service_url = url
+        self.responses = list(responses)
+        self.requests = []
+
+    def post(self, resource_type, resource, **kwargs):
+        self.requests.append((f"{self.target_service_url}/{resource_type}", resource))
+        if len(self.responses) > 0:
+            return self.responses.pop(0)
+        return {
+            "status_code": 201,
+            "response": dict(resource, id=f"id-{len(self.requests)}")
+        }
+
+def observation(subject, code, value, system="https://example.org/vars", tag=None):
+    resource = {
+        "resourceType": "Observation",
+        "subject": {"reference": subject},
+        "code": {"coding": [{"system": system, "code": code}]},
+        "valueQuantity": {"value": value}
+    }
+    if tag is not None:
+        resource['meta'] = {"tag": [tag]}
+    return resource
+
+def quantity_od(code, system="https://example.org/vars"):
+    return {
+        "resourceType": "ObservationDefinition",
+        "id": code,
+        "identifier": [{"system": "https://example.org/od", "value": code}],
+        "code": {"coding": [{"system": system, "code": code, "display": code}]},
+        "permittedDataType": ["Quantity"]
+    }
+
+def group(name, members):
+    return {
+        "resourceType": "Group",
+        "id": name,
+        "identifier": [{"system": "https://example.org/group", "value": name}],
+        "member": [{"entity": {"reference": ref}} for ref in members]
+    }
+
+class FakeOD:
+    """An ObservationDefinition reduced to its bookkeeping. The code doubles
+    as the column name"""
+    def __init__(self, code):
+        self.resource = {"resourceType": "ObservationDefinition", "code": code}
+        self.source_identifier = f"sys|{code}"
+        self.colname = code
+        self.study_summaries = {}
+        self.last_committed = None
+        self.merged = []
+
+    def merge_into_phsid(self, phsid, data_manager):
+        self.merged.append((phsid, data_manager))
+
+class FakeAD:
+    def __init__(self, ods, table_name="participant", missing=("NA",)):
+        self.resource = {"resourceType": "ActivityDefinition", "name": table_name}
+        self.table_name = table_name
+        self.missing_encoding = set(missing)
+        self.ods = ods
+
+    def get_observation_definitions(self):
+        return self.ods
+
+class FakeDD:
+    """A data-dictionary with a single table"""
+    def __init__(self, codes=("age", "sex"), **kwargs):
+        self.ods = [FakeOD(code) for code in codes]
+        self.activity_definitions = [FakeAD(self.ods, **kwargs)]
@@ -0,0 +1,77 @@
+"""
+AggregateStore reuse rules: a workspace's stored aggregates are only reused
+while its lastModified, the data-dictionary and the settings are unchanged
+"""
+
+import pytest
+
+pytest.importorskip("rich")
+
+from ddsummary.aggregate_store import AggregateStore, fingerprint
+
+from fhir_fakes import FakeDD
+
+def store_workspace(store, dd, last_modified="2024-01-01T00:00:00"):
+    store.start_workspace(dd)
+    dd.ods[0].last_committed = {"count": 10}
+    store.save("ns", "ws", last_modified, dd, "cmg", "participant", {"problems": []})
+
+def test_fingerprint():
+    assert fingerprint(FakeDD()) == fingerprint(FakeDD())
+    assert fingerprint(FakeDD()) != fingerprint(FakeDD(missing=("NA", "-999")))
+    assert fingerprint(FakeDD()) != fingerprint(FakeDD(), {"sketch_threshold": 5})
+
+    changed = FakeDD()
+    changed.ods[1].resource['code'] = "gender"
+    assert fingerprint(FakeDD()) != fingerprint(changed)
+
+def test_unchanged_workspace_is_reused(tmp_path):
+    store = AggregateStore(tmp_path)
+    dd = FakeDD()
+    store_workspace(store, dd)
+    assert store.refreshed == 1
+
+    # A later run, with a fresh store and data-dictionary
+    store = AggregateStore(tmp_path)
+    dd = FakeDD()
+    assert store.is_current("ns", "ws", "2024-01-01T00:00:00", dd)
+    record = store.lookup("ns", "ws", "2024-01-01T00:00:00", dd)
+    assert record['tables'] == "participant"
+    assert record['study_problems'] == {"problems": []}
+
+    store.reuse(record, dd, "cmg", "phs000001")
+    assert dd.ods[0].merged == [("phs000001", {"count": 10})]
+    assert dd.ods[1].merged == []
+    assert store.reused == 1
+
+def test_changes_force_a_refresh(tmp_path):
+    store_workspace(AggregateStore(tmp_path), FakeDD())
+
+    store = AggregateStore(tmp_path)
+    assert not store.is_current("ns", "ws", "2024-02-01T00:00:00", FakeDD())
+    assert not store.is_current("ns", "ws", None, FakeDD())
+    assert not store.is_current("ns", "other", "2024-01-01T00:00:00", FakeDD())
+    assert not store.is_current("ns", "ws", "2024-01-01T00:00:00", FakeDD(missing=()))
+    assert store.lookup("ns", "ws", "2024-02-01T00:00:00", FakeDD()) is None
+
+    settings = AggregateStore(tmp_path, config={"sketch_threshold": 5})
+    assert not settings.is_current("ns", "ws", "2024-01-01T00:00:00", FakeDD())
+
+def test_missing_or_broken_pickle(tmp_path):
+    store = AggregateStore(tmp_path)
+    dd = FakeDD()
+    store_workspace(store, dd)
+
+    store.filename("ns", "ws").write_bytes(b"not a pickle")
+    assert store.is_current("ns", "ws", "2024-01-01T00:00:00", dd)
+    assert store.lookup("ns", "ws", "2024-01-01T00:00:00", dd) is None
+
+    store.filename("ns", "ws").unlink()
+    assert not store.is_current("ns", "ws", "2024-01-01T00:00:00", dd)
+
+def test_start_workspace_clears_commits(tmp_path):
+    store = AggregateStore(tmp_path)
+    dd = FakeDD()
+    dd.ods[1].last_committed = {"count": 3}
+    store.start_workspace(dd)
+    assert all(od.last_committed is None for od in dd.ods)
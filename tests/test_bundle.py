@@ -0,0 +1,161 @@
+"""
+BundleWriter against a stand-in for FhirClient, which answers with the same
+{status_code, response} dict
+"""
+
+import pytest
+
+pytest.importorskip("rich")
+
+from summvar.fhir.bundle import BundleWriter, entry_status, entry_reference
+
+from fhir_fakes import FakeClient
+
+BASE = "https://fhir.example.org/fhir"
+
+def summary(value):
+    return {
+        "resourceType": "Observation",
+        "identifier": [{"system": "https://example.org/summary", "value": value}],
+        "status": "final"
+    }
+
+def batch_response(*entries):
+    return {
+        "status_code": 200,
+        "response": {
+            "resourceType": "Bundle",
+            "type": "batch-response",
+            "entry": [{"response": entry} for entry in entries]
+        }
+    }
+
+outcome = {
+    "resourceType": "OperationOutcome",
+    "issue": [{"severity": "error", "code": "invalid"}]
+}
+
+def test_entry_helpers():
+    assert entry_status("201 Created") == 201
+    assert entry_status("weird") == 500
+    assert entry_reference(f"{BASE}/Observation/12/_history/3") == "Observation/12"
+    assert entry_reference("Observation/12") == "Observation/12"
+    assert entry_reference(None) is None
+
+def test_bundle_goes_to_the_base_url():
+    client = FakeClient(responses=[batch_response({"status": "201 Created", 
+                                         "location": "Observation/1/_history/1"})])
+    writer = BundleWriter(client)
+    writer.add(summary("a"))
+    writer.flush()
+
+    url, bundle = client.requests[0]
+    assert url.rstrip("/") == BASE
+    assert bundle['type'] == "batch"
+    request = bundle['entry'][0]['request']
+    assert request == {
+        "method": "PUT",
+        "url": "Observation?identifier=https://example.org/summary|a"
+    }
+
+def test_mixed_outcomes(ledger):
+    client = FakeClient(responses=[batch_response(
+        {"status": "201 Created", "location": f"{BASE}/Observation/1/_history/1"},
+        {"status": "400 Bad Request", "outcome": outcome},
+        {"status": "200 OK", "location": "Observation/3/_history/2"},
+        {"status": "412 Precondition Failed", "outcome": outcome}
+    )])
+    writer = BundleWriter(client, batch_size=10)
+    for value in "abcd":
+        assert writer.add(summary(value)) == []
+    results = writer.flush()
+
+    assert [r.status for r in results] == [201, 400, 200, 412]
+    assert [r.reference for r in results] == ["Observation/1", None, "Observation/3", None]
+    assert writer.written == 2
+    assert [f.resource['identifier'][0]['value'] for f in writer.failures] == ["b", "d"]
+    assert writer.failures[0].outcome == outcome
+    assert [f['identifier'] for f in writer.failure_details()] == [
+        "https://example.org/summary|b", 
+        "https://example.org/summary|d"
+    ]
+
+    # Only the successes made it into the ledger
+    assert ledger.lookup(client, summary("a")) == "1"
+    assert ledger.lookup(client, summary("b")) is None
+    assert ledger.lookup(client, summary("c")) == "3"
+    assert ledger.lookup(client, summary("d")) is None
+
+def test_unchanged_resources_are_not_sent(ledger):
+    client = FakeClient(responses=[
+        batch_response({"status": "201 Created", "location": "Observation/1"},
+                       {"status": "500 Internal Server Error"}),
+        batch_response({"status": "201 Created", "location": "Observation/2"})
+    ])
+    writer = BundleWriter(client)
+    writer.add(summary("a"))
+    writer.add(summary("b"))
+    writer.flush()
+
+    skipped = writer.add(summary("a"))
+    assert skipped[0].reference == "Observation/1"
+    writer.add(summary("b"))
+    writer.flush()
+
+    # Only the failed one was sent again
+    assert len(client.requests) == 2
+    assert [e['resource']['identifier'][0]['value'] for e in client.requests[1][1]['entry']] == ["b"]
+    assert writer.skipped == 1
+    assert ledger.lookup(client, summary("b")) == "2"
+
+def test_if_none_exist(ledger):
+    # An entry that already existed comes back 200 with the existing
+    # resource rather than a location
+    client = FakeClient(responses=[{
+        "status_code": 200,
+        "response": {
+            "resourceType": "Bundle",
+            "type": "batch-response",
+            "entry": [
+                {"response": {"status": "201 Created", "location": "Observation/1/_history/1"}},
+                {"response": {"status": "200 OK"}, 
+                 "resource": {"resourceType": "Observation", "id": "9"}},
+                {"response": {"status": "200 OK"}}
+            ]
+        }
+    }])
+    writer = BundleWriter(client, mode="create")
+    for value in "abc":
+        writer.add(summary(value))
+    results = writer.flush()
+
+    request = client.requests[0][1]['entry'][0]['request']
+    assert request['method'] == "POST"
+    assert request['ifNoneExist'] == "identifier=https://example.org/summary|a"
+    assert [r.reference for r in results] == ["Observation/1", "Observation/9", None]
+    assert writer.written == 3
+    assert writer.failures == []
+
+    # Without an id there is nothing to hand back later, so it isn't recorded
+    assert ledger.lookup(client, summary("b")) == "9"
+    assert ledger.lookup(client, summary("c")) is None
+
+def test_failed_bundle_fails_every_entry(ledger):
+    client = FakeClient(responses=[
+        {"status_code": 400, "response": outcome},
+        {"status_code": 200, "response": "<html>Proxy error</html>"}
+    ])
+    writer = BundleWriter(client, bundle_type="transaction")
+    writer.add(summary("a"))
+    writer.add(summary("b"))
+    results = writer.flush()
+    assert [r.status for r in results] == [400, 400]
+    assert results[0].outcome == outcome
+
+    # A 200 that isn't a Bundle doesn't count as success either
+    writer.add(summary("c"))
+    results = writer.flush()
+    assert results[0].status == 500
+    assert writer.written == 0
+    assert len(writer.failures) == 3
+    assert ledger.lookup(client, summary("a")) is None
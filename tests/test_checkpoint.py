@@ -0,0 +1,82 @@
+"""
+Checkpoint save/load round trip and the rules about when a file is written
+"""
+
+import pytest
+
+pytest.importorskip("rich")
+
+import summvar
+from ddsummary.checkpoint import Checkpoint
+
+from fhir_fakes import FakeDD
+
+def data_dictionaries():
+    dd = FakeDD()
+    return {"cmg": dd}, dd.ods
+
+def test_round_trip(tmp_path):
+    filename = tmp_path / "checkpoint.pkl"
+    dds, ods = data_dictionaries()
+    ods[0].study_summaries = {"phs000001": {"n": 10}}
+    summvar._valid_phs_ids.add("phs000001")
+
+    checkpoint = Checkpoint(filename, every=2)
+    checkpoint.workspace_complete("ns", "ws1", dds, {"phs000001": ("cmg", "sys")}, {"ws1": {}})
+    assert not filename.exists()
+    checkpoint.workspace_complete("ns", "ws2", dds, {"phs000001": ("cmg", "sys")}, {"ws1": {}, "ws2": {}})
+    assert filename.exists()
+
+    restored = Checkpoint(filename)
+    assert restored.load()
+    assert restored.is_complete("ns", "ws1")
+    assert restored.is_complete("ns", "ws2")
+    assert not restored.is_complete("ns", "ws3")
+
+    fresh_dds, fresh_ods = data_dictionaries()
+    study_summaries = {}
+    study_problems = {}
+    summvar._valid_phs_ids.discard("phs000001")
+    restored.restore(fresh_dds, study_summaries, study_problems)
+
+    assert study_summaries == {"phs000001": ("cmg", "sys")}
+    assert set(study_problems) == {"ws1", "ws2"}
+    assert fresh_ods[0].study_summaries == {"phs000001": {"n": 10}}
+    assert fresh_ods[1].study_summaries == {}
+    assert "phs000001" in summvar._valid_phs_ids
+
+    restored.discard()
+    assert not filename.exists()
+    assert not list(tmp_path.iterdir())
+
+def test_without_a_file_nothing_is_written(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    dds, _ = data_dictionaries()
+    checkpoint = Checkpoint(None, every=1)
+    checkpoint.workspace_complete("ns", "ws1", dds, {}, {})
+    checkpoint.save(dds, {}, {})
+    checkpoint.discard()
+
+    assert checkpoint.is_complete("ns", "ws1")
+    assert not checkpoint.load()
+    assert not list(tmp_path.rglob("*"))
+
+def test_missing_checkpoint(tmp_path):
+    assert not Checkpoint(tmp_path / "nope.pkl").load()
+
+def test_failed_uploads_wait_for_resume(tmp_path):
+    filename = tmp_path / "checkpoint.pkl"
+    dds, _ = data_dictionaries()
+    summary = {"resourceType": "Observation", "identifier": [{"system": "sys", "value": "age"}]}
+
+    checkpoint = Checkpoint(filename, every=1)
+    checkpoint.workspace_complete("ns", "ws1", dds, {}, {}, failed_uploads=[summary])
+    checkpoint.workspace_complete("ns", "ws2", dds, {}, {}, failed_uploads=[])
+
+    restored = Checkpoint(filename)
+    assert restored.load()
+    assert restored.is_complete("ns", "ws1")
+    assert restored.failed_uploads == {"ns/ws1": [summary]}
+
+    restored.uploads_retried("ns/ws1", [])
+    assert restored.failed_uploads == {}
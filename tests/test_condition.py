@@ -0,0 +1,42 @@
+"""
+Whichever strategy is used to harvest a group's Conditions, only those
+carrying the study's tag are counted
+"""
+
+import pytest
+
+pytest.importorskip("rich")
+pytest.importorskip("ncpi_fhir_plugin")
+
+from summvar.fhir import InitMetaTag
+from summvar.summary.condition import summarize, HARVEST_STRATEGIES
+
+from fhir_fakes import FakeServer
+
+STUDY_TAG = {"system": "https://example.org/study", "code": "s1"}
+OTHER_TAG = {"system": "https://example.org/study", "code": "s2"}
+
+def condition(subject, code, tag):
+    return {
+        "resourceType": "Condition",
+        "subject": {"reference": subject},
+        "code": {"coding": [{"system": "http://purl.obolibrary.org/obo/hp.owl", 
+                             "code": code, 
+                             "display": code}]},
+        "meta": {"tag": [tag]}
+    }
+
+@pytest.mark.parametrize("strategy", HARVEST_STRATEGIES)
+def test_conditions_are_tag_scoped(strategy):
+    InitMetaTag(STUDY_TAG['system'], STUDY_TAG['code'])
+    server = FakeServer([
+        condition("Patient/1", "HP:0001", STUDY_TAG),
+        condition("Patient/2", "HP:0001", STUDY_TAG),
+        condition("Patient/1", "HP:0001", OTHER_TAG),
+        condition("Patient/2", "HP:0002", OTHER_TAG)
+    ])
+
+    summaries = summarize(server, "g1", ["Patient/1", "Patient/2"], "Group/g1", 
+                          strategy=strategy, batch_size=2)
+    assert len(summaries) == 1
+    assert all("_tag=https://example.org/study|s1" in query for query in server.queries)
@@ -0,0 +1,82 @@
+"""
+Group keeps a compact copy of its membership. What it writes back out has to
+match the source Group.
+"""
+
+import pytest
+
+pytest.importorskip("rich")
+
+from summvar.fhir import InitMetaTag
+from summvar.fhir.group import Group
+from summvar.summary.subjects import subject_index
+
+BASE = "https://fhir.example.org/fhir"
+
+def source_group(members):
+    return {
+        "resourceType": "Group",
+        "id": "g1",
+        "identifier": [{"system": "https://example.org/group", "value": "g1"}],
+        "name": "Group One",
+        "type": "person",
+        "member": members
+    }
+
+def member(ref):
+    return {"entity": {"reference": ref}}
+
+def test_members_written_as_they_were_read():
+    InitMetaTag("https://example.org/study", "s1")
+    members = [
+        member("Patient/3"),
+        member(f"{BASE}/Patient/1"),
+        {"entity": {"reference": "Patient/2"}, "inactive": True},
+        member("Patient/3"),
+        member("Patient/10")
+    ]
+    group = Group(None, resource=source_group(members))
+
+    assert group.p_refs == ["Patient/3", f"{BASE}/Patient/1", "Patient/2", 
+                            "Patient/3", "Patient/10"]
+    assert group.count == 5
+
+    obj = group.objectify()
+    assert obj['member'] == members
+    assert obj['quantity'] == 5
+
+    # The source resource doesn't hang on to the member list
+    assert 'member' not in group.resource
+
+def test_is_member_ignores_reference_form():
+    group = Group(None, resource=source_group([member(f"{BASE}/Patient/1"), 
+                                               member("Patient/2")]))
+    assert group.is_member("Patient/1")
+    assert group.is_member(f"{BASE}/Patient/2")
+    assert group.is_member("Patient/2")
+    assert not group.is_member("Patient/3")
+    assert not group.is_member("Patient/never-seen-anywhere")
+
+def test_members_share_the_subject_index():
+    a = Group(None, resource=source_group([member("Patient/shared"), member("Patient/a")]))
+    b = Group(None, resource=source_group([member("Patient/shared")]))
+    assert a.index is subject_index()
+    assert a.members[0] == b.members[0]
+
+def test_assigned_members():
+    group = Group(None, resource=source_group([{"entity": {"reference": "Patient/1"}, 
+                                                "inactive": True}]))
+    group.p_refs = ["Patient/5", "Patient/6"]
+    assert group.objectify()['member'] == [member("Patient/5"), member("Patient/6")]
+    assert group.is_member("Patient/6")
+    assert not group.is_member("Patient/1")
+
+def test_empty_group_reports_quantity():
+    InitMetaTag("https://example.org/study", "s1")
+    for members in ([], None):
+        resource = source_group(members)
+        if members is None:
+            del resource['member']
+        obj = Group(None, resource=resource).objectify()
+        assert obj['quantity'] == 0
+        assert 'member' not in obj
@@ -0,0 +1,97 @@
+"""
+Partitioning a variable's Observations across several groups in one pass has
+to give each group the same data as pulling the group on its own
+"""
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("rich")
+
+from summvar.fhir.group import Group, GroupIndex
+from summvar.fhir.observation_definition import ObservationDefinition
+
+from fhir_fakes import FakeServer, observation, quantity_od, group
+
+BASE = "https://fhir.example.org/fhir"
+
+@pytest.fixture
+def groups():
+    return [
+        Group(None, resource=group("g1", ["Patient/1", "Patient/2"])),
+        Group(None, resource=group("g2", [f"{BASE}/Patient/2", "Patient/3"])),
+        Group(None, resource=group("g3", []))
+    ]
+
+@pytest.fixture
+def server():
+    return FakeServer([
+        observation("Patient/1", "age", 10),
+        observation("Patient/2", "age", 20),
+        observation("Patient/3", "age", 30),
+        observation("Patient/4", "age", 40),
+        observation("Patient/1", "height", 150)
+    ])
+
+def test_group_index(groups):
+    index = GroupIndex(groups)
+    assert index.groups_for("Patient/1") == [0]
+    assert index.groups_for(f"{BASE}/Patient/2") == [0, 1]
+    assert index.groups_for("Patient/3") == [1]
+    assert index.groups_for("Patient/4") == []
+    assert index.groups_for("Specimen/1") == []
+    assert index.groups_for(f"{BASE}/Group/2") == []
+    assert sorted(index.subject_refs) == ["Patient/1", "Patient/3", f"{BASE}/Patient/2"]
+
+def stats(data_manager):
+    quantity = data_manager.quantity
+    if quantity is None:
+        return None
+    return (quantity.count, quantity.sum, quantity.min, quantity.max)
+
+@pytest.mark.parametrize("scope", ["server", "subject"])
+def test_partitions_match_separate_pulls(groups, server, scope):
+    od = ObservationDefinition(server, resource=quantity_od("age"))
+    index = GroupIndex(groups)
+    od.pull_partitioned(index, scope=scope, batch_size=2)
+    partitioned = [(partition[2], stats(partition[1])) for partition in od.partitions]
+
+    separate = []
+    for population in groups:
+        single = ObservationDefinition(server, resource=quantity_od("age"))
+        single.pull_observations(population, scope=scope, batch_size=2)
+        separate.append((single.valid_observation_count, stats(single.data_manager)))
+
+    assert partitioned == separate
+    assert partitioned[0] == (2, (2, 30, 10, 20))
+    assert partitioned[1] == (2, (2, 50, 20, 30))
+    assert partitioned[2][0] == 0
+
+def test_observations_without_subject_are_skipped(groups):
+    orphan = observation("Patient/1", "age", 99)
+    del orphan['subject']
+    server = FakeServer([observation("Patient/1", "age", 10), orphan])
+
+    od = ObservationDefinition(server, resource=quantity_od("age"))
+    od.pull_partitioned(GroupIndex(groups))
+    assert od.partitions[0][2] == 1
+    assert stats(od.partitions[0][1]) == (1, 10, 10, 10)
+    assert len(od.invalid_values) == 1
+
+@pytest.mark.parametrize("scope", ["server", "subject"])
+def test_other_subject_types_sharing_an_id(scope):
+    groups = [Group(None, resource=group("g1", ["Patient/1"]))]
+    server = FakeServer([
+        observation("Patient/1", "age", 10),
+        observation("Specimen/1", "age", 99),
+        observation("Group/1", "age", 1000)
+    ])
+
+    od = ObservationDefinition(server, resource=quantity_od("age"))
+    od.pull_partitioned(GroupIndex(groups), scope=scope)
+
+    single = ObservationDefinition(server, resource=quantity_od("age"))
+    single.pull_observations(groups[0], scope=scope)
+
+    assert od.partitions[0][2] == single.valid_observation_count == 1
+    assert stats(od.partitions[0][1]) == stats(single.data_manager) == (1, 10, 10, 10)
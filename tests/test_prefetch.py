@@ -0,0 +1,92 @@
+"""
+TablePrefetcher hands results back in the order they are asked for and
+drops anything the caller has moved past
+"""
+
+import threading
+import time
+
+from ddsummary.terra import TablePrefetcher
+
+class Fetcher:
+    """Records each fetch. Earlier keys take longer, so the downloads 
+    finish in the reverse of the order they were submitted"""
+    def __init__(self, delays=None):
+        self.calls = []
+        self.lock = threading.Lock()
+        self.delays = delays or {}
+
+    def __call__(self, namespace, name):
+        with self.lock:
+            self.calls.append((namespace, name))
+        time.sleep(self.delays.get(name, 0))
+        return f"{namespace}/{name}"
+
+def keys(count):
+    return [("ns", f"ws{i}") for i in range(count)]
+
+def test_results_come_back_in_order():
+    fetch = Fetcher({f"ws{i}": 0.05 * (5 - i) for i in range(5)})
+    prefetcher = TablePrefetcher(fetch, keys(5), workers=5)
+    try:
+        assert [prefetcher.get(key) for key in keys(5)] == [f"ns/ws{i}" for i in range(5)]
+    finally:
+        prefetcher.shutdown()
+    assert sorted(fetch.calls) == keys(5)
+
+def test_depth_bounds_what_is_in_flight():
+    fetch = Fetcher()
+    prefetcher = TablePrefetcher(fetch, keys(10), workers=1, depth=2)
+    try:
+        assert list(prefetcher.futures) == keys(2)
+        assert len(prefetcher.pending) == 8
+
+        prefetcher.get(("ns", "ws0"))
+        assert list(prefetcher.futures) == keys(3)[1:]
+    finally:
+        prefetcher.shutdown()
+
+def test_skipped_keys_are_dropped():
+    # The worker is held up on ws0, so ws1 and ws2 are still waiting and 
+    # can be cancelled when ws3 is asked for first
+    release = threading.Event()
+    calls = []
+    def fetch(namespace, name):
+        calls.append(name)
+        if name == "ws0":
+            release.wait(5)
+        return name
+
+    prefetcher = TablePrefetcher(fetch, keys(6), workers=1, depth=4)
+    try:
+        threading.Timer(0.1, release.set).start()
+        assert prefetcher.get(("ns", "ws3")) == "ws3"
+        assert ("ns", "ws1") not in prefetcher.futures
+        assert ("ns", "ws2") not in prefetcher.futures
+        assert prefetcher.get(("ns", "ws4")) == "ws4"
+    finally:
+        prefetcher.shutdown()
+    assert "ws1" not in calls
+    assert "ws2" not in calls
+    assert "ws4" in calls
+
+def test_key_beyond_the_window():
+    fetch = Fetcher()
+    prefetcher = TablePrefetcher(fetch, keys(10), workers=1, depth=2)
+    try:
+        # ws7 hasn't been submitted yet, so it is pulled directly and 
+        # everything ahead of it is forgotten
+        assert prefetcher.get(("ns", "ws7")) == "ns/ws7"
+        assert list(prefetcher.futures) == [("ns", "ws8"), ("ns", "ws9")]
+        assert prefetcher.get(("ns", "ws9")) == "ns/ws9"
+    finally:
+        prefetcher.shutdown()
+
+def test_unexpected_key():
+    fetch = Fetcher()
+    prefetcher = TablePrefetcher(fetch, keys(2), workers=1)
+    try:
+        assert prefetcher.get(("other", "ws")) == "other/ws"
+        assert prefetcher.get(("ns", "ws0")) == "ns/ws0"
+    finally:
+        prefetcher.shutdown()
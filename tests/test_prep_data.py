@@ -0,0 +1,87 @@
+"""
+Regression cases for summarize_workspaces' prep_data. The expected rows 
+are what prep_data returned before the rows were run through the 
+TableTransformer. header_lookup now covers every column in the table rather
+than only those written out as values.
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+
+# The script pulls in the full set of dependencies when it is imported
+pytest.importorskip("firecloud")
+pytest.importorskip("ncpi_fhir_client")
+pytest.importorskip("rich")
+pytest.importorskip("numpy")
+pytest.importorskip("xmltodict")
+pytest.importorskip("yaml")
+pytest.importorskip("requests")
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "scripts"))
+from summarize_workspaces import prep_data
+
+def entity_list(items_type, items):
+    return {
+        "itemsType": items_type,
+        "items": items
+    }
+
+def test_reference_list_after_empty_list():
+    # The first row's empty AttributeValue list must not hide the 
+    # EntityReferences that show up in the same column later on
+    rows = [
+        {"name": "set1", 
+         "attributes": {"samples": entity_list("AttributeValue", [])}},
+        {"name": "set2", 
+         "attributes": {"samples": entity_list("EntityReference", [
+                {"entityType": "sample", "entityName": "s1"},
+                {"entityType": "sample", "entityName": "s2"}
+         ])}}
+    ]
+
+    data, header_lookup = prep_data("sample_set", "sample_set_id", rows)
+    assert data == [
+        {"sample_set_id_id": "set1"},
+        {"sample_set_id_id": "set2", "sample_id": "s1"},
+        {"sample_set_id_id": "set2", "sample_id": "s2"}
+    ]
+    assert header_lookup == {"samples_id": "samples"}
+
+def test_values_and_joined_references():
+    # A single reference list gets folded into the value column that follows
+    # it. That's odd, but it is what prep_data has always done
+    rows = [
+        {"name": "p1", 
+         "attributes": {"1-Age-2": 10, "Sex": "F"}},
+        {"name": "p2", 
+         "attributes": {"family": entity_list("EntityReference", [
+                            {"entityType": "family", "entityName": "f1"}]),
+                        "Sex": "M"}}
+    ]
+
+    data, header_lookup = prep_data("participant", "participant_id", rows)
+    assert data == [
+        {"participant_id_id": "p1", "age_id": 10, "sex_id": "F"},
+        {"participant_id_id": "p2", "sex_id": "f1"}
+    ]
+    assert header_lookup == {"age_id": "1-Age-2", 
+                             "sex_id": "Sex", 
+                             "family_id": "family"}
+
+def test_uncleanable_column_is_dropped():
+    # The original prep_data raised on a header clean_varname couldn't make
+    # sense of and lost the entire row. Now only that column is dropped
+    rows = [
+        {"name": "p1", "attributes": {"%odd": "x", "Sex": "F"}},
+        {"name": "p2", "attributes": {"Sex": "M"}}
+    ]
+
+    data, header_lookup = prep_data("participant", "participant_id", rows, 
+                                    attribute_names=["%odd", "Sex"])
+    assert data == [
+        {"participant_id_id": "p1", "sex_id": "F"},
+        {"participant_id_id": "p2", "sex_id": "M"}
+    ]
+    assert header_lookup == {"sex_id": "Sex"}
@@ -0,0 +1,54 @@
+"""
+QuantitySummary's column path has to agree with adding the values one at a
+time
+"""
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("rich")
+
+from summvar.fhir.observation_definition import QuantitySummary, QuantityVariable
+
+values = [1, "2.5", "NA", None, "", "abc", float("nan"), 4, "-999", 7.5, "NA"]
+missing = {"NA", "-999", "", None}
+
+def summarize_one_at_a_time():
+    summary = QuantitySummary(["Quantity"], missing)
+    for value in values:
+        summary.add_value(value)
+    return summary
+
+def test_column_matches_values():
+    expected = summarize_one_at_a_time()
+    summary = QuantitySummary(["Quantity"], missing)
+    assert summary.add_column(values) == []
+
+    assert summary.missing == expected.missing == 6
+    assert summary.invalid_values == expected.invalid_values == 2
+    assert summary.nonmissing_count == expected.nonmissing_count == 4
+    assert summary.quantity.min == expected.quantity.min == 1
+    assert summary.quantity.max == expected.quantity.max == 7.5
+    assert summary.quantity.sum == expected.quantity.sum == 15
+
+def test_numeric_column_without_missing_encodings():
+    summary = QuantitySummary(["Quantity"], set())
+    summary.add_column([3, 1, 2])
+    assert summary.missing == 0
+    assert summary.nonmissing_count == 3
+    assert summary.quantity.sketch.quantile(0.5) == 2
+
+def test_components_share_the_unit():
+    quantity = QuantityVariable(unit="cm", unit_code="cm", unit_system="http://unitsofmeasure.org")
+    for value in [1.0, 2.0, 3.0, 4.0]:
+        quantity.add_quantity(value)
+
+    unit = {"unit": "cm", "code": "cm", "system": "http://unitsofmeasure.org"}
+    assert quantity.mean() == dict(unit, value=2.5)
+    assert quantity.median() == quantity.as_quantity(quantity.median()['value'])
+
+    quartiles = {}
+    quantity.add_quartiles(quartiles)
+    assert quartiles['valueRange']['low'].keys() == quantity.mean().keys()
+
+    assert QuantityVariable().mean() is None
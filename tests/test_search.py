@@ -0,0 +1,54 @@
+"""
+PagedSearch follows next links itself and must not quietly stop short when a
+page can't be pulled
+"""
+
+import pytest
+
+from summvar import SearchFailed
+from summvar.fhir.search import PagedSearch
+
+class PageResponse:
+    def __init__(self, status_code, entries=None, next_url=None):
+        self.status_code = status_code
+        self.entries = entries or []
+        self.response = {"resourceType": "Bundle", "link": []}
+        if next_url is not None:
+            self.response['link'].append({"relation": "next", "url": next_url})
+
+    def success(self):
+        return self.status_code < 300
+
+class PagedClient:
+    def __init__(self, pages):
+        self.pages = pages
+
+    def get(self, url, recurse=True, except_on_error=True):
+        return self.pages[url]
+
+def patient(pid):
+    return {"resource": {"resourceType": "Patient", "id": pid}}
+
+def test_pages_are_followed():
+    client = PagedClient({
+        "Patient?_count=2": PageResponse(200, [patient("1"), patient("2")], "page2"),
+        "page2": PageResponse(200, [patient("3")])
+    })
+    search = PagedSearch(client, page_size=2)
+    assert [r['id'] for r in search.resources("Patient")] == ["1", "2", "3"]
+    assert search.request_count == 2
+
+def test_failed_page_raises():
+    client = PagedClient({
+        "Patient?_count=2": PageResponse(200, [patient("1"), patient("2")], "page2"),
+        "page2": PageResponse(503)
+    })
+    search = PagedSearch(client, page_size=2)
+    seen = []
+    with pytest.raises(SearchFailed) as failure:
+        for resource in search.resources("Patient"):
+            seen.append(resource['id'])
+
+    assert seen == ["1", "2"]
+    assert failure.value.url == "page2"
+    assert failure.value.status_code == 503
@@ -0,0 +1,158 @@
+"""
+Accuracy checks for the bounded memory sketches behind the summary 
+components.
+"""
+
+import random
+
+import pytest
+
+from summvar.summary.sketch import KLLSketch, HyperLogLog, SpaceSaving
+
+def rank_error(values, estimate, q):
+    """How far (as a fraction of n) the estimate's rank is from q"""
+    values = sorted(values)
+    rank = sum(1 for v in values if v <= estimate) / len(values)
+    return abs(rank - q)
+
+def test_kll_small_n_is_exact():
+    # Nothing gets compacted until the sketch fills up, so these are exact
+    sketch = KLLSketch()
+    sketch.update_many([5, 1, 4, 2, 3])
+    assert sketch.n == 5
+    assert sketch.quantile(0.25) == 2
+    assert sketch.quantile(0.5) == 3
+    assert sketch.quantile(0.75) == 4
+    assert sketch.quantile(0) == 1
+    assert sketch.quantile(1) == 5
+
+def test_kll_empty():
+    assert KLLSketch().quantile(0.5) is None
+
+def test_kll_quantiles_on_known_distribution():
+    rng = random.Random(7)
+    values = [rng.gauss(100, 15) for _ in range(100000)]
+
+    sketch = KLLSketch()
+    for value in values:
+        sketch.update(value)
+
+    assert sketch.n == len(values)
+    assert sketch.size < 3 * sketch.k * 2
+    for q in (0.25, 0.5, 0.75):
+        assert rank_error(values, sketch.quantile(q), q) < 0.02
+
+def test_kll_update_many_matches_update():
+    values = list(range(20000))
+    one_at_a_time = KLLSketch()
+    for value in values:
+        one_at_a_time.update(value)
+    batched = KLLSketch()
+    batched.update_many(values)
+
+    assert batched.n == one_at_a_time.n
+    for q in (0.25, 0.5, 0.75):
+        assert rank_error(values, batched.quantile(q), q) < 0.02
+
+def test_kll_merge():
+    rng = random.Random(11)
+    left = [rng.uniform(0, 10) for _ in range(30000)]
+    right = [rng.uniform(10, 30) for _ in range(50000)]
+
+    a = KLLSketch()
+    a.update_many(left)
+    b = KLLSketch()
+    b.update_many(right)
+    a.merge(b)
+
+    combined = left + right
+    assert a.n == len(combined)
+    for q in (0.25, 0.5, 0.75):
+        assert rank_error(combined, a.quantile(q), q) < 0.02
+
+def test_kll_merge_small_sketches_is_exact():
+    a = KLLSketch()
+    a.update_many([1, 2, 3])
+    b = KLLSketch()
+    b.update_many([4, 5, 6, 7])
+    a.merge(b)
+    assert a.quantile(0.5) == 4
+
+def test_hll_count():
+    hll = HyperLogLog()
+    for i in range(50000):
+        hll.add(f"subject-{i}")
+        # Repeats shouldn't change anything
+        hll.add(f"subject-{i}")
+    assert abs(hll.count() - 50000) / 50000 < 0.05
+
+def test_hll_small_counts_and_merge():
+    a = HyperLogLog()
+    b = HyperLogLog()
+    for i in range(100):
+        a.add(i)
+    for i in range(50, 150):
+        b.add(i)
+    assert abs(a.count() - 100) <= 2
+    a.merge(b)
+    assert abs(a.count() - 150) <= 3
+
+def test_space_saving_finds_heavy_hitters():
+    rng = random.Random(3)
+    ss = SpaceSaving(k=10)
+    stream = ["A"] * 5000 + ["B"] * 3000 + ["C"] * 2000
+    stream += [f"rare-{rng.randrange(100000)}" for _ in range(5000)]
+    rng.shuffle(stream)
+    for value in stream:
+        ss.add(value)
+
+    top = ss.top(3)
+    assert [value for value, _ in top] == ["A", "B", "C"]
+    for value, count in top:
+        # Counts are only ever overestimated, and by no more than the error
+        true_count = stream.count(value)
+        assert true_count <= count <= true_count + ss.errors[value]
+
+def test_space_saving_merge():
+    a = SpaceSaving(k=5)
+    b = SpaceSaving(k=5)
+    for value in "aaab":
+        a.add(value)
+    for value in "abbbbc":
+        b.add(value)
+    a.merge(b)
+    assert a.top(2) == [("b", 5), ("a", 4)]
+
+@pytest.fixture
+def small_threshold():
+    # observation_definition brings numpy (and rich) with it
+    pytest.importorskip("numpy")
+    pytest.importorskip("rich")
+    from summvar.fhir.observation_definition import sketch_threshold
+    original = sketch_threshold()
+    sketch_threshold(100)
+    yield
+    sketch_threshold(original)
+
+def test_default_summary_switches_to_sketches(small_threshold):
+    from summvar.fhir.observation_definition import DefaultSummary
+
+    exact = DefaultSummary(["string"], {"NA"})
+    exact.add_column(["a", "b", "a", "NA", " "])
+    assert not exact.sketched
+    assert exact.distinct_count == 2
+    assert exact.missing_count == 2
+
+    wide = DefaultSummary(["string"], {"NA"})
+    wide.add_column([f"id-{i}" for i in range(1000)] + ["common"] * 50)
+    assert wide.sketched
+    assert len(wide.observed_data) == 0
+    assert abs(wide.distinct_count - 1001) <= 20
+    assert wide.top_values.top(1)[0][0] == "common"
+
+    # Merging an exact summary into a sketched one (and the reverse) keeps
+    # everything
+    exact.merge(wide)
+    assert exact.sketched
+    assert exact.nonmissing_count == 1053
+    assert abs(exact.distinct_count - 1003) <= 20
@@ -0,0 +1,88 @@
+"""
+A single tag scoped scan routed by (system, code) has to give each variable
+and group the same data as searching for each variable separately
+"""
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("rich")
+
+from summvar.fhir import InitMetaTag
+from summvar.fhir.group import Group, GroupIndex
+from summvar.fhir.observation_definition import ObservationDefinition
+from summvar.fhir.study_scan import StudyScan
+from summvar.summary.constants import common_terms
+
+from fhir_fakes import FakeServer, FakeAD, observation, quantity_od, group
+
+STUDY_TAG = {"system": "https://example.org/study", "code": "s1"}
+OTHER_TAG = {"system": "https://example.org/study", "code": "s2"}
+LOINC = "https://loinc.org"
+
+def summary_observation():
+    resource = observation("Group/g1", "ignored", 1, tag=STUDY_TAG)
+    resource['code'] = {"coding": [common_terms['SUMMARY_REPORT']]}
+    return resource
+
+@pytest.fixture
+def server():
+    # Height is coded two different ways in the study
+    height = observation("Patient/2", "8302-2", 170, system=LOINC, tag=STUDY_TAG)
+    height['code']['coding'].append({"system": "https://example.org/vars", "code": "height"})
+    return FakeServer([
+        observation("Patient/1", "age", 10, tag=STUDY_TAG),
+        observation("Patient/2", "age", 20, tag=STUDY_TAG),
+        observation("Patient/3", "age", 30, tag=STUDY_TAG),
+        observation("Patient/1", "height", 150, tag=STUDY_TAG),
+        height,
+        observation("Patient/1", "weight", 60, tag=STUDY_TAG),
+        observation("Patient/1", "weight", 60, tag=STUDY_TAG),
+        observation("Patient/1", "age", 99, tag=OTHER_TAG),
+        summary_observation()
+    ])
+
+@pytest.fixture
+def groups():
+    return [
+        Group(None, resource=group("g1", ["Patient/1", "Patient/2"])),
+        Group(None, resource=group("g2", ["Patient/2", "Patient/3"]))
+    ]
+
+def height_od():
+    resource = quantity_od("height")
+    resource['code']['coding'].append({"system": LOINC, "code": "8302-2"})
+    return resource
+
+def stats(data_manager):
+    quantity = data_manager.quantity
+    if quantity is None:
+        return None
+    return (quantity.count, quantity.sum)
+
+def test_scan_routes_by_code(server, groups):
+    InitMetaTag(STUDY_TAG['system'], STUDY_TAG['code'])
+    ods = [ObservationDefinition(server, resource=quantity_od("age")),
+           ObservationDefinition(server, resource=height_od())]
+    scan = StudyScan(server, [FakeAD(ods)], GroupIndex(groups))
+    scan.scan()
+
+    # One search for the whole study
+    assert len(server.queries) == 1
+    assert "_tag=https://example.org/study|s1" in server.queries[0]
+
+    # The summary Observation is neither matched nor unmatched. The height
+    # Observation with both codings is only counted once
+    assert scan.matched == 5
+    assert dict(scan.unmatched) == {("https://example.org/vars", "weight"): 2}
+
+    age, height = ods
+    assert [(p[2], stats(p[1])) for p in age.partitions] == [(2, (2, 30)), (2, (2, 50))]
+    assert [(p[2], stats(p[1])) for p in height.partitions] == [(2, (2, 320)), (1, (1, 170))]
+
+    # Same as searching for each variable, tag scoped, group by group
+    for od in ods:
+        for population, partition in zip(groups, od.partitions):
+            single = ObservationDefinition(server, resource=od.resource)
+            single.pull_observations(population, scope="tag")
+            assert stats(single.data_manager) == stats(partition[1])
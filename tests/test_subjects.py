@@ -0,0 +1,82 @@
+"""
+SubjectSet has to behave like the set of reference strings it replaces
+"""
+
+from summvar.summary.subjects import (SubjectSet, SubjectIndex, subject_index, 
+                                      reset_subject_index)
+
+def refs(start, stop, step=1):
+    return [f"Patient/{i}" for i in range(start, stop, step)]
+
+def test_behaves_like_a_set():
+    index = SubjectIndex()
+    subjects = SubjectSet(index=index)
+    for ref in ["Patient/2", "Patient/1", "Patient/2", "Patient/3"]:
+        subjects.add(ref)
+
+    assert len(subjects) == 3
+    assert "Patient/1" in subjects
+    assert "Patient/4" not in subjects
+    assert "Patient/never-interned" not in subjects
+    assert sorted(subjects) == ["Patient/1", "Patient/2", "Patient/3"]
+
+def test_dense_chunks_become_bitmaps():
+    index = SubjectIndex()
+    subjects = SubjectSet(refs(0, 10000), index=index)
+    assert len(subjects) == 10000
+    assert type(subjects.chunks[0]) is bytearray
+
+    # Adding duplicates to a bitmap chunk doesn't change the count
+    subjects.add("Patient/5")
+    assert len(subjects) == 10000
+    assert set(subjects) == set(refs(0, 10000))
+
+def test_ids_span_chunks():
+    index = SubjectIndex()
+    everyone = refs(0, 70000)
+    for ref in everyone:
+        index.intern(ref)
+    subjects = SubjectSet(refs(0, 70000, 7), index=index)
+
+    assert len(subjects) == len(range(0, 70000, 7))
+    assert "Patient/69993" in subjects
+    assert "Patient/69999" not in subjects
+    assert list(subjects) == refs(0, 70000, 7)
+
+def test_union():
+    index = SubjectIndex()
+    sparse = refs(0, 100, 2)
+    dense = refs(0, 6000)
+    cases = [
+        (sparse, refs(1, 100, 2)),      # array | array
+        (sparse, dense),                # array | bitmap
+        (dense, sparse),                # bitmap | array
+        (dense, refs(3000, 9000))       # bitmap | bitmap
+    ]
+    for left, right in cases:
+        a = SubjectSet(left, index=index)
+        b = SubjectSet(right, index=index)
+        union = a | b
+        assert set(union) == set(left) | set(right)
+        assert len(union) == len(set(left) | set(right))
+
+        # | leaves the operands alone while |= updates in place
+        assert len(a) == len(set(left))
+        a |= b
+        assert set(a) == set(left) | set(right)
+
+def test_array_union_past_the_limit():
+    index = SubjectIndex()
+    a = SubjectSet(refs(0, 8000, 2), index=index)
+    b = SubjectSet(refs(1, 8000, 2), index=index)
+    a |= b
+    assert len(a) == 8000
+    assert type(a.chunks[0]) is bytearray
+
+def test_default_index():
+    reset_subject_index()
+    subjects = SubjectSet(["Patient/1"])
+    assert subjects.index is subject_index()
+    assert len(subject_index()) == 1
+    reset_subject_index()
+    assert len(subject_index()) == 0
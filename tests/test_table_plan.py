@@ -0,0 +1,60 @@
+"""
+TablePlan resolves a table's columns against its ObservationDefinitions once
+and then only has to look at keys it hasn't seen before
+"""
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("rich")
+
+from summvar.fhir.activity_definition import TablePlan
+
+from fhir_fakes import FakeOD
+
+def test_plan_from_header():
+    age, sex, race = FakeOD("age_id"), FakeOD("sex_id"), FakeOD("race_id")
+    plan = TablePlan(["participant_id", "age_id", "sex_id", "file_id"], [age, sex, race])
+
+    assert plan.columns == {"age_id": [age], "sex_id": [sex]}
+    assert plan.recognized == {"age_id", "sex_id"}
+    assert plan.unrecognized == {"participant_id", "file_id"}
+    assert plan.unseen == {"race_id"}
+
+def test_new_keys_extend_the_plan():
+    age, race = FakeOD("age_id"), FakeOD("race_id")
+    plan = TablePlan(["participant_id", "age_id"], [age, race])
+
+    rows = [
+        {"participant_id": "p1", "age_id": 10},
+        {"participant_id": "p2"},
+        {"participant_id": "p3", "race_id": "Asian", "notes_id": "x"}
+    ]
+    assert plan.new_keys(rows[:2]) == set()
+    new_keys = plan.new_keys(rows)
+    assert new_keys == {"race_id", "notes_id"}
+
+    plan.extend(new_keys)
+    assert plan.columns == {"age_id": [age], "race_id": [race]}
+    assert plan.unseen == set()
+    assert plan.unrecognized == {"participant_id", "notes_id"}
+
+    # Keys the plan already has don't change anything
+    plan.extend(["age_id", "race_id"])
+    assert plan.columns == {"age_id": [age], "race_id": [race]}
+
+def test_shared_column():
+    a, b = FakeOD("age_id"), FakeOD("age_id")
+    plan = TablePlan([], [a, b])
+    assert plan.unseen == {"age_id"}
+    plan.extend({"age_id"})
+    assert plan.columns == {"age_id": [a, b]}
+
+def test_pivot_skips_missing_cells():
+    plan = TablePlan(["age_id", "sex_id"], [FakeOD("age_id"), FakeOD("sex_id")])
+    rows = [
+        {"age_id": 1, "sex_id": "F"},
+        {"sex_id": "M"},
+        {"age_id": 3, "other": "x"}
+    ]
+    assert plan.pivot(rows) == {"age_id": [1, 3], "sex_id": ["F", "M"]}
@@ -0,0 +1,90 @@
+"""
+UploadLedger hashing and skip behavior, using a stand-in for the FHIR client
+"""
+
+import pytest
+
+pytest.importorskip("rich")
+
+from summvar import upload_ledger
+from summvar.upload_ledger import (UploadLedger, InitUploadLedger, 
+                                   canonical_hash, post, forget)
+
+from fhir_fakes import FakeClient
+
+def group(value="g1", members=("Patient/1", "Patient/2"), **extra):
+    resource = {
+        "resourceType": "Group",
+        "identifier": [{"system": "https://example.org/group", "value": value}],
+        "member": [{"entity": {"reference": ref}} for ref in members],
+        "meta": {"tag": [{"code": "study"}]}
+    }
+    resource.update(extra)
+    return resource
+
+def test_hash_ignores_server_managed_properties():
+    original = group()
+    returned = group(id="123")
+    returned['meta'] = dict(returned['meta'], versionId="4", lastUpdated="2024-01-01")
+    assert canonical_hash(original) == canonical_hash(returned)
+
+def test_hash_sees_content_tags_and_key_order():
+    assert canonical_hash(group()) != canonical_hash(group(members=["Patient/1"]))
+
+    retagged = group()
+    retagged['meta'] = {"tag": [{"code": "other"}]}
+    assert canonical_hash(group()) != canonical_hash(retagged)
+
+    reordered = dict(reversed(list(group().items())))
+    assert canonical_hash(group()) == canonical_hash(reordered)
+
+def test_post_skips_unchanged(ledger):
+    client = FakeClient("https://fhir.example.org")
+    first = post(client, "Group", group())
+    again = post(client, "Group", group())
+    assert len(client.requests) == 1
+    assert again['status_code'] == 200
+    assert again['response']['id'] == first['response']['id']
+
+    post(client, "Group", group(members=["Patient/3"]))
+    assert len(client.requests) == 2
+    assert ledger.skipped == 1
+    assert ledger.written == 2
+
+def test_hosts_are_tracked_separately(ledger):
+    a = FakeClient("https://a.example.org")
+    b = FakeClient("https://b.example.org")
+    post(a, "Group", group())
+    post(b, "Group", group())
+    assert len(a.requests) == 1
+    assert len(b.requests) == 1
+
+def test_reset_and_forget(ledger):
+    a = FakeClient("https://a.example.org")
+    b = FakeClient("https://b.example.org")
+    post(a, "Group", group())
+    post(a, "Group", group("g2"))
+    post(b, "Group", group())
+
+    assert ledger.reset(a) == 2
+    post(a, "Group", group())
+    post(b, "Group", group())
+    assert len(a.requests) == 3
+    assert len(b.requests) == 1
+
+    forget(b, group())
+    post(b, "Group", group())
+    assert len(b.requests) == 2
+
+def test_ledger_persists(tmp_path):
+    client = FakeClient("https://fhir.example.org")
+    UploadLedger(tmp_path / "ledger.db").record(client, group(), "abc")
+    assert UploadLedger(tmp_path / "ledger.db").lookup(client, group()) == "abc"
+
+def test_without_ledger_everything_is_written():
+    InitUploadLedger(None)
+    client = FakeClient("https://fhir.example.org")
+    post(client, "Group", group())
+    post(client, "Group", group())
+    assert len(client.requests) == 2
+    assert upload_ledger.upload_ledger() is None